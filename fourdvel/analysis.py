@@ -61,21 +61,13 @@ class analysis(configure):
         test_id = self.test_id
 
         # Load all the results.
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_true_tide_vec.pkl','rb') as f:
-            self.grid_set_true_tide_vec = pickle.load(f)
+        self.grid_set_true_tide_vec = self.load_grid_set(this_result_folder, test_id, 'true_tide_vec')
 
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_tide_vec.pkl','rb') as f:
-            self.grid_set_tide_vec = pickle.load(f)
+        self.grid_set_tide_vec = self.load_grid_set(this_result_folder, test_id, 'tide_vec')
 
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_tide_vec_uq.pkl','rb') as f:
-            self.grid_set_tide_vec_uq = pickle.load(f)
+        self.grid_set_tide_vec_uq = self.load_grid_set(this_result_folder, test_id, 'tide_vec_uq')
 
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_others.pkl','rb') as f:
-            self.grid_set_others = pickle.load(f)
+        self.grid_set_others = self.load_grid_set(this_result_folder, test_id, 'others')
 
         self.point_set = self.grid_set_tide_vec.keys()
 
@@ -273,11 +265,12 @@ class analysis(configure):
             t_axis = np.arange(-600,600,0.0005)
             con_pred = np.zeros(shape=t_axis.shape)
 
+            schema = self.get_parameter_schema()
             for k, tide_name in enumerate(self.modeling_tides):
                 for t in range(3):
                     if t==2:
-                        ampU = tide_vec[3+k*6+t]
-                        phaseU = tide_vec[3+k*6+t+3]
+                        ampU = tide_vec[schema.amp_index[k,t]]
+                        phaseU = tide_vec[schema.phase_index[k,t]]
                         omega = 2*np.pi / self.tide_periods[tide_name]
     
                         dis_ampU = self.velo_amp_to_dis_amp(ampU, tide_name)
@@ -512,10 +505,27 @@ class analysis(configure):
 
         (data_info_set, data_vec_set, noise_sigma_set, offsetfields_set, true_tide_vec_set, height_set, demfactor_set, max_num_of_offsets_set) = all_data_set
 
-        linear_design_mat_set = self.build_G_set(point_set, offsetfields_set=offsetfields_set)
-
         if self.est_topo_resid:
-            linear_design_mat_set = self.modify_G_for_topo_resid_set(point_set, linear_design_mat_set, offsetfields_set, data_info_set, demfactor_set)
+            topo_resid_column_set = self.get_topo_resid_column_set(point_set, offsetfields_set, data_info_set, demfactor_set)
+        else:
+            topo_resid_column_set = None
+
+        # Cross validation solves the linear model (tides_1) again and downdates it by track and by pair
+        if task_name == "cross_validation":
+
+            design_mat_set = self.build_design_mat_set(point_set, offsetfields_set, topo_resid_column_set)
+            invCd_set = self.real_data_uncertainty_set(point_set, data_vec_set, noise_sigma_set)
+            model_prior = self.model_prior_precision()
+
+            analysis_set = self.cross_validation_set(point_set, design_mat_set, data_vec_set, invCd_set, offsetfields_set, model_prior)
+
+            print("Recording...")
+            all_sets = {}
+            all_sets['analysis_set'] = analysis_set
+
+            return all_sets
+
+        linear_design_mat_set = self.build_design_mat_set(point_set, offsetfields_set, topo_resid_column_set)
 
         # Perform estimation on each point
         analysis_set = {}
@@ -630,6 +640,8 @@ class analysis(configure):
         tide_data = self.tide_data
 
 
+        offsetfields = self.as_offsetfield_table(offsetfields)
+
         data_info_summary = self.summarize_data_info(data_info)
         for i, track in enumerate(data_info_summary):
             track_name, data_num = track
@@ -667,9 +679,13 @@ class analysis(configure):
             taxis = []
             tide_proxy_track = []
             pair_acq_time_track = []
-            for j, offsetfield in enumerate(offsetfields_track):
-                t1 = (offsetfield[0] - self.t_origin.date()).days + offsetfield[4]
-                t2 = (offsetfield[1] - self.t_origin.date()).days + offsetfield[4]
+            dates_a = offsetfields_track.dates_a
+            dates_b = offsetfields_track.dates_b
+            t_a_track = offsetfields_track.t_a.tolist()
+            t_b_track = offsetfields_track.t_b.tolist()
+            for j in range(len(offsetfields_track)):
+                t1 = t_a_track[j]
+                t2 = t_b_track[j]
                 taxis.append((t1+t2)/2)
 
                 # The tidal height
@@ -677,7 +693,7 @@ class analysis(configure):
                 z2 = tide_data[int(np.round((t2 - tide_taxis[0])/delta))]
 
                 # Record the low tide 
-                tide_proxy_track.append((z1, z2, track_num, offsetfield[0], offsetfield[1]))
+                tide_proxy_track.append((z1, z2, track_num, dates_a[j], dates_b[j]))
 
                 # Record the acquisition time
                 pair_acq_time_track.append((t1, t2))
@@ -410,42 +410,95 @@ class basics():
 
         return (tide_names, ris_tides_params)
 
-    def write_dict_to_xyz(self, show_dict, xyz_name, f2i=None):
-        
-        # Write to txt file.
-        f = open(xyz_name,'w')
-        #cap=1000
-        cap=10**10
-        for key in sorted(show_dict.keys()):
-            lon, lat = key
+    def write_dict_to_xyz(self, show_dict, xyz_name, f2i=None, binary=None):
 
-            if f2i is None:
-                lon, lat = self.int5d_to_float([lon,lat])
-            else:
-                lon, lat = lon/f2i, lat/f2i
-
-            value = show_dict[key]
-
-            # More than one value (velocity vector).
-            if isinstance(value,tuple):
-                if not np.isnan(value[0]):
-                    record = str(lon)+' '+str(lat)
-                    for irec in range(len(value)):
-                        record = record + ' ' + str(value[irec])
-                    record = record + '\n'
-                    f.write(record)
-            else:
-                # Only output valid values.
-                value = min(value,cap)
-                if not np.isnan(value):
+        # Points and values to arrays, written in bulk
+        keys = list(show_dict.keys())
 
-                    # write it
-                    f.write(str(lon)+' '+str(lat)+' '+str(value)+'\n')
+        # More than one value (velocity vector) is a tuple
+        widths = [len(show_dict[key]) if isinstance(show_dict[key], tuple) else 0 for key in keys]
 
-        f.close()
+        if len(set(widths)) <= 1:
+            points, values = self.dict_to_point_arrays(show_dict, keys, widths[0] if widths else 0)
+            self.write_points_to_xyz(points, values, xyz_name, f2i=f2i, binary=binary)
+            return
+
+        # Mixed single and multiple values (text only), formatted per width
+        lines_by_key = {}
+        for width in set(widths):
+            group_keys = [key for key, key_width in zip(keys, widths) if key_width == width]
+            points, values = self.dict_to_point_arrays(show_dict, group_keys, width)
+
+            index, coords, values = self.valid_xyz_records(points, values, f2i)
+            lines_by_key.update(zip([group_keys[i] for i in index.tolist()], self.format_xyz_text(coords, values).splitlines()))
+
+        with open(xyz_name, 'w') as f:
+            f.write(''.join(lines_by_key[key] + '\n' for key in sorted(lines_by_key.keys())))
+
+        return
+
+    def dict_to_point_arrays(self, show_dict, keys, width):
+
+        points = np.asarray(keys, dtype=np.float64).reshape(-1,2)
+        values = np.asarray([show_dict[key] for key in keys], dtype=np.float64)
+        if width > 0:
+            values = values.reshape(-1, width)
+
+        return (points, values)
+
+    def write_points_to_xyz(self, points, values, xyz_name, f2i=None, binary=None, fmt='%.10g'):
+
+        # points: (n,2) int5d lon/lat, values: (n,) or (n,k)
+        # binary: little-endian float32 records of lon, lat, values to <name>.bin (GMT: -bi3f, or -bi{k+2}f)
+        if binary is None:
+            binary = getattr(self, 'xyz_format', 'text') == 'binary'
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+        values = np.asarray(values, dtype=np.float64)
+
+        index, coords, values = self.valid_xyz_records(points, values, f2i)
+
+        if binary:
+            records = np.column_stack((coords, values if values.ndim == 2 else values[:,None])).astype('<f4')
+            records.tofile(os.path.splitext(xyz_name)[0] + '.bin')
+            return
+
+        # One write for the file
+        with open(xyz_name, 'w') as f:
+            f.write(self.format_xyz_text(coords, values, fmt))
 
         return
 
+    def valid_xyz_records(self, points, values, f2i=None):
+
+        # Sorted by lon and lat, only the valid values
+        # Returns the index of the records in the input, lon/lat in float and the values
+        if f2i is None:
+            f2i = self.float2int if hasattr(self, 'float2int') else 10**5
+
+        order = np.lexsort((points[:,1], points[:,0]))
+        values = values[order]
+
+        if values.ndim == 1:
+            # Single value, capped
+            cap = 10**10
+            values = np.minimum(values, cap)
+            valid = ~np.isnan(values)
+        else:
+            valid = ~np.isnan(values[:,0])
+
+        index = order[valid]
+
+        return (index, points[index] / f2i, values[valid])
+
+    def format_xyz_text(self, coords, values, fmt='%.10g'):
+
+        records = np.column_stack((coords, values if values.ndim == 2 else values[:,None]))
+        line_fmt = ' '.join([fmt] * records.shape[1]) + '\n'
+
+        # One formatting call for all the records
+        return line_fmt * len(records) % tuple(records.ravel().tolist())
+
     def write_datamat_to_xyz(self, datamat, xaxis, yaxis, xyz_name, f2i=None):
        
         f = open(xyz_name,'w')
@@ -19,6 +19,7 @@ from datetime import date
 import collections
 
 from fourdvel import fourdvel
+from offsetfield_table import offsetfield_table
 
 from simulation import simulation
 
@@ -112,19 +113,16 @@ class configure(fourdvel):
         # Based on track_pairs_set, add observation vectors and time fractions to get track_offsetfields_set
         track_offsetfields_set = {}
         for point in point_set:
-            track_offsetfields_set[point] = []
+            track_offsetfields_set[point] = offsetfield_table(self.t_origin)
 
             # vec info is available.
             if point in vecs_set.keys():
                 vec1 = vecs_set[point][0]
                 vec2 = vecs_set[point][1]
                 t_frac = self.track_timefraction[(sate,track_num)]
-                tail = [vec1, vec2, t_frac]
 
                 # offsetfields match the obtained offsets.
-                for pair in track_pairs_set[point]:
-                    offsetfield = pair + tail
-                    track_offsetfields_set[point].append(offsetfield)
+                track_offsetfields_set[point] = offsetfield_table.from_track(self.t_origin, track_pairs_set[point], vec1, vec2, t_frac, sate, track_num)
 
             # 2019.02.14
             # Cancel the obtained offsets, if no vec info is available for the point.
@@ -470,8 +468,8 @@ class configure(fourdvel):
                     # decfactor_set contains demfactor of 
 
                     for point in point_set:
-                        # List addition.
-                        offsetfields_set[point] = offsetfields_set[point] + track_offsetfields_set[point]
+                        # Table concatenation.
+                        offsetfields_set[point] = offsetfield_table.concatenate([offsetfields_set[point], track_offsetfields_set[point]], t_origin=self.t_origin)
 
                         # List addition
                         # Old
@@ -601,7 +599,7 @@ class configure(fourdvel):
         # data_info_set: For each point a list of (track_num, sate_name, number of data points)
         # data_vec_set: For each point, a vector
         # noise_sigma_set: For each point, a two value tuple (range error and azimuth error)
-        # offsetfields_set: For each point, a list of offsetfield info [date1, date2, vec1, vec2, t_frac]
+        # offsetfields_set: For each point, an offsetfield_table (columns of date1, date2, vec1, vec2, t_frac, sate, track)
         # true_tide_vev_set is the same for all satellites
 
         final_data_info_set = collections.defaultdict(list)
@@ -646,7 +644,7 @@ class configure(fourdvel):
                 final_data_info_set[point] = final_data_info_set[point] + data_info_set_dict[sate_name][point]
 
                 final_noise_sigma_set[point] = final_noise_sigma_set[point] + noise_sigma_set_dict[sate_name][point]
-                final_offsetfields_set[point] = final_offsetfields_set[point] + offsetfields_set_dict[sate_name][point]
+                final_offsetfields_set[point] = offsetfield_table.concatenate([final_offsetfields_set[point], offsetfields_set_dict[sate_name][point]], t_origin=self.t_origin)
 
                 final_height_set[point] = final_height_set[point] + height_set_dict[sate_name][point]
 
@@ -28,6 +28,9 @@ from estimate import estimate
 # Analysis
 from analysis import analysis
 
+# Load mode
+from point_result_consolidation import point_result_consolidation
+
 
 def createParser():
 
@@ -103,7 +106,7 @@ class driver_fourdvel():
         # Need to load the results
         # All grid_set except than grid_set needs to be updated
 
-        self.analysis_tasks = ["residual_vs_tide_height","residual_analysis"]
+        self.analysis_tasks = ["residual_vs_tide_height","residual_analysis","cross_validation"]
 
         # Set the task
         if self.task_name in self.estimate_tasks:
@@ -188,7 +191,7 @@ class driver_fourdvel():
             ################################################################################
 
                 # If this one is calculated then skip it
-                if os.path.exists(point_result_pklname) and self.update == False:
+                if tasks.tile_result_exists(point_name) and self.update == False:
                     print(point_result_pklname, "is already calculated and update mode is turend off. Skip")
                     continue
                 else:
@@ -272,8 +275,7 @@ class driver_fourdvel():
                             (use_threading and task_name in ["tides_2"] and tasks.inversion_method == "Nonlinear_Optimization"):
         
        
-                            with open(point_result_pklname, "wb") as f:
-                                pickle.dump(all_sets, f)
+                            tasks.save_tile_result(point_name, all_sets)
     
                             # Say that this tile is record
                             recorded = True
@@ -390,8 +392,13 @@ class driver_fourdvel():
             for ip in range(nthreads):
                 thread_to_tiles[ip] = []
 
-            for it in range(n_tiles):
-                thread_to_tiles[it % nthreads].append(it)
+            if tasks.gl_search_neighbour_seed:
+                # Contiguous runs of the serpentine order, each thread sweeps its own strip
+                for it in range(n_tiles):
+                    thread_to_tiles[it * nthreads // n_tiles].append(it)
+            else:
+                for it in range(n_tiles):
+                    thread_to_tiles[it % nthreads].append(it)
 
             print('thread to tiles: : ', thread_to_tiles)
             #print(stop)
@@ -474,56 +481,36 @@ class driver_fourdvel():
 
             ## end of dict.
 
+        elif tasks.use_result_store:
+            # Load the results from the result store, field by field
+            print("Loading the results from the result store...")
+            store = tasks.get_result_store()
+
+            tasks.grid_set_true_tide_vec = store.read_grid_set('true_tide_vec_set')
+            tasks.grid_set_tide_vec = store.read_grid_set('tide_vec_set')
+            tasks.grid_set_tide_vec_uq = store.read_grid_set('tide_vec_uq_set')
+            tasks.grid_set_resid_of_secular = store.read_grid_set('resid_of_secular_set')
+            tasks.grid_set_resid_of_tides = store.read_grid_set('resid_of_tides_set')
+            tasks.grid_set_others = store.read_grid_set('others_set')
+            tasks.grid_set_residual_analysis = store.read_grid_set('residual_analysis_set')
+
         else:
             # Load the results from point_result
+            # Through the compact shards of the tiles, only the new or updated tiles are converted
+            # Serial by default, the process pool only helps to convert many tiles on several cores
             print("Loading the results...")
-            point_results = os.listdir(self.estimation_dir + '/point_result')
-
-            # Intialization
-            tasks.grid_set_true_tide_vec = {}
-            tasks.grid_set_tide_vec = {}
-            tasks.grid_set_tide_vec_uq = {}
-            tasks.grid_set_resid_of_secular = {}
-            tasks.grid_set_resid_of_tides = {}
-            tasks.grid_set_others = {}
-            tasks.grid_set_residual_analysis = {}
- 
-            # Loop through the results
-            for ip, point_pkl in enumerate(point_results):
+            nthreads = self.nthreads if self.nthreads is not None else 1
 
-                if point_pkl.endswith('.pkl'):
-                    print(ip)
-    
-                    pklfile = self.estimation_dir + '/point_result/' + point_pkl
-                    
-                    with open(pklfile,"rb") as f:
-                        all_sets = pickle.load(f)
-    
-                    if all_sets['true_tide_vec_set'] is not None:
-                        tasks.grid_set_true_tide_vec.update(all_sets['true_tide_vec_set'])
-                    
-                    tasks.grid_set_tide_vec.update(all_sets['tide_vec_set'])
-                    tasks.grid_set_tide_vec_uq.update(all_sets['tide_vec_uq_set'])
-                    tasks.grid_set_resid_of_secular.update(all_sets['resid_of_secular_set'])
-                    tasks.grid_set_resid_of_tides.update(all_sets['resid_of_tides_set'])
-                    tasks.grid_set_others.update(all_sets['others_set'])
-                    tasks.grid_set_residual_analysis.update(all_sets['residual_analysis_set'])
-
-
-                    #point_set = set(all_sets['tide_vec_set'].keys())
-
-                    #print('point set size: ', len(point_set))
+            consolidation = point_result_consolidation(self.estimation_dir + '/point_result', self.estimation_dir + '/point_result_shards')
+            grid_sets = consolidation.consolidate(nthreads=nthreads)
 
-                    #on_ephemeral_grounding = tasks.check_point_set_with_requirements(point_set, kind='ephemeral_grounding')
-                    #on_ice_shelf = tasks.check_point_set_with_requirements(point_set, kind='ice_shelf')
-
-                    #if on_ice_shelf and not on_ephemeral_grounding:
-                    #    print('Need to redo this: ', point_pkl)
-                    #    cmd = 'rm estimations/20211822/point_result/' + point_pkl
-                    #    print(cmd)
-                    #    os.system(cmd)
-
-                    #tasks.grid_set_analysis.update(all_sets['analysis_set'])
+            tasks.grid_set_true_tide_vec = grid_sets['true_tide_vec_set']
+            tasks.grid_set_tide_vec = grid_sets['tide_vec_set']
+            tasks.grid_set_tide_vec_uq = grid_sets['tide_vec_uq_set']
+            tasks.grid_set_resid_of_secular = grid_sets['resid_of_secular_set']
+            tasks.grid_set_resid_of_tides = grid_sets['resid_of_tides_set']
+            tasks.grid_set_others = grid_sets['others_set']
+            tasks.grid_set_residual_analysis = grid_sets['residual_analysis_set']
 
         #return
 
@@ -537,6 +524,11 @@ class driver_fourdvel():
         #print(stop)
 
         # Estimates
+        # The tile results are already in the result store
+        if task_name in self.estimate_tasks and tasks.use_result_store:
+            forceUnSaveTides = True
+            print("The results are in the result store: ", tasks.get_result_store().store_dir)
+
         if ((task_name in self.estimate_tasks and tasks.single_point_mode == False) or (task_name in self.estimate_tasks and forceSaveTides == True)) and (forceUnSaveTides==False):
 
             print("Write results to disk")
@@ -575,7 +567,7 @@ class driver_fourdvel():
             if task_name == 'residual_vs_tide_height':
                 pkl_name = '_'.join([str(test_id), 'grid_set_analysis', task_name, tasks.analysis_name])  + '.pkl'
 
-            elif task_name == 'residual_analysis':
+            elif task_name in ['residual_analysis', 'cross_validation']:
                 pkl_name = '_'.join((str(test_id), 'grid_set_analysis', task_name))  + '.pkl'
             
             else:
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# Results of the grounding level enumeration (tides_3) of a tile
+# Replaces the dicts keyed by the integer grounding level in others_set[point]:
+# grounding_level_model_likelihood, grounding_level_up_scale, grounding_level_resids
+# Sorted grounding level axis, (n_points, n_levels) arrays and a mask of the enumerated (point, level)
+
+import numpy as np
+
+class enum_result_cube():
+
+    def __init__(self, point_set=None):
+
+        self.points = []
+        self.point_index = {}
+
+        # gl * 10**6, sorted
+        self.grounding_levels = np.zeros(shape=(0,), dtype=np.int64)
+
+        self.model_likelihood = np.zeros(shape=(0,0), dtype=np.float32)
+        self.up_scale = np.zeros(shape=(0,0), dtype=np.float32)
+        # resid_of_tides: (range_mean, range_rms, azimuth_mean, azimuth_rms)
+        self.resids = np.zeros(shape=(0,0,4), dtype=np.float32)
+        self.valid = np.zeros(shape=(0,0), dtype=bool)
+
+        # Stage of the auto enumeration
+        self.current_auto_enum_stage = 0
+
+        if point_set is not None:
+            self.add_points(point_set)
+
+    @classmethod
+    def from_others_set(cls, point_set, others_set):
+
+        # From the dicts in others_set[point] (tile results before the cube)
+        cube = cls(point_set)
+
+        for point in point_set:
+            if not 'grounding_level_model_likelihood' in others_set[point]:
+                continue
+
+            grounding_levels_int = list(others_set[point]['grounding_level_model_likelihood'].keys())
+            cube.append([point], {point: grounding_levels_int},
+                        {point: [others_set[point]['grounding_level_model_likelihood'][gl_int] for gl_int in grounding_levels_int]},
+                        {point: [others_set[point]['grounding_level_up_scale'][gl_int] for gl_int in grounding_levels_int]},
+                        {point: [others_set[point]['grounding_level_resids'][gl_int] for gl_int in grounding_levels_int]})
+
+        cube.current_auto_enum_stage = others_set.get('current_auto_enum_stage', 0)
+
+        return cube
+
+    def __getstate__(self):
+
+        # Pickle only the enumerated cells and the packed mask
+        # With per point levels (auto mode) most cells of the arrays are empty
+        state = self.__dict__.copy()
+        state.pop('point_index')
+
+        state['valid'] = (np.packbits(self.valid, axis=None), self.valid.shape)
+        for name in ['model_likelihood', 'up_scale', 'resids']:
+            state[name] = getattr(self, name)[self.valid]
+
+        return state
+
+    def __setstate__(self, state):
+
+        packed_valid, shape = state['valid']
+        valid = np.unpackbits(packed_valid, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+
+        for name, cell_shape in [('model_likelihood', ()), ('up_scale', ()), ('resids', (4,))]:
+            values = np.full(shape + cell_shape, np.nan, dtype=np.float32)
+            values[valid] = state[name]
+            state[name] = values
+
+        state['valid'] = valid
+        self.__dict__.update(state)
+        self.point_index = {point: ip for ip, point in enumerate(self.points)}
+
+    @property
+    def n_points(self):
+        return len(self.points)
+
+    @property
+    def n_levels(self):
+        return len(self.grounding_levels)
+
+    def add_points(self, point_set):
+
+        new_points = [point for point in point_set if point not in self.point_index]
+        if len(new_points) == 0:
+            return 0
+
+        for point in new_points:
+            self.point_index[point] = len(self.points)
+            self.points.append(point)
+
+        n_new = len(new_points)
+        self.model_likelihood = np.concatenate((self.model_likelihood, np.full((n_new, self.n_levels), np.nan, dtype=np.float32)), axis=0)
+        self.up_scale = np.concatenate((self.up_scale, np.full((n_new, self.n_levels), np.nan, dtype=np.float32)), axis=0)
+        self.resids = np.concatenate((self.resids, np.full((n_new, self.n_levels, 4), np.nan, dtype=np.float32)), axis=0)
+        self.valid = np.concatenate((self.valid, np.zeros((n_new, self.n_levels), dtype=bool)), axis=0)
+
+        return 0
+
+    def add_levels(self, grounding_levels_int):
+
+        # Merge into the sorted axis, the old columns move to their new positions
+        grounding_levels = np.union1d(self.grounding_levels, np.asarray(grounding_levels_int, dtype=np.int64))
+        if len(grounding_levels) == self.n_levels:
+            return 0
+
+        old_cols = np.searchsorted(grounding_levels, self.grounding_levels)
+        shape = (self.n_points, len(grounding_levels))
+
+        model_likelihood = np.full(shape, np.nan, dtype=np.float32)
+        up_scale = np.full(shape, np.nan, dtype=np.float32)
+        resids = np.full(shape + (4,), np.nan, dtype=np.float32)
+        valid = np.zeros(shape, dtype=bool)
+
+        model_likelihood[:,old_cols] = self.model_likelihood
+        up_scale[:,old_cols] = self.up_scale
+        resids[:,old_cols] = self.resids
+        valid[:,old_cols] = self.valid
+
+        self.grounding_levels = grounding_levels
+        self.model_likelihood = model_likelihood
+        self.up_scale = up_scale
+        self.resids = resids
+        self.valid = valid
+
+        return 0
+
+    def append(self, point_set, grounding_levels_int_set, model_likelihood_set, up_scale_set, resid_set):
+
+        # Per point lists of the levels and their results, a level enumerated again is overwritten
+        self.add_points(point_set)
+
+        grounding_levels_int = [np.asarray(grounding_levels_int_set[point], dtype=np.int64).reshape(-1) for point in point_set]
+        if sum(len(levels) for levels in grounding_levels_int) == 0:
+            return 0
+
+        self.add_levels(np.concatenate(grounding_levels_int))
+
+        rows = np.concatenate([np.full(len(levels), self.point_index[point]) for point, levels in zip(point_set, grounding_levels_int)])
+        cols = np.searchsorted(self.grounding_levels, np.concatenate(grounding_levels_int))
+
+        self.model_likelihood[rows, cols] = np.concatenate([np.asarray(model_likelihood_set[point], dtype=np.float64).reshape(-1) for point in point_set])
+        self.up_scale[rows, cols] = np.concatenate([np.asarray(up_scale_set[point], dtype=np.float64).reshape(-1) for point in point_set])
+        self.resids[rows, cols] = np.concatenate([np.asarray(resid_set[point], dtype=np.float64).reshape(-1,4) for point in point_set])
+        self.valid[rows, cols] = True
+
+        return 0
+
+    def completed_levels(self, point):
+
+        if point not in self.point_index:
+            return []
+
+        return self.grounding_levels[self.valid[self.point_index[point]]].tolist()
+
+    def point_levels(self, point):
+
+        # Enumerated levels of a point and their likelihoods and up_scales, sorted by level
+        if point not in self.point_index:
+            return (np.zeros(shape=(0,), dtype=np.int64), np.zeros(shape=(0,)), np.zeros(shape=(0,)))
+
+        ip = self.point_index[point]
+        valid = self.valid[ip]
+
+        return (self.grounding_levels[valid], self.model_likelihood[ip, valid].astype(np.float64), self.up_scale[ip, valid].astype(np.float64))
+
+    def value(self, point, grounding_level_int, name='up_scale'):
+
+        ip = self.point_index[point]
+        col = np.searchsorted(self.grounding_levels, grounding_level_int)
+        if col == self.n_levels or self.grounding_levels[col] != grounding_level_int or not self.valid[ip, col]:
+            raise KeyError(grounding_level_int)
+
+        return getattr(self, name)[ip, col]
+
+    def arrays(self, point_set):
+
+        # (n_levels,) and (len(point_set), n_levels) arrays, nan where not enumerated
+        rows = np.asarray([self.point_index.get(point, -1) for point in point_set], dtype=np.int64)
+        has_row = rows >= 0
+
+        model_likelihood = np.full((len(point_set), self.n_levels), np.nan)
+        up_scale = np.full((len(point_set), self.n_levels), np.nan)
+
+        valid = self.valid[rows[has_row]]
+        model_likelihood[has_row] = np.where(valid, self.model_likelihood[rows[has_row]], np.nan)
+        up_scale[has_row] = np.where(valid, self.up_scale[rows[has_row]], np.nan)
+
+        return (self.grounding_levels.copy(), model_likelihood, up_scale)
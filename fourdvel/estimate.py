@@ -8,7 +8,6 @@ import sys
 import pickle
 import shelve
 import time
-import copy
 
 import numpy as np
 from scipy import stats
@@ -21,6 +20,7 @@ from datetime import date
 from configure import configure
 from display import display
 from solvers import solvers
+from enum_result_cube import enum_result_cube
 
 class estimate(configure):
     def __init__(self, param_file=None):
@@ -73,6 +73,9 @@ class estimate(configure):
         others_set = {}
         for point in point_set:
             others_set[point] = {}
+
+        # Normal equations kept for the incremental update (tides_1)
+        normal_eq_state = None
         
         # test point
         #print('The test point is: ', self.test_point)
@@ -113,6 +116,20 @@ class estimate(configure):
 
         print("Number of offset pairs at test point: ", len(offsetfields_set[point]))
 
+        # Points without data skip the linear inversion and get NaN results in bulk
+        # The test point stays in the inversion for its diagnostics
+        data_point_set = [point for point in point_set if len(offsetfields_set[point]) > 0]
+        print("Number of points with data: ", len(data_point_set), "/", n_points)
+
+        if len(data_point_set) > 0:
+            inversion_point_set = [point for point in point_set if len(offsetfields_set[point]) > 0 or point == self.test_point]
+        else:
+            print("No point in this tile has data, skip the inversion")
+            inversion_point_set = []
+
+        inversion_points = set(inversion_point_set)
+        empty_point_set = [point for point in point_set if not point in inversion_points]
+
         # Check task and inversion method
         if task_name in ["tides_1","tides_3"]:
             assert inversion_method == "Bayesian_Linear"
@@ -120,18 +137,19 @@ class estimate(configure):
         if task_name == "tides_2":
             assert inversion_method in ["Bayesian_MCMC", "Nonlinear_Optimization"]
 
-        if task_name in ["tides_1", "tides_3"] and inversion_method == 'Bayesian_Linear':
+        if task_name in ["tides_1", "tides_3"] and inversion_method == 'Bayesian_Linear' and len(inversion_point_set) > 0:
+
+            # Only the points in the inversion below
+            full_point_set = point_set
+            point_set = inversion_point_set
             
+            # Count the paths of the linear solver in this tile
+            self.reset_linear_solver_counts()
+
             # Get data error prior.
             invCd_set = self.real_data_uncertainty_set(point_set, data_vec_set, noise_sigma_set)
             print("Data error prior set is Done")
 
-            # Get design matrix.
-            linear_design_mat_set_orig = self.build_G_set(point_set, offsetfields_set=offsetfields_set)
-    
-            #print("Design matrix set (G)\n:", linear_design_mat_set[self.test_point])
-            print("Design matrix (obs) set is Done")
-
             # tides_1: simple linear model
             if task_name == "tides_1":
 
@@ -191,27 +209,29 @@ class estimate(configure):
                 elif enum_grounding_run_mode == "continue":
 
                     # Load existing tile_set
-                    point_result_folder = self.estimation_dir + '/point_result'
-                    tile_lon, tile_lat = self.tile
-                    point_name = str(tile_lon) + '_' + str(tile_lat)
-
-                    tile_result_pkl_file = point_result_folder + "/" + point_name + ".pkl"
-                    if os.path.exists(tile_result_pkl_file):
-                        with open(tile_result_pkl_file,"rb") as f:
-                            all_sets_former = pickle.load(f)
+                    all_sets_former = self.load_tile_result(self.tile)
+                    if all_sets_former is not None:
 
                         # Load others set
                         others_set = all_sets_former["others_set"]
 
-                        # Load the enumerated values at test point
-                        completed_enum_gl = others_set[self.test_point]["grounding_level_model_likelihood"].keys()
-                        print("Completed enum gl: ", sorted(completed_enum_gl))
+                        # Tile results saved before the enumeration cube
+                        if not "grounding_level_enum" in others_set:
+                            others_set["grounding_level_enum"] = enum_result_cube.from_others_set(point_set, others_set)
+                            others_set.pop("current_auto_enum_stage", None)
+                            for point in point_set:
+                                for name in ["grounding_level_model_likelihood", "grounding_level_up_scale", "grounding_level_resids"]:
+                                    others_set[point].pop(name, None)
 
-                        # Load the auto enumeration stage if exists
-                        if "current_auto_enum_stage" in others_set:
-                            #others_set['current_auto_enum_stage'] = 1
+                        enum_cube = others_set["grounding_level_enum"]
 
-                            current_auto_enum_stage = others_set['current_auto_enum_stage']
+                        # Load the enumerated values at test point
+                        completed_enum_gl = enum_cube.completed_levels(self.test_point)
+                        print("Completed enum gl: ", completed_enum_gl)
+
+                        # Load the auto enumeration stage
+                        #enum_cube.current_auto_enum_stage = 1
+                        current_auto_enum_stage = enum_cube.current_auto_enum_stage
 
                     else:
                         completed_enum_gl = []
@@ -219,6 +239,8 @@ class estimate(configure):
                 else:
                     raise ValueError("Unknown enum grounding run mode")
 
+                enum_cube = self.get_enum_result_cube(point_set, others_set)
+
 
                 ###### Prepare the grounding level values to be enumerated #########
                 if gl_option == 'no_grounding':
@@ -317,7 +339,7 @@ class estimate(configure):
 
                     # Mark that the next stage will be done (for manual mode)
                     # Need to be checked every time in manual mode
-                    others_set['current_auto_enum_stage'] = 3
+                    enum_cube.current_auto_enum_stage = 3
                
                 elif gl_option == 'auto':
                     # set the parameters for auto
@@ -367,7 +389,14 @@ class estimate(configure):
                     print("gl_high: ", gl_high)
 
                     # Derive the gl values to be enumerated
-                    if current_auto_enum_stage == 0:
+                    # Adaptive search does all stages at once
+                    if self.gl_search_mode == 'adaptive' and current_auto_enum_stage < len(auto_enum_stages):
+
+                        enum_grounding_level_int = ['adaptive']
+
+                        next_auto_enum_stage = len(auto_enum_stages)
+
+                    elif current_auto_enum_stage == 0:
 
                         # move to stage 1
                         next_auto_enum_stage = current_auto_enum_stage + 1
@@ -445,7 +474,7 @@ class estimate(configure):
                     print("Next auto enum stage: ", next_auto_enum_stage)
                     
                     # Mark that the next stage will be done (for auto mode)
-                    others_set['current_auto_enum_stage'] = next_auto_enum_stage
+                    enum_cube.current_auto_enum_stage = next_auto_enum_stage
 
                 ### End of auto mode for gl_option ###
 
@@ -527,18 +556,124 @@ class estimate(configure):
                 
                 others_set[point]['lowest_tide_height'] = lowest_tide_height
 
+            ### Prepare the part of G that does not depend on the grounding level ###
+            if len(enum_grounding_level_int) > 0 and task_name == "tides_1" and self.incremental_update:
+
+                # Normal equations from the tile result, with the new offset pairs folded in
+                linear_design_mat_set_fixed = None
+
+                normal_eq_state = self.load_normal_eq_state(self.tile)
+                num_new_pairs_set = self.update_normal_eq_state_set(normal_eq_state, point_set, offsetfields_set, data_vec_set, invCd_set, data_info_set, demfactor_set)
+                normal_eq_set_fixed = normal_eq_state.normal_eq_set(point_set)
+                print("Normal equations (obs) set is updated. New offset pairs in this tile and at test point: ", sum(num_new_pairs_set.values()), num_new_pairs_set[self.test_point])
+
+                # Model prior, diagonal and shared by all points.
+                model_prior = self.model_prior_precision()
+                print("Model prior Done")
+
+            elif len(enum_grounding_level_int) > 0 and self.assemble_normal_eq:
+
+                # Normal equations of the fixed part of G, without forming G
+                linear_design_mat_set_fixed = None
+
+                if self.est_topo_resid:
+                    topo_resid_column_set = self.get_topo_resid_column_set(point_set, offsetfields_set, data_info_set, demfactor_set)
+                else:
+                    topo_resid_column_set = None
+
+                # Model prior, diagonal and shared by all points.
+                model_prior = self.model_prior_precision()
+                print("Model prior Done")
+
+                if task_name == "tides_1":
+                    normal_eq_set_fixed = self.assemble_normal_eq_set(point_set, offsetfields_set, data_vec_set, invCd_set, secular_variation=self.est_secular_variation, topo_resid_column_set=topo_resid_column_set)
+                    print("Normal equations (obs) set is Done")
+
+                elif task_name == "tides_3":
+                    normal_eq_set_fixed = self.assemble_normal_eq_set(point_set, offsetfields_set, data_vec_set, invCd_set, secular_variation=self.est_secular_variation, topo_resid_column_set=topo_resid_column_set)
+                    enum_state_set = self.prepare_enum_normal_eq_set(point_set, None, data_vec_set, invCd_set, model_prior, fixed_normal_eq_set=normal_eq_set_fixed)
+                    print("Normal equations of the fixed part of G are Done")
+
+            elif len(enum_grounding_level_int) > 0:
+
+                if self.est_topo_resid:
+                    topo_resid_column_set = self.get_topo_resid_column_set(point_set, offsetfields_set, data_info_set, demfactor_set)
+                else:
+                    topo_resid_column_set = None
+
+                # Design matrix with all the columns of the parameter schema, allocated once.
+                # The order of the columns is: 1. tides 2. tides_3 up 3. secular variation 4. topo resid
+                # The tides_3 up column is filled in place for each grounding level
+                linear_design_mat_set_fixed = self.build_design_mat_set(point_set, offsetfields_set, topo_resid_column_set)
+                print("Design matrix (obs) set is Done. Matrix shape ", linear_design_mat_set_fixed[self.test_point].shape)
+
+                # Model prior, diagonal and shared by all points.
+                model_prior = self.model_prior_precision()
+                print("Model prior Done")
+
+                # tides_3: solve the fixed part once, and update it for each grounding level
+                if task_name == "tides_3":
+                    enum_state_set = self.prepare_enum_normal_eq_set(point_set, linear_design_mat_set_fixed, data_vec_set, invCd_set, model_prior)
+                    print("Normal equations of the fixed part of G are Done")
+
+            ### Adaptive search of the grounding level (tides_3, auto) ###
+            if len(enum_grounding_level_int) > 0 and enum_grounding_level_int[0] == 'adaptive':
+
+                # Search windows from the solved neighbour tiles
+                gl_window_set = None
+                if self.gl_search_neighbour_seed:
+                    neighbour_gl_set = self.load_neighbour_grounding_levels(self.tile)
+                    gl_window_set = self.neighbour_seeded_gl_window_set(point_set, neighbour_gl_set, gl_low, gl_high)
+                    print("Number of points with a seeded search window: ", len(gl_window_set), "/", len(point_set))
+
+                self.adaptive_grounding_level_search_set(point_set, enum_state_set, offsetfields_set, up_disp_set, data_vec_set, invCd_set, gl_low, gl_high, others_set, topo_resid_column_set, gl_window_set)
+                print("Adaptive search of the grounding level Done")
+
+                # Nothing left to enumerate
+                enum_grounding_level_int = []
+
+            ### Batched enumeration of the grounding levels (tides_3, find) ###
+            if task_name == "tides_3" and self.gl_enum_batch and tides_3_mode == "find_optimal_gl" and gl_option in ['auto', 'manual'] and len(enum_grounding_level_int) > 0:
+
+                # The grounding levels of each point, same as the enumeration loop below
+                grounding_levels_int_set = {}
+                for point in point_set:
+                    if gl_option == 'auto' and point_set_on_ice_shelf:
+                        gl_low_int, gl_enum_spacing_int = enum_grounding_level_auto_mode_set[point]
+                        grounding_levels_int = [gl_low_int + enum_grounding_level * gl_enum_spacing_int for enum_grounding_level in enum_grounding_level_int]
+                        grounding_levels_int = np.clip(grounding_levels_int, a_min = gl_low * 10**6, a_max = gl_high * 10**6)
+                    else:
+                        grounding_levels_int = enum_grounding_level_int
+
+                    grounding_levels_int_set[point] = [int(grounding_level_int) for grounding_level_int in grounding_levels_int]
+
+                grounding_levels_set = {point: np.asarray(grounding_levels_int_set[point]) / 10**6 for point in point_set}
+
+                model_likelihood_set, up_scale_set, resid_of_tides_set = self.evaluate_grounding_levels_batch_set(point_set, enum_state_set, offsetfields_set, up_disp_set, data_vec_set, invCd_set, grounding_levels_set, topo_resid_column_set)
+                self.export_to_others_set_wrt_gl_batch(point_set, grounding_levels_int_set, model_likelihood_set, up_scale_set, resid_of_tides_set, others_set)
+                print("Batched enumeration of {} grounding levels Done".format(len(enum_grounding_level_int)))
+
+                # Nothing left to enumerate
+                enum_grounding_level_int = []
+
             ### Main: Loop through the grounding level ###
             for ienum, enum_grounding_level in enumerate(enum_grounding_level_int):
 
                 # Default linear inversion ("tides_1")
                 if enum_grounding_level is None:
-                     linear_design_mat_set = linear_design_mat_set_orig
+                    linear_design_mat_set = linear_design_mat_set_fixed
+                    up_disp_column_set = None
+
+                    # Model posterior and inversion, batched over the tile (Singular matrix will come back with nan).
+                    #Cm_p_set = self.model_posterior_set(point_set, linear_design_mat_set, invCd_set, invCm_set, test_point = self.test_point)
+                    #model_vec_set = self.param_estimation_set(point_set, linear_design_mat_set, data_vec_set, invCd_set, invCm_set, Cm_p_set)
+                    if self.assemble_normal_eq or normal_eq_state is not None:
+                        Cm_p_set, model_vec_set = self.solve_normal_eq_set(point_set, normal_eq_set_fixed, model_prior, variance_only=self.posterior_variance_only)
+                    else:
+                        Cm_p_set, model_vec_set = self.model_posterior_param_estimation_batch_set(point_set, linear_design_mat_set, data_vec_set, invCd_set, model_prior, variance_only=self.posterior_variance_only)
 
                 # Nonlinear inversion with the grounding level ("tides_3")
                 else:
-                    # Make a deep copy of dictionary of design matrix
-                    linear_design_mat_set = copy.deepcopy(linear_design_mat_set_orig)
-
                     # Find the given_grounding_level
                     if enum_grounding_level == 'external':
                         given_grounding_level = external_grounding_level
@@ -617,42 +752,24 @@ class estimate(configure):
                         else:
                             raise ValueError("Unknown gl_option")
 
-                    # Modifying G matrix to add direct modeling of vertical displacement
-                    linear_design_mat_set = self.modify_G_set(point_set, linear_design_mat_set, offsetfields_set, up_disp_set, grounding_level = given_grounding_level, gl_name = gl_name)
-                    print("Modified matrix (obs) set for tide_3 mode is Done. Matrix shape ", linear_design_mat_set[self.test_point].shape)
-
-                # If invert for secular variation, add three column for G
-                if self.est_secular_variation:
-                    linear_design_mat_set = self.modify_G_for_secular_variation_set(point_set, linear_design_mat_set, offsetfields_set, data_info_set)
-                    print("Modified matrix (obs) set for secular variation is Done. Matrix shape ", linear_design_mat_set[self.test_point].shape)
-
-                # If invert for topographic residual, add another column for G
-                if self.est_topo_resid:
-                    linear_design_mat_set = self.modify_G_for_topo_resid_set(point_set, linear_design_mat_set, offsetfields_set, data_info_set, demfactor_set)
-                    print("Modified matrix (obs) set for topo resid is Done. Matrix shape ", linear_design_mat_set[self.test_point].shape)
-
+                    # Up column of G for this grounding level (direct modeling of vertical displacement)
+                    up_disp_column_set = self.get_up_disp_column_set(point_set, offsetfields_set, up_disp_set, grounding_level = given_grounding_level, gl_name = gl_name)
 
-                ## The order of making modification is required. 1. tides_3 change 2. secular variation 3. topo resid
-                ##########################################################################################################
+                    # Model posterior and inversion by updating the fixed part (Singular matrix will come back with nan).
+                    if self.assemble_normal_eq:
+                        border_set = self.assemble_normal_eq_border_set(point_set, offsetfields_set, data_vec_set, invCd_set, up_disp_column_set, secular_variation=self.est_secular_variation, topo_resid_column_set=topo_resid_column_set)
+                        Cm_p_set, model_vec_set, linear_design_mat_set = self.enum_posterior_param_estimation_set(point_set, enum_state_set, up_disp_column_set, border_set, variance_only=self.posterior_variance_only)
+                        print("Normal equations for tide_3 mode are Done")
+                    else:
+                        Cm_p_set, model_vec_set, linear_design_mat_set = self.enum_posterior_param_estimation_set(point_set, enum_state_set, up_disp_column_set, variance_only=self.posterior_variance_only)
+                        print("Modified matrix (obs) set for tide_3 mode is Done. Matrix shape ", linear_design_mat_set[self.test_point].shape)
 
-                # Model prior.
-                if ienum == 0:
-                    invCm_set = self.model_prior_set(point_set)
-                    print("Model prior set Done")
-                else:
-                    print('Reuse the model prior set')
-        
-                # Model posterior (Singular matrix will come back with nan).
-                Cm_p_set = self.model_posterior_set(point_set, linear_design_mat_set, invCd_set, invCm_set, test_point = self.test_point)
                 #print('Model posterior: ',Cm_p_set[self.test_point])
                 print("Model posterior set Done")
-        
+
                 # Show the model posterior.
                 #self.display.show_model_mat(Cm_p_set[self.test_point])
-        
-                ### Inversion ###
-                # Estimate model params.
-                model_vec_set = self.param_estimation_set(point_set, linear_design_mat_set, data_vec_set, invCd_set, invCm_set, Cm_p_set)
+
                 #print('model_vec_set: ', model_vec_set)
                 print('Model vec set estimation Done')
     
@@ -662,23 +779,29 @@ class estimate(configure):
                 print("Bayesian linear model: \n")
                 print(bl_model_vec)
     
-                # Calculale the residual.
-                resid_of_secular_set, resid_of_tides_set = self.get_resid_set(point_set, linear_design_mat_set, data_vec_set, model_vec_set)
-                print('Residual calculation Done')
+                # Incremental update: the residual and the model likelihood are from the normal equations, no prediction
+                if normal_eq_state is not None:
+                    resid_of_secular_set, resid_of_tides_set, residual_analysis_set, model_likelihood_set = self.post_solve_analysis_from_state_set(point_set, normal_eq_state, data_info_set, model_vec_set)
+
+                else:
+                    # Prediction streamed over the offsets, if G is not formed
+                    if self.assemble_normal_eq:
+                        data_vec_pred_set, data_vec_pred_secular_set = self.predict_data_vec_set(point_set, offsetfields_set, model_vec_set, up_disp_column_set=up_disp_column_set, secular_variation=self.est_secular_variation, topo_resid_column_set=topo_resid_column_set)
+                    else:
+                        data_vec_pred_set, data_vec_pred_secular_set = None, None
+
+                    # Calculale the residual, the residual per track per obs and the model likelihood (one prediction per point).
+                    resid_of_secular_set, resid_of_tides_set, residual_analysis_set, model_likelihood_set = self.post_solve_analysis_set(point_set, data_info_set, offsetfields_set, data_vec_set, invCd_set, linear_design_mat_set, model_vec_set, data_vec_pred_set, data_vec_pred_secular_set)
+                print('Residual calculation, residual analysis and model likelihood calculation Done')
+
                 resid_of_tides_point = resid_of_tides_set[self.test_point]
                 print("Residual at this point: ", resid_of_tides_point)
 
-                # Calculate the residual per trakc per obs
-                residual_analysis_set = self.point_set_residual_analysis(point_set, data_info_set, offsetfields_set, data_vec_set, linear_design_mat_set, model_vec_set)
-                print('Residual analysis Done')
                 #print(residual_analysis_set)
                 #print(residual_analysis_set.keys())
                 resid_analysis_point_result = residual_analysis_set[self.test_point]
                 print("Residual analysis at this point: ", resid_analysis_point_result)
 
-                # Calculale the model likelihood.
-                model_likelihood_set = self.get_model_likelihood_set(point_set, linear_design_mat_set, data_vec_set, model_vec_set, invCd_set)
-                print('Model likelihood calculation Done')
                 model_likelihood_point = model_likelihood_set[self.test_point]
                 print("Model likelihood at this point: ", model_likelihood_point)
 
@@ -706,13 +829,18 @@ class estimate(configure):
 
             ## End of enumeration ##
 
+            print("Linear solver ({}) paths in this tile: ".format(self.linear_solver), self.linear_solver_counts)
+
             # Select the optimal grounding level
             # If mode is tides_3 and the enumeration is actually done, so the others set is done
             forceUpdateOthers = False
             if self.task_name == "tides_3" and (tides_3_mode == "find_optimal_gl" or forceUpdateOthers):
                 
                 # Select the optimal grounding level
-                self.select_optimal_grounding_level(point_set, self.grid_set_velo, others_set)
+                if self.gl_select_vectorized:
+                    self.select_optimal_grounding_level_vectorized(point_set, self.grid_set_velo, others_set)
+                else:
+                    self.select_optimal_grounding_level(point_set, self.grid_set_velo, others_set)
         
                 # Show the results at test_point 
                 optimal_grounding_level_int = others_set[self.test_point]["optimal_grounding_level"]
@@ -722,8 +850,7 @@ class estimate(configure):
 
                 print("####")
                 print("optimal gl: ", others_set[self.test_point]['optimal_grounding_level'])
-                #print("gl model likelihood: ", others_set[self.test_point]['grounding_level_model_likelihood'])
-                #print("gl up scale: ", others_set[self.test_point]['grounding_level_up_scale'])
+                #print("gl model likelihood: ", others_set['grounding_level_enum'].point_levels(self.test_point))
                 #print("gl prob: ", others_set[self.test_point]['grounding_level_prob'])
                 print("gl credible interval: ", others_set[self.test_point]['grounding_level_credible_interval'])
                 print("####")
@@ -778,7 +905,7 @@ class estimate(configure):
                     #print(stop)
 
                 if not np.isnan(optimal_grounding_level_int):
-                    up_scale = others_set[self.test_point]['grounding_level_up_scale'][optimal_grounding_level_int]
+                    up_scale = others_set['grounding_level_enum'].value(self.test_point, optimal_grounding_level_int)
 
                     print("The scaling is: ", up_scale)
                     print("Optimal grounding level after scaling: ", optimal_grounding_level * up_scale)
@@ -823,6 +950,13 @@ class estimate(configure):
 
             #######################################################
 
+            point_set = full_point_set
+
+        # NaN results of the points without data
+        if task_name in ["tides_1", "tides_3"] and inversion_method == 'Bayesian_Linear' and len(empty_point_set) > 0:
+            self.export_empty_point_set(empty_point_set, tide_vec_set, tide_vec_uq_set, resid_of_secular_set, resid_of_tides_set, residual_analysis_set, others_set)
+            print("NaN results of points without data Done: ", len(empty_point_set))
+
         # Non-linear model 
         if task_name == "tides_2" and inversion_method in ['Bayesian_MCMC', 'Nonlinear_Optimization']:
 
@@ -975,5 +1109,9 @@ class estimate(configure):
 
         all_sets['residual_analysis_set'] = residual_analysis_set
 
+        # Kept for the next incremental update
+        if normal_eq_state is not None:
+            all_sets['normal_eq_state'] = normal_eq_state
+
         return all_sets
 
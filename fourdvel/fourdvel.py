@@ -23,6 +23,14 @@ from datetime import date
 import multiprocessing
 
 from basics import basics
+from offsetfield_table import offsetfield_table
+from grounding_level_selection import grounding_level_selection
+from enum_result_cube import enum_result_cube
+from parameter_schema import parameter_schema
+from normal_eq_state import normal_eq_state
+from offset_stack_store import offset_stack_store, convert_stack_pkl
+from offset_stack_cache import offset_stack_cache
+from result_store import result_store
 
 #from numba import jit
 
@@ -206,6 +214,19 @@ class fourdvel(basics):
         self.csk_data_log = None
         self.csk_data_product_ids = None
 
+        # offset field stacks: memory-mapped store instead of the pickles
+        self.offset_stack_store = False
+
+        # offset field stacks: load a track at the first use, LRU cache size in GB (None: no limit)
+        self.offset_stack_lazy = False
+        self.offset_stack_cache_size = None
+
+        # tile results: columnar result store instead of point_result pickles and grid_set pickles
+        self.use_result_store = False
+
+        # xyz output: text, or binary (little-endian float32 lon, lat, values in <name>.bin)
+        self.xyz_format = 'text'
+
         # error model
         self.data_error_mode = None
         self.data_uncert_grid_set_pklfile = None
@@ -219,6 +240,39 @@ class fourdvel(basics):
         # est secular variation
         self.est_secular_variation = False
 
+        # Bayesian linear: assemble the normal equations without forming G
+        self.assemble_normal_eq = False
+        self.normal_eq_chunk_size = 4096
+
+        # Bayesian linear: solver of the normal equations (cholesky, qr, svd)
+        self.linear_solver = 'cholesky'
+
+        # Bayesian linear: only keep the variances (and secular covariances) of the posterior
+        self.posterior_variance_only = False
+
+        # tides_1: keep the normal equations in the tile result and only fold in the new offset pairs
+        self.incremental_update = False
+
+        # tides_3: search of the grounding level in auto mode (staged, adaptive)
+        self.gl_search_mode = 'staged'
+        self.gl_search_coarse_space = 0.4
+        self.gl_search_tol = 0.01
+        self.gl_search_ci_tol = 0.01
+        self.gl_search_max_ci_iter = 4
+
+        # tides_3: seed the adaptive search window of a point from the solved neighbour tiles
+        self.gl_search_neighbour_seed = False
+        self.gl_search_seed_radius = 2
+        self.gl_search_seed_min_count = 3
+        self.gl_search_seed_spread = 0.4
+        self.gl_search_seed_margin = 0.1
+
+        # tides_3: evaluate all enumerated grounding levels of a stage at once
+        self.gl_enum_batch = False
+
+        # tides_3: select the optimal grounding levels of all points at once
+        self.gl_select_vectorized = False
+
         # options to skip some point sets
         self.point_set_check_kind = None
 
@@ -269,6 +323,19 @@ class fourdvel(basics):
                     print("copy param file: ",cmd)
                     os.system(cmd)
 
+            if name == 'use_result_store':
+                if value == 'True':
+                    self.use_result_store = True
+                else:
+                    self.use_result_store = False
+                print('use_result_store: ', value)
+
+            if name == 'xyz_format':
+                if value not in ['text', 'binary']:
+                    raise ValueError("Unknown xyz_format: " + value)
+                self.xyz_format = value
+                print('xyz_format: ', value)
+
             if name == "test_point":
                 if value.lower() != "none":
 
@@ -385,6 +452,28 @@ class fourdvel(basics):
                 print('csk_data_product_ids: ',value)
                 print("Number of products: ", len(set(self.csk_data_product_ids)))
 
+            # Offset field stacks (csk and s1)
+            if name == 'offset_stack_store':
+                if value == 'True':
+                    self.offset_stack_store = True
+                else:
+                    self.offset_stack_store = False
+                print('offset_stack_store: ', value)
+
+            if name == 'offset_stack_lazy':
+                if value == 'True':
+                    self.offset_stack_lazy = True
+                else:
+                    self.offset_stack_lazy = False
+                print('offset_stack_lazy: ', value)
+
+            if name == 'offset_stack_cache_size':
+                if value == 'None':
+                    self.offset_stack_cache_size = None
+                else:
+                    self.offset_stack_cache_size = float(value)
+                print('offset_stack_cache_size: ', value)
+
             # S1
             if name == 'use_s1':
                 if value == 'True':
@@ -569,6 +658,101 @@ class fourdvel(basics):
                     self.est_secular_variation = False
                 print('est_secular_variation: ', value)
 
+            ## Normal equations without forming G
+            if name == 'assemble_normal_eq':
+                if value == 'True':
+                    self.assemble_normal_eq = True
+                else:
+                    self.assemble_normal_eq = False
+                print('assemble_normal_eq: ', value)
+
+            if name == 'normal_eq_chunk_size':
+                self.normal_eq_chunk_size = int(value)
+                print('normal_eq_chunk_size: ', value)
+
+            if name == 'linear_solver':
+                if value not in ['cholesky', 'qr', 'svd']:
+                    raise ValueError("Unknown linear_solver: " + value)
+                self.linear_solver = value
+                print('linear_solver: ', value)
+
+            if name == 'posterior_variance_only':
+                if value == 'True':
+                    self.posterior_variance_only = True
+                else:
+                    self.posterior_variance_only = False
+                print('posterior_variance_only: ', value)
+
+            if name == 'incremental_update':
+                if value == 'True':
+                    self.incremental_update = True
+                else:
+                    self.incremental_update = False
+                print('incremental_update: ', value)
+
+            ## Grounding level search
+            if name == 'gl_search_mode':
+                if value not in ['staged', 'adaptive']:
+                    raise ValueError("Unknown gl_search_mode: " + value)
+                self.gl_search_mode = value
+                print('gl_search_mode: ', value)
+
+            if name == 'gl_search_coarse_space':
+                self.gl_search_coarse_space = float(value)
+                print('gl_search_coarse_space: ', value)
+
+            if name == 'gl_search_tol':
+                self.gl_search_tol = float(value)
+                # The grounding levels are saved as int (1e-6 m)
+                if self.gl_search_tol < 1e-6:
+                    raise ValueError("gl_search_tol must be at least 1e-6 m: " + value)
+                print('gl_search_tol: ', value)
+
+            if name == 'gl_search_ci_tol':
+                self.gl_search_ci_tol = float(value)
+                print('gl_search_ci_tol: ', value)
+
+            if name == 'gl_search_max_ci_iter':
+                self.gl_search_max_ci_iter = int(value)
+                print('gl_search_max_ci_iter: ', value)
+
+            if name == 'gl_search_neighbour_seed':
+                if value == 'True':
+                    self.gl_search_neighbour_seed = True
+                else:
+                    self.gl_search_neighbour_seed = False
+                print('gl_search_neighbour_seed: ', value)
+
+            if name == 'gl_search_seed_radius':
+                self.gl_search_seed_radius = int(value)
+                print('gl_search_seed_radius: ', value)
+
+            if name == 'gl_search_seed_min_count':
+                self.gl_search_seed_min_count = int(value)
+                print('gl_search_seed_min_count: ', value)
+
+            if name == 'gl_search_seed_spread':
+                self.gl_search_seed_spread = float(value)
+                print('gl_search_seed_spread: ', value)
+
+            if name == 'gl_search_seed_margin':
+                self.gl_search_seed_margin = float(value)
+                print('gl_search_seed_margin: ', value)
+
+            if name == 'gl_enum_batch':
+                if value == 'True':
+                    self.gl_enum_batch = True
+                else:
+                    self.gl_enum_batch = False
+                print('gl_enum_batch: ', value)
+
+            if name == 'gl_select_vectorized':
+                if value == 'True':
+                    self.gl_select_vectorized = True
+                else:
+                    self.gl_select_vectorized = False
+                print('gl_select_vectorized: ', value)
+
             ## Analysis ##
             if name == 'analysis_name':
                 self.analysis_name = value
@@ -1020,8 +1204,28 @@ class fourdvel(basics):
             print("tile set file is missing: ", self.tile_set_pkl_name)
             raise Exception()
 
+        # Neighbour seeding needs the neighbour tiles to be solved first
+        if self.gl_search_neighbour_seed:
+            self.tile_set = self.spatially_coherent_tile_set(self.tile_set)
+            print("Tiles are in serpentine order")
+
         return 0 
 
+    def spatially_coherent_tile_set(self, tile_set):
+
+        # Serpentine order: column by column in lon, alternating the direction in lat
+        # Consecutive tiles are adjacent
+        tiles_of_lon = {}
+        for tile in tile_set.keys():
+            tiles_of_lon.setdefault(tile[0], []).append(tile)
+
+        ordered_tile_set = {}
+        for i, tile_lon in enumerate(sorted(tiles_of_lon.keys())):
+            for tile in sorted(tiles_of_lon[tile_lon], key=lambda tile: tile[1], reverse=(i % 2 == 1)):
+                ordered_tile_set[tile] = tile_set[tile]
+
+        return ordered_tile_set
+
     def get_used_datasets(self):
 
         # Find the datasets
@@ -1389,38 +1593,22 @@ class fourdvel(basics):
 
     def get_up_single_disp_for_point(self, point, offsetfields):
 
-        tide_height_master = []
-        tide_height_slave = []
-        for i in range(len(offsetfields)):
-            timing_a = (offsetfields[i][0], round(offsetfields[i][4],4))
-            timing_b = (offsetfields[i][1], round(offsetfields[i][4],4))
+        offsetfields = self.as_offsetfield_table(offsetfields)
 
-            # Tide height for the two dates
-            tide_height_master.append(self.timings_tide_heights[timing_a])
-            tide_height_slave.append(self.timings_tide_heights[timing_b])
-
-        tide_height_master = np.asarray(tide_height_master)
-        tide_height_slave = np.asarray(tide_height_slave)
+        # Tide height for the two dates
+        tide_height_master = np.asarray([self.timings_tide_heights[timing_a] for timing_a in offsetfields.timings_a()])
+        tide_height_slave = np.asarray([self.timings_tide_heights[timing_b] for timing_b in offsetfields.timings_b()])
 
         return (tide_height_master, tide_height_slave)
 
     def get_up_parametric_single_disp_for_point(self, point, offsetfields, tide_cons, tide_params):
 
         # timings
-        master_timings = []
-        slave_timings = []
-        for i in range(len(offsetfields)):
-            timing_a = (offsetfields[i][0], round(offsetfields[i][4],4))
-            timing_b = (offsetfields[i][1], round(offsetfields[i][4],4))
-
-            ta = (timing_a[0] - self.t_origin.date()).days + timing_a[1]
-            tb = (timing_b[0] - self.t_origin.date()).days + timing_b[1]
+        offsetfields = self.as_offsetfield_table(offsetfields)
+        rounded_t_frac = np.asarray(offsetfields.rounded_t_frac(), dtype=np.float64)
 
-            master_timings.append(ta)
-            slave_timings.append(tb)
-    
-        master_timings = np.asarray(master_timings)
-        slave_timings = np.asarray(slave_timings)
+        master_timings = offsetfields.day_a + rounded_t_frac
+        slave_timings = offsetfields.day_b + rounded_t_frac
 
         # tide heights
         tide_height_master = 0
@@ -1461,18 +1649,9 @@ class fourdvel(basics):
                 up_disp = pickle.load(f)
 
         # Get timings for master and slave        
-        ta_arr = []
-        tb_arr = []
-        for i in range(len(offsetfields)):
-            # (offsetfields[i][0] - t_origin).days + offsetfields[i][4]
-            ta = (offsetfields[i][0] - self.t_origin.date()).days + offsetfields[i][4]
-            tb = (offsetfields[i][1] - self.t_origin.date()).days + offsetfields[i][4]
-
-            ta_arr.append(ta)
-            tb_arr.append(tb)
-
-        ta_arr = np.asarray(ta_arr)
-        tb_arr = np.asarray(tb_arr)
+        offsetfields = self.as_offsetfield_table(offsetfields)
+        ta_arr = offsetfields.t_a
+        tb_arr = offsetfields.t_b
 
         # Important! Need to enforce 0.001 delta here. Using taxis[1]-taxis[0] will cause problem due to float precision 
         t_delta = 0.001
@@ -1509,11 +1688,9 @@ class fourdvel(basics):
         stacked_design_mat_U_tb = []
 
         # Note that it is possible that offsetfields is empty
+        offsetfields = self.as_offsetfield_table(offsetfields)
 
-        for i in range(len(offsetfields)):
-
-            timing_a = (offsetfields[i][0], round(offsetfields[i][4],4))
-            timing_b = (offsetfields[i][1], round(offsetfields[i][4],4))
+        for timing_a, timing_b in zip(offsetfields.timings_a(), offsetfields.timings_b()):
 
             # design_mat_set shape: 
             # 2 * n_params for EN
@@ -1548,7 +1725,12 @@ class fourdvel(basics):
         #    self.use_csk = False 
    
         # Create the dictionary for all offset fields 
-        self.offsetFieldStack_all = {}
+        # Tracks are loaded at the first use (lazy) or all at the end of this function
+        if self.offset_stack_lazy and self.offset_stack_cache_size is not None:
+            max_bytes = int(self.offset_stack_cache_size * 1024**3)
+        else:
+            max_bytes = None
+        self.offsetFieldStack_all = offset_stack_cache(self.load_offset_field_stack, max_bytes=max_bytes)
 
         # Find the necessary tracks
         skip_this = True
@@ -1610,11 +1792,8 @@ class fourdvel(basics):
                 else:
                     raise ValueError()
 
-                if os.path.exists(track_offsetFieldStack_pkl):
-                    print("Loading: ", track_offsetFieldStack_pkl)
-                    with open(track_offsetFieldStack_pkl,'rb') as f:
-                        offsetFieldStack = pickle.load(f)
-                        self.offsetFieldStack_all[("csk", track_num)]= offsetFieldStack
+                if self.offset_field_stack_exists(track_offsetFieldStack_pkl):
+                    self.offsetFieldStack_all.register(("csk", track_num), track_offsetFieldStack_pkl)
                 else:
                     print(track_offsetFieldStack_pkl + ' does not exist')
                     assert self.csk_data_mode==1, "Test mode must be 1"
@@ -1639,17 +1818,42 @@ class fourdvel(basics):
                 else:
                     raise ValueError()
 
-                if os.path.exists(track_offsetFieldStack_pkl):
-                    print("Loading: ", track_offsetFieldStack_pkl)
-                    with open(track_offsetFieldStack_pkl,'rb') as f:
-                        offsetFieldStack = pickle.load(f)
-                        self.offsetFieldStack_all[("s1", track_num)] = offsetFieldStack
+                if self.offset_field_stack_exists(track_offsetFieldStack_pkl):
+                    self.offsetFieldStack_all.register(("s1", track_num), track_offsetFieldStack_pkl)
                 else:
                     print(track_offsetFieldStack_pkl + ' does not exist')
                     assert self.s1_data_mode==1, "Test mode must be 1"
 
+        if not self.offset_stack_lazy:
+            self.offsetFieldStack_all.load_all()
+
         return 0
 
+    def offset_field_stack_exists(self, track_offsetFieldStack_pkl):
+
+        if os.path.exists(track_offsetFieldStack_pkl):
+            return True
+
+        return self.offset_stack_store and offset_stack_store(offset_stack_store.store_dir_of_pkl(track_offsetFieldStack_pkl)).exists()
+
+    def load_offset_field_stack(self, track_offsetFieldStack_pkl):
+
+        # Memory-mapped store next to the pickle, converted at the first use
+        if self.offset_stack_store:
+            store = offset_stack_store(offset_stack_store.store_dir_of_pkl(track_offsetFieldStack_pkl))
+
+            if not store.exists():
+                store = convert_stack_pkl(track_offsetFieldStack_pkl, store.store_dir)
+
+            print("Loading (memmap): ", store.store_dir)
+            return store.load()
+
+        print("Loading: ", track_offsetFieldStack_pkl)
+        with open(track_offsetFieldStack_pkl,'rb') as f:
+            offsetFieldStack = pickle.load(f)
+
+        return offsetFieldStack
+
     def point_rounding(self, point):
 
         point_lon, point_lat = point
@@ -1832,10 +2036,15 @@ class fourdvel(basics):
 
                         offsetfields.append([d1,d2,vec1,vec2,t_frac])
 
+        offsetfields = offsetfield_table.from_offsetfields(self.t_origin, offsetfields, data_info_list)
+
         return data_info_list, offsetfields
 
     def build_G_set(self, point_set, offsetfields_set):
         
+        # Points in the tile share the temporal basis of the same track
+        self.temporal_basis_cache = {}
+
         linear_design_mat_set = {}
         for point in point_set:
             offsetfields = offsetfields_set[point]
@@ -1872,369 +2081,579 @@ class fourdvel(basics):
         ###############################################################
 
         ## Build the G matrix
+        offsetfields = self.as_offsetfield_table(offsetfields)
+
+        # Temporal basis (from the cache of each track)
+        if not hasattr(self, 'temporal_basis_cache'):
+            self.temporal_basis_cache = {}
+
+        coefs_list = []
+        for track_name, track_slice in offsetfields.track_slices():
+            coefs_list.append(self.get_temporal_basis(track_name, offsetfields[track_slice]))
+
+        coefs = np.vstack(coefs_list)
+
+        ## G formation.
+        # E, N, U components.
+        # cosE, cosN, cosU and sinE, sinN, sinU.
+        G = self.project_coefs_to_obs_vecs(offsetfields.vecs, coefs)
+
+        return G
+        # End of building G.
+
+    def build_design_mat_set(self, point_set, offsetfields_set, topo_resid_column_set=None):
+
+        # Points in the tile share the temporal basis of the same track
+        self.temporal_basis_cache = {}
+
+        schema = self.get_parameter_schema()
+
+        design_mat_set = {}
+        for point in point_set:
+            topo_resid_column = topo_resid_column_set[point] if topo_resid_column_set is not None else None
+            design_mat_set[point] = self.build_design_mat(offsetfields_set[point], schema, topo_resid_column)
+
+        return design_mat_set
+
+    def build_design_mat(self, offsetfields, schema, topo_resid_column=None):
+
+        # G with all the columns of the schema, allocated once
+        # The tides_3 up column is left empty, it is filled in place for each grounding level
+        n_offsets = len(offsetfields)
+
+        # Important: accounting for no offsetfield scenario
+        if n_offsets == 0:
+            G = np.zeros(shape=(1,1)) + np.nan
+            return G
+
+        offsetfields = self.as_offsetfield_table(offsetfields)
+        vecs = offsetfields.vecs
+
+        if not hasattr(self, 'temporal_basis_cache'):
+            self.temporal_basis_cache = {}
+
+        G = np.zeros(shape=(n_offsets*2, schema.num_params))
+
+        for track_name, track_slice in offsetfields.track_slices():
+            coefs = self.get_temporal_basis(track_name, offsetfields[track_slice])
+            rows = slice(track_slice.start*2, track_slice.stop*2)
+
+            # Secular and tidal columns
+            G[rows, 0:schema.n_tide_params] = self.project_coefs_to_obs_vecs(vecs[track_slice], coefs)
+
+            # Secular variation, coefficient delta_td^2
+            if schema.secular_variation:
+                G[rows, schema.secular_variation_index] = self.project_coefs_to_obs_vecs(vecs[track_slice], np.square(coefs[:,0:1]))
+
+        if schema.topo_resid:
+            G[:, schema.topo_resid_index] = topo_resid_column
+
+        return G
+
+    def get_parameter_schema(self, up_disp=None, secular_variation=None, topo_resid=None):
+
+        # Layout of the run, unless the optional columns are given
+        if up_disp is None:
+            up_disp = self.task_name == "tides_3"
+
+        if secular_variation is None:
+            secular_variation = self.est_secular_variation
+
+        if topo_resid is None:
+            topo_resid = self.est_topo_resid
+
+        if not hasattr(self, 'parameter_schema_cache'):
+            self.parameter_schema_cache = {}
+
+        key = (tuple(self.modeling_tides), up_disp, secular_variation, topo_resid)
+        if key not in self.parameter_schema_cache:
+            self.parameter_schema_cache[key] = parameter_schema(self.modeling_tides, up_disp=up_disp, secular_variation=secular_variation, topo_resid=topo_resid)
+
+        return self.parameter_schema_cache[key]
+
+    def get_temporal_basis(self, track_name, offsetfields_track):
+
+        # Key: satellite, track, used pairs, modeling tides, t_origin
+        key = (track_name, offsetfields_track.day_a.tobytes(), offsetfields_track.day_b.tobytes(), offsetfields_track.t_frac.tobytes(), tuple(self.modeling_tides), self.t_origin)
+
+        if key in self.temporal_basis_cache:
+            return self.temporal_basis_cache[key]
+
+        coefs = self.build_temporal_basis(offsetfields_track)
+        self.temporal_basis_cache[key] = coefs
+
+        return coefs
+
+    def build_temporal_basis(self, offsetfields):
+
         modeling_tides = self.modeling_tides
         n_modeling_tides = self.n_modeling_tides
         tide_periods = self.tide_periods
 
-        t_origin = self.t_origin.date()
+        n_offsets = len(offsetfields)
+
+        # Timings as arrays
+        t_a, t_b, delta_td, vecs = self.offsetfields_to_arrays(offsetfields)
 
         # Build up delta_td, delta_cos and delta_sin.
-        delta_td = np.zeros(shape=(n_offsets,))
-        delta_cos = np.zeros(shape=(n_offsets,n_modeling_tides))
-        delta_sin = np.zeros(shape=(n_offsets,n_modeling_tides))
-        
-        for i in range(n_offsets):
+        omegas = np.asarray([2 * np.pi / tide_periods[tide_name] for tide_name in modeling_tides])
 
-            t_a = (offsetfields[i][0] - t_origin).days + offsetfields[i][4]
-            t_b = (offsetfields[i][1] - t_origin).days + offsetfields[i][4]
+        delta_cos = np.cos(t_b[:,None] * omegas[None,:]) - np.cos(t_a[:,None] * omegas[None,:])
+        delta_sin = np.sin(t_b[:,None] * omegas[None,:]) - np.sin(t_a[:,None] * omegas[None,:])
 
-            delta_td[i] = (offsetfields[i][1] - offsetfields[i][0]).days
+        # Coefficients of the column blocks: secular, (cos, sin) of each tide
+        coefs = np.zeros(shape=(n_offsets, 1 + n_modeling_tides*2))
+        coefs[:,0] = delta_td
+        coefs[:,1::2] = delta_cos
+        coefs[:,2::2] = delta_sin
 
-            for j in range(n_modeling_tides):
+        return coefs
 
-                tide_name = modeling_tides[j]
+    def as_offsetfield_table(self, offsetfields):
 
-                omega = 2 * np.pi / tide_periods[tide_name]
-            
-                delta_cos[i,j] = np.cos(omega*t_b) - np.cos(omega*t_a)
-                delta_sin[i,j] = np.sin(omega*t_b) - np.sin(omega*t_a)
+        # Old list of [date1, date2, vec1, vec2, t_frac] is converted
+        return offsetfield_table.from_offsetfields(self.t_origin, offsetfields)
 
-        n_rows = n_offsets * 2 # Each offset corresponds to a vector.
+    def offsetfields_to_arrays(self, offsetfields):
 
-        # E, N, U components.
-        n_cols = 3 + n_modeling_tides * 6 # cosE, cosN, cosU and sinE, sinN, sinU.
-        
-        ## G formation.
-        G = np.zeros(shape=(n_rows,n_cols))
+        offsetfields = self.as_offsetfield_table(offsetfields)
 
-        # Iterate over offsetfields
-        for i in range(n_offsets):
+        t_a = offsetfields.t_a
+        t_b = offsetfields.t_b
+        delta_td = offsetfields.delta_td
 
-            # Find the observation vector (los, azi) refering to "create_grid_set"
-            vecs = [offsetfields[i][2],offsetfields[i][3]]
+        # Observation vectors (los, azi) refering to "create_grid_set", shape (n_offsets, 2, 3)
+        vecs = offsetfields.vecs
 
-            # Two observation vectors
-            for j in range(2):
+        return (t_a, t_b, delta_td, vecs)
 
-                # Get the vector (represent E,N,U)
-                vector = np.asarray(vecs[j])
+    def project_coefs_to_obs_vecs(self, vecs, coefs):
 
-                # Row entries of the observation.
-                row = np.zeros(shape=(n_cols,))
+        # Each column block is (E,N,U) vector multiplied by a scalar coefficient per offset
+        # vecs: (n_offsets, 2, 3), coefs: (n_offsets, n_blocks)
+        # Output: (n_offsets*2, n_blocks*3), rows are (los, azi) of each offset
+        n_offsets, n_blocks = coefs.shape
 
-                # Secular component.
-                row[0:3] = vector * delta_td[i]
-                
-                # Tidal components. (Projection)
-                for k in range(n_modeling_tides):
-                    row[3*(2*k+1):3*(2*k+2)] = vector * delta_cos[i,k]
-                    row[3*(2*k+2):3*(2*k+3)] = vector * delta_sin[i,k]
+        G = np.einsum('ij,ikc->ikjc', coefs, vecs)
 
-                # Put them in into G.
-                G[i*2+j,:] = row
+        return G.reshape(n_offsets*2, n_blocks*3)
 
-        return G
-        # End of building G.
+    ## Normal equations without forming G ##
+    # Each row of G is an observation vector (E,N,U) times a temporal coefficient of the offset (Kronecker structure).
+    # G^T W G and G^T W d are accumulated from 3x3 blocks of the offsets, chunk by chunk.
+    # The scalar columns (tides_3 up, topo resid) are given as per-row columns.
 
-    def modify_G_for_topo_resid_set(self, point_set, G_set, offsetfields_set, data_info_set, demfactor_set):
+    def normal_eq_column_layout(self, up_disp, secular_variation, topo_resid):
 
-        for point in point_set:
+        # Same column order as G: 1. tides 2. tides_3 up 3. secular variation 4. topo resid
+        schema = self.get_parameter_schema(up_disp, secular_variation, topo_resid)
 
-            #if point != self.test_point:
-            #    continue
-            
-            G = G_set[point]
+        return (schema.kron_index, schema.scalar_index, schema.num_params)
 
-            offsetfields = offsetfields_set[point]
+    def iter_temporal_basis_chunks(self, offsetfields, secular_variation, chunk_size=None):
 
-            data_info = data_info_set[point]
+        if chunk_size is None:
+            chunk_size = self.normal_eq_chunk_size
 
-            demfactor_dict = demfactor_set[point]
+        if not hasattr(self, 'temporal_basis_cache'):
+            self.temporal_basis_cache = {}
 
-            demfactor_list = [demfactor_dict[data_info[i]] for i in range(len(data_info))]
+        for track_name, track_slice in offsetfields.track_slices():
+            coefs_track = self.get_temporal_basis(track_name, offsetfields[track_slice])
+            n_track = coefs_track.shape[0]
 
-            B_perp_list = []
-            #B_perp_list_2 = []
-            for i, offsetfield in enumerate(offsetfields):
-                sate, track_num = data_info[i]
-                date1, date2 = offsetfield[0:2]
-                pairname = date1.strftime('%Y%m%d') + '_' + date2.strftime('%Y%m%d')
+            for start in range(0, n_track, chunk_size):
+                stop = min(start + chunk_size, n_track)
+                coefs = coefs_track[start:stop]
 
-                B_perp_list.append(self.pair_baselines_dict[sate][sate, track_num, pairname])
-                
-                ## Find the B_perp data
-                #if sate == 'csk':
-                #    track_name = 'track_' + str(track_num).zfill(3) + '_0'
-                #    B_perp_pklfile = os.path.join(self.csk_workdir, track_name, 'merged/interp_baselines', pairname+'.pkl')
-                #    with open(B_perp_pklfile, "rb") as f:
-                #        B_perp_data = pickle.load(f)
-                #    
-                #    B_perp_list_2.append(B_perp_data[0])
-
-                #elif sate == 's1':
-                #    track_name = 'track_' + str(track_num)
-                #    B_perp_pklfile = os.path.join(self.s1_workdir, track_name, 'merged/interp_baselines', pairname+'.pkl')
-                #    with open(B_perp_pklfile, "rb") as f:
-                #        B_perp_data = pickle.load(f)
-                #    
-                #    B_perp_list_2.append(B_perp_data[0])
-
-                #else:
-                #    raise ValueError()
- 
-            #print('offsetfields: ', len(offsetfields))
-            #print('data_info: ', len(data_info))
-            #print('demfactor: ', len(demfactor_list))
-            #print('B_perp: ', len(B_perp_list))
-            #print(B_perp_list, B_perp_list_2)
+                # Secular variation is one more block with coefficient delta_td^2
+                if secular_variation:
+                    coefs = np.hstack((coefs, np.square(coefs[:,0:1])))
 
-            # modify G for topo resid
-            G_set[point] = self.modify_G_for_topo_resid(point=point, G=G, offsetfields=offsetfields, demfactor_list=demfactor_list, B_perp_list=B_perp_list)
+                yield (slice(track_slice.start + start, track_slice.start + stop), coefs)
 
-        return G_set
+    def get_scalar_columns(self, n_offsets, columns):
 
-    def modify_G_for_topo_resid(self, point, G, offsetfields, demfactor_list, B_perp_list):
+        # (n_offsets, 2, n_columns)
+        columns = [column for column in columns if column is not None]
+        if len(columns) == 0:
+            return np.zeros(shape=(n_offsets,2,0))
 
-        # Control the number of offsetfields
+        return np.stack([np.asarray(column).reshape(n_offsets,2) for column in columns], axis=2)
+
+    def assemble_normal_eq_set(self, point_set, offsetfields_set, data_vec_set, invCd_set, up_disp_column_set=None, secular_variation=False, topo_resid_column_set=None):
+
+        # Points in the tile share the temporal basis of the same track
+        self.temporal_basis_cache = {}
+
+        normal_eq_set = {}
+        for point in point_set:
+            up_disp_column = up_disp_column_set[point] if up_disp_column_set is not None else None
+            topo_resid_column = topo_resid_column_set[point] if topo_resid_column_set is not None else None
+
+            normal_eq_set[point] = self.assemble_normal_eq(offsetfields_set[point], data_vec_set[point], invCd_set[point], up_disp_column=up_disp_column, secular_variation=secular_variation, topo_resid_column=topo_resid_column)
+
+        return normal_eq_set
+
+    def assemble_normal_eq(self, offsetfields, data_vec, invCd, up_disp_column=None, secular_variation=False, topo_resid_column=None, chunk_size=None):
+
+        # Returns (G^T W G, G^T W d, d^T W d), None if there is no data
         n_offsets = len(offsetfields)
+        if n_offsets == 0:
+            return None
 
-        # Important: accounting for the no offsetfield scenario
-        if n_offsets ==0:
-            G = np.zeros(shape=(1,1)) + np.nan
-            return G 
+        offsetfields = self.as_offsetfield_table(offsetfields)
+        vecs = offsetfields.vecs
 
-        ## Modify the G matrix
-        # Find the shape of G
-        n_rows, n_cols = G.shape
-        #print("n_rows, n_cols: ", n_rows, n_cols)
-
-        # Add a column to model topo resid
-        G = np.hstack((G, np.zeros(shape=(n_rows,1))))
-
-        # Iterate over offsetfields
-        #print("n_offsets: ",n_offsets)
-        for i in range(n_offsets):
-
-            # Two observation vectors for each offsetfield
-            # LOS and AZI
-            for j in range(2):
-                # Only for LOS
-                if j%2==0:
-                    phi = B_perp_list[i] * demfactor_list[i]
-                    G[i*2+j,n_cols] = phi
-
-        #print(n_offsets)
-        #print(i)
-        #print(G)
-        #print(G.shape)
-        #print(stop)
+        d = np.asarray(data_vec).reshape(n_offsets,2)
+        w = np.asarray(invCd).reshape(n_offsets,2)
+        wd = w * d
+        S = self.get_scalar_columns(n_offsets, [up_disp_column, topo_resid_column])
 
-        return G
-        # End of modifying G.
+        kron_index, scalar_index, num_params = self.normal_eq_column_layout(up_disp_column is not None, secular_variation, topo_resid_column is not None)
+        n_blocks = len(kron_index)//3
+        n_scalar = len(scalar_index)
+
+        KK = np.zeros(shape=(n_blocks,n_blocks,3,3))
+        KS = np.zeros(shape=(n_blocks,3,n_scalar))
+        Kd = np.zeros(shape=(n_blocks,3))
+
+        for chunk, coefs in self.iter_temporal_basis_chunks(offsetfields, secular_variation, chunk_size):
+            v = vecs[chunk]
+            wv = w[chunk][:,:,None] * v
+
+            # Weighted outer products of the (los, azi) vectors of each offset, (n_chunk, 3, 3)
+            V = np.einsum('ikc,ike->ice', wv, v)
+            KK += np.tensordot(coefs, coefs[:,:,None,None] * V[:,None,:,:], axes=(0,0))
+
+            Kd += np.matmul(coefs.T, np.einsum('ikc,ik->ic', v, wd[chunk]))
+
+            if n_scalar > 0:
+                KS += np.tensordot(coefs, np.einsum('ikc,ikj->icj', wv, S[chunk]), axes=(0,0))
+
+        GtWG = np.zeros(shape=(num_params,num_params))
+        GtWd = np.zeros(shape=(num_params,))
+
+        GtWG[np.ix_(kron_index,kron_index)] = np.transpose(KK, axes=(0,2,1,3)).reshape(n_blocks*3, n_blocks*3)
+        GtWd[kron_index] = Kd.reshape(n_blocks*3)
+
+        if n_scalar > 0:
+            KS = KS.reshape(n_blocks*3, n_scalar)
+            GtWG[np.ix_(kron_index,scalar_index)] = KS
+            GtWG[np.ix_(scalar_index,kron_index)] = KS.T
+            GtWG[np.ix_(scalar_index,scalar_index)] = np.einsum('ikj,ik,ikl->jl', S, w, S)
+            GtWd[scalar_index] = np.einsum('ikj,ik->j', S, wd)
+
+        dtWd = np.sum(wd * d)
 
-    def modify_G_for_secular_variation_set(self, point_set, G_set, offsetfields_set, data_info_set):
+        return (GtWG, GtWd, dtWd)
 
+    def assemble_normal_eq_border_set(self, point_set, offsetfields_set, data_vec_set, invCd_set, up_disp_column_set, secular_variation=False, topo_resid_column_set=None):
+
+        border_set = {}
         for point in point_set:
+            topo_resid_column = topo_resid_column_set[point] if topo_resid_column_set is not None else None
 
-            #if point != self.test_point:
-            #    continue
-            
-            G = G_set[point]
+            border_set[point] = self.assemble_normal_eq_border(offsetfields_set[point], data_vec_set[point], invCd_set[point], up_disp_column_set[point], secular_variation=secular_variation, topo_resid_column=topo_resid_column)
 
-            offsetfields = offsetfields_set[point]
+        return border_set
 
-            data_info = data_info_set[point]
+    def assemble_normal_eq_border(self, offsetfields, data_vec, invCd, up_disp_column, secular_variation=False, topo_resid_column=None, chunk_size=None):
 
-            G_set[point] = self.modify_G_for_secular_variation(point=point, G=G, offsetfields=offsetfields)
+        # Border of the normal equations for the tides_3 up column u
+        # Returns (F^T W u, u^T W u, u^T W d), F is G without the up column
+        border = self.assemble_normal_eq_border_batch(offsetfields, data_vec, invCd, np.asarray(up_disp_column)[None,:], secular_variation, topo_resid_column, chunk_size)
 
-        return G_set
+        if border is None:
+            return None
 
-    def modify_G_for_secular_variation(self, point, G, offsetfields):
+        FtWU, UtWU, UtWd = border
 
-        # Control the number of offsetfields
+        return (FtWU[:,0], UtWU[0], UtWd[0])
+
+    def assemble_normal_eq_border_batch(self, offsetfields, data_vec, invCd, up_disp_columns, secular_variation=False, topo_resid_column=None, chunk_size=None):
+
+        # Border for many up columns at once, up_disp_columns: (n_levels, n_offsets*2)
+        # Returns (F^T W U (num_params, n_levels), diag(U^T W U) (n_levels,), U^T W d (n_levels,))
         n_offsets = len(offsetfields)
+        if n_offsets == 0:
+            return None
 
-        # Important: accounting for the no offsetfield scenario
-        if n_offsets ==0:
-            G = np.zeros(shape=(1,1)) + np.nan
-            return G 
+        offsetfields = self.as_offsetfield_table(offsetfields)
+        vecs = offsetfields.vecs
 
-        # Find delta_td_2
-        delta_td_2 = np.zeros(shape=(n_offsets,))
-        
-        for i in range(n_offsets):
+        n_levels = up_disp_columns.shape[0]
 
-            delta_td = (offsetfields[i][1] - offsetfields[i][0]).days
+        d = np.asarray(data_vec).reshape(n_offsets,2)
+        w = np.asarray(invCd).reshape(n_offsets,2)
 
-            # t^2
-            delta_td_2[i] = delta_td**2
+        # (n_offsets, 2, n_levels)
+        U = np.transpose(up_disp_columns.reshape(n_levels,n_offsets,2), axes=(1,2,0))
+        wU = w[:,:,None] * U
 
-        ## Modify the G matrix
-        # Find the shape of G
-        n_rows, n_cols = G.shape
-        #print("n_rows, n_cols: ", n_rows, n_cols)
+        kron_index, scalar_index, num_params = self.normal_eq_column_layout(False, secular_variation, topo_resid_column is not None)
+        n_blocks = len(kron_index)//3
 
-        # Add three columns to model secular variation
-        G = np.hstack((G, np.zeros(shape=(n_rows,3))))
+        KU = np.zeros(shape=(n_blocks,3,n_levels))
+        for chunk, coefs in self.iter_temporal_basis_chunks(offsetfields, secular_variation, chunk_size):
+            KU += np.tensordot(coefs, np.einsum('ikc,ikl->icl', vecs[chunk], wU[chunk]), axes=(0,0))
 
-        # Iterate over offsetfields
-        for i in range(n_offsets):
+        FtWU = np.zeros(shape=(num_params,n_levels))
+        FtWU[kron_index] = KU.reshape(n_blocks*3,n_levels)
 
-            # Find the observation vector (los, azi) refering to "create_grid_set"
-            vecs = [offsetfields[i][2],offsetfields[i][3]]
+        if topo_resid_column is not None:
+            FtWU[scalar_index] = np.einsum('ik,ikl->l', np.asarray(topo_resid_column).reshape(n_offsets,2), wU)
 
-            # Two observation vectors, LOS and AZI
-            for j in range(2):
+        UtWU = np.einsum('ikl,ikl->l', wU, U)
+        UtWd = np.einsum('ikl,ik->l', wU, d)
 
-                # Get the vector (represent E,N,U)
-                vector = np.asarray(vecs[j])
+        return (FtWU, UtWU, UtWd)
 
-                # Secular variation component, the last three columns. 
-                # A vector multiplies a scalar. Put it in into G.
-                G[i*2+j,-3:] = vector * delta_td_2[i]
+    def predict_data_vec_set(self, point_set, offsetfields_set, model_vec_set, up_disp_column_set=None, secular_variation=False, topo_resid_column_set=None):
 
-        #print(n_offsets)
-        #print(i)
-        #print(G)
-        #print(G.shape)
-        #print(delta_td_2[0])
-        #print(G[0,:])
-        #print(stop)
+        # Prediction of the full model and of the secular velocity (E,N) only
+        data_vec_pred_set = {}
+        data_vec_pred_secular_set = {}
 
-        return G
-        # End of modifying G for secular variation.
+        for point in point_set:
+            model_vec = model_vec_set[point]
 
-    def modify_G_set(self, point_set, G_set, offsetfields_set, up_disp_set, grounding_level, gl_name):
+            if np.isnan(model_vec[0,0]):
+                data_vec_pred_set[point] = np.zeros(shape=(1,1)) + np.nan
+                data_vec_pred_secular_set[point] = np.zeros(shape=(1,1)) + np.nan
+                continue
 
-        # Extract the stack of up displacement from the tide model
-        # up_disp_set = self.get_up_disp_set(point_set, offsetfields_set)
+            up_disp_column = up_disp_column_set[point] if up_disp_column_set is not None else None
+            topo_resid_column = topo_resid_column_set[point] if topo_resid_column_set is not None else None
 
-        for point in point_set:
+            data_vec_pred_set[point], data_vec_pred_secular_set[point] = self.predict_data_vec(offsetfields_set[point], model_vec, up_disp_column=up_disp_column, secular_variation=secular_variation, topo_resid_column=topo_resid_column)
 
-            #if point == self.test_point:
-            #    print(point)
-            #    print(grounding_level[point])
+        return (data_vec_pred_set, data_vec_pred_secular_set)
+
+    def predict_data_vec_batch(self, offsetfields, model_vecs, up_disp_columns, secular_variation=False, topo_resid_column=None, chunk_size=None):
+
+        # Prediction of many models (n_levels, num_params) with their own up columns (n_levels, n_offsets*2)
+        # Returns (n_levels, n_offsets*2)
+        n_offsets = len(offsetfields)
+        offsetfields = self.as_offsetfield_table(offsetfields)
+        vecs = offsetfields.vecs
+
+        schema = self.get_parameter_schema(True, secular_variation, topo_resid_column is not None)
+        kron_index = schema.kron_index
+        n_blocks = len(kron_index)//3
+        n_levels = model_vecs.shape[0]
+
+        m_kron = model_vecs[:,kron_index].reshape(n_levels,n_blocks,3)
+
+        pred = np.zeros(shape=(n_offsets,2,n_levels))
+        for chunk, coefs in self.iter_temporal_basis_chunks(offsetfields, secular_variation, chunk_size):
+            pred[chunk] = np.einsum('ikc,ilc->ikl', vecs[chunk], np.einsum('ia,lac->ilc', coefs, m_kron))
+
+        pred = np.transpose(pred, axes=(2,0,1)).reshape(n_levels,n_offsets*2)
+
+        pred += model_vecs[:,schema.up_index][:,None] * up_disp_columns
+        if topo_resid_column is not None:
+            pred += model_vecs[:,schema.topo_resid_index][:,None] * np.asarray(topo_resid_column)[None,:]
+
+        return pred
+
+    def predict_data_vec(self, offsetfields, model_vec, up_disp_column=None, secular_variation=False, topo_resid_column=None, chunk_size=None):
+
+        # Streams over the offsets, same as G @ m
+        n_offsets = len(offsetfields)
+        offsetfields = self.as_offsetfield_table(offsetfields)
+        vecs = offsetfields.vecs
+
+        kron_index, scalar_index, num_params = self.normal_eq_column_layout(up_disp_column is not None, secular_variation, topo_resid_column is not None)
+        n_blocks = len(kron_index)//3
+
+        m = np.asarray(model_vec).reshape(num_params)
+        m_kron = m[kron_index].reshape(n_blocks,3)
+
+        pred = np.zeros(shape=(n_offsets,2))
+        pred_secular = np.zeros(shape=(n_offsets,2))
 
-            G = G_set[point]
-            tide_height_master_model, tide_height_slave_model = up_disp_set[point]
+        for chunk, coefs in self.iter_temporal_basis_chunks(offsetfields, secular_variation, chunk_size):
+            v = vecs[chunk]
+            pred[chunk] = np.einsum('ikc,ic->ik', v, np.matmul(coefs, m_kron))
 
-            # Should not do scaling here!
-            #velo_model = self.grid_set_velo[point]
-            #tide_height_master = tide_height_master_model * velo_model[2]
-            #tide_height_slave = tide_height_slave_model * velo_model[2]
+            # Secular velocity: E and N of the first block
+            pred_secular[chunk] = np.einsum('ikc,ic->ik', v[:,:,0:2], coefs[:,0:1] * m[None,0:2])
 
-            # No scaling
-            tide_height_master = tide_height_master_model
-            tide_height_slave = tide_height_slave_model
+        S = self.get_scalar_columns(n_offsets, [up_disp_column, topo_resid_column])
+        if len(scalar_index) > 0:
+            pred += np.matmul(S, m[scalar_index])
 
+        return (pred.reshape(n_offsets*2,1), pred_secular.reshape(n_offsets*2,1))
+
+    def get_topo_resid_column_set(self, point_set, offsetfields_set, data_info_set, demfactor_set):
+
+        topo_resid_column_set = {}
+        for point in point_set:
             offsetfields = offsetfields_set[point]
 
-            if gl_name == "external":
-                # Try to get the value from external file
-                try:
-                    given_grounding_level = grounding_level[point]['optimal_grounding_level']
-                    #print("optimal grounding level at this point is: ", given_grounding_level)
-                except:
-                    given_grounding_level = -10
+            if len(offsetfields) == 0:
+                topo_resid_column_set[point] = np.zeros(shape=(1,)) + np.nan
+                continue
+
+            demfactor_list, B_perp_list = self.get_topo_resid_factors(offsetfields, data_info_set[point], demfactor_set[point])
+
+            topo_resid_column_set[point] = self.get_topo_resid_column(offsetfields, demfactor_list, B_perp_list)
+
+        return topo_resid_column_set
 
-                if np.isnan(given_grounding_level):
-                    given_grounding_level = -10
+    def get_topo_resid_factors(self, offsetfields, data_info, demfactor_dict):
+
+        demfactor_list = [demfactor_dict[data_info[i]] for i in range(len(data_info))]
+
+        B_perp_list = []
+        #B_perp_list_2 = []
+        pairnames = self.as_offsetfield_table(offsetfields).pairnames()
+        for i, pairname in enumerate(pairnames):
+            sate, track_num = data_info[i]
+
+            B_perp_list.append(self.pair_baselines_dict[sate][sate, track_num, pairname])
             
-            elif gl_name == "optimal":
-                # Try to get the value from the obtained grounding level
-                if point in grounding_level:
-                    given_grounding_level_int = grounding_level[point]['optimal_grounding_level']
-                    given_grounding_level = given_grounding_level_int / (10**6)
+            ## Find the B_perp data
+            #if sate == 'csk':
+            #    track_name = 'track_' + str(track_num).zfill(3) + '_0'
+            #    B_perp_pklfile = os.path.join(self.csk_workdir, track_name, 'merged/interp_baselines', pairname+'.pkl')
+            #    with open(B_perp_pklfile, "rb") as f:
+            #        B_perp_data = pickle.load(f)
+            #    
+            #    B_perp_list_2.append(B_perp_data[0])
+
+            #elif sate == 's1':
+            #    track_name = 'track_' + str(track_num)
+            #    B_perp_pklfile = os.path.join(self.s1_workdir, track_name, 'merged/interp_baselines', pairname+'.pkl')
+            #    with open(B_perp_pklfile, "rb") as f:
+            #        B_perp_data = pickle.load(f)
+            #    
+            #    B_perp_list_2.append(B_perp_data[0])
+
+            #else:
+            #    raise ValueError()
+ 
+        #print('offsetfields: ', len(offsetfields))
+        #print('data_info: ', len(data_info))
+        #print('demfactor: ', len(demfactor_list))
+        #print('B_perp: ', len(B_perp_list))
+        #print(B_perp_list, B_perp_list_2)
 
-                    #if point == self.test_point:
-                    #    print('given_grounding_level: ', given_grounding_level)
+        return (demfactor_list, B_perp_list)
 
-                    # 2021.04.10: Manually clip value large than zero
-                    given_grounding_level = min(given_grounding_level, 0)
+    def get_topo_resid_column(self, offsetfields, demfactor_list, B_perp_list):
 
-                    # 2021.04.12: Manually set the value to be -10
-                    #given_grounding_level = -10
-                    print("In optimal mode: optimal grounding level at this point is: ", point, given_grounding_level)
-                    #print("AAA")
+        n_offsets = len(offsetfields)
 
-                # Not available, set it to -10
-                else:
-                    given_grounding_level = -10
-                    #print("BBB")
+        # Only for LOS (the first row of each offsetfield)
+        topo_column = np.zeros(shape=(n_offsets,2))
+        topo_column[:,0] = np.asarray(B_perp_list) * np.asarray(demfactor_list)
+
+        return topo_column.reshape(n_offsets*2)
+
+    def get_given_grounding_level(self, point, grounding_level, gl_name):
+
+        if gl_name == "external":
+            # Try to get the value from external file
+            try:
+                given_grounding_level = grounding_level[point]['optimal_grounding_level']
+                #print("optimal grounding level at this point is: ", given_grounding_level)
+            except:
+                given_grounding_level = -10
+
+            if np.isnan(given_grounding_level):
+                given_grounding_level = -10
+        
+        elif gl_name == "optimal":
+            # Try to get the value from the obtained grounding level
+            if point in grounding_level:
+                given_grounding_level_int = grounding_level[point]['optimal_grounding_level']
+                given_grounding_level = given_grounding_level_int / (10**6)
 
-                # If invalid, set it to be -10
-                if np.isnan(given_grounding_level):
-                    given_grounding_level = -10
+                #if point == self.test_point:
+                #    print('given_grounding_level: ', given_grounding_level)
 
-            elif gl_name == "float":
-                given_grounding_level = grounding_level
+                # 2021.04.10: Manually clip value large than zero
+                given_grounding_level = min(given_grounding_level, 0)
 
-            elif gl_name == "auto":
-                given_grounding_level = grounding_level[point]
+                # 2021.04.12: Manually set the value to be -10
+                #given_grounding_level = -10
+                print("In optimal mode: optimal grounding level at this point is: ", point, given_grounding_level)
+                #print("AAA")
 
+            # Not available, set it to -10
             else:
-                raise ValueError()
+                given_grounding_level = -10
+                #print("BBB")
 
-            # modify G
-            G_set[point] = self.modify_G(point=point, offsetfields=offsetfields, G=G, tide_height_master = tide_height_master, tide_height_slave = tide_height_slave, grounding_level = given_grounding_level)
+            # If invalid, set it to be -10
+            if np.isnan(given_grounding_level):
+                given_grounding_level = -10
 
-        return G_set
+        elif gl_name == "float":
+            given_grounding_level = grounding_level
 
-    #@jit(nopython=True)
-    def modify_G(self, point, offsetfields, G, tide_height_master, tide_height_slave, grounding_level):
+        elif gl_name == "auto":
+            given_grounding_level = grounding_level[point]
 
-        lon,lat = point
+        else:
+            raise ValueError()
 
-        # Control the number of offsetfields
-        n_offsets = len(offsetfields)
+        return given_grounding_level
 
-        # Important: accounting for the no offsetfield scenario
-        if n_offsets ==0:
-            G = np.zeros(shape=(1,1)) + np.nan
-            return G 
+    def get_up_disp_column_set(self, point_set, offsetfields_set, up_disp_set, grounding_level, gl_name):
 
-        ###############################################################
+        up_disp_column_set = {}
+        for point in point_set:
+            offsetfields = offsetfields_set[point]
+
+            if len(offsetfields) == 0:
+                up_disp_column_set[point] = np.zeros(shape=(1,)) + np.nan
+                continue
 
-        ## Modify the G matrix
-        # Find the shape of G
-        n_rows, n_cols = G.shape
+            tide_height_master, tide_height_slave = up_disp_set[point]
+            given_grounding_level = self.get_given_grounding_level(point, grounding_level, gl_name)
 
-        # Perform clipping
-        #print("shape: ",tide_height_master.shape)
-        #print("shape: ",grounding_level)
+            up_disp_column_set[point] = self.get_up_disp_column(offsetfields, tide_height_master, tide_height_slave, given_grounding_level)
 
-        tide_height_master[tide_height_master<grounding_level]=grounding_level
-        tide_height_slave[tide_height_slave<grounding_level]=grounding_level
+        return up_disp_column_set
+
+    def get_up_disp_column(self, offsetfields, tide_height_master, tide_height_slave, grounding_level):
+
+        n_offsets = len(offsetfields)
+
+        # Perform clipping
+        tide_height_master = np.maximum(tide_height_master, grounding_level)
+        tide_height_slave = np.maximum(tide_height_slave, grounding_level)
 
         # Find the vertical displacement
-        disp_up = (tide_height_slave - tide_height_master).reshape(n_offsets,1)
+        disp_up = np.asarray(tide_height_slave - tide_height_master).reshape(n_offsets)
 
-        # Find the vertical displacement vector
-        disp_up_vecs = np.hstack((np.zeros(shape=(n_offsets,2)), disp_up))
+        # Find the vertical displacement vector (0, 0, disp_up)
+        disp_up_vecs = np.zeros(shape=(n_offsets,3))
+        disp_up_vecs[:,2] = disp_up
 
-        # Add a column to model vertical displacement from external tide model
-        G = np.hstack((G, np.zeros(shape=(n_rows,1))))
+        # Find the projection onto the two observation vectors
+        vecs = self.as_offsetfield_table(offsetfields).vecs
+        up_disp_column = np.einsum('ikc,ic->ik', vecs, disp_up_vecs).reshape(n_offsets*2)
 
-        # Iterate over offsetfields
-        #print("n_offsets: ",n_offsets)
-        for i in range(n_offsets):
+        return up_disp_column
 
-            # Find the observation vector (los, azi) refering to "create_grid_set"
-            vecs = [offsetfields[i][2],offsetfields[i][3]]
+    def get_up_disp_columns(self, offsetfields, tide_height_master, tide_height_slave, grounding_levels):
 
-            # Find the vertical displacement vector
-            disp_up_vec = disp_up_vecs[i,:]
+        # Up column of many grounding levels at once, (n_levels, n_offsets*2)
+        n_offsets = len(offsetfields)
+        grounding_levels = np.asarray(grounding_levels).reshape(-1,1)
 
-            # Two observation vectors
-            for j in range(2):
-                # Get the vector (represent E,N,U)
-                vector = np.asarray(vecs[j])
+        # Perform clipping and find the vertical displacement, (n_levels, n_offsets)
+        disp_up = np.maximum(np.asarray(tide_height_slave).reshape(1,n_offsets), grounding_levels) - np.maximum(np.asarray(tide_height_master).reshape(1,n_offsets), grounding_levels)
 
-                # Find the projection
-                G[i*2+j,n_cols] = np.dot(vector, disp_up_vec)
+        # Projection of (0, 0, disp_up) onto the two observation vectors
+        vecs = self.as_offsetfield_table(offsetfields).vecs
+        up_disp_columns = disp_up[:,:,None] * vecs[None,:,:,2]
 
-        return G
-        # End of modifying G.
+        return up_disp_columns.reshape(len(grounding_levels), n_offsets*2)
 
     def model_vec_set_to_tide_vec_set(self, point_set, model_vec_set):
         tide_vec_set = {}
@@ -2263,6 +2682,8 @@ class fourdvel(basics):
             param_vec = param_vec + np.nan
             return param_vec
 
+        schema = self.get_parameter_schema()
+
         # Loop through the tides.
         for k in range(n_modeling_tides):
             
@@ -2277,10 +2698,10 @@ class fourdvel(basics):
                 ### return value is in velocity domain m/d
 
                 # cos term.
-                coe1 = model_vec[3+k*6+t]
+                coe1 = model_vec[schema.cos_index[k,t],0]
 
                 # sin term.
-                coe2 = model_vec[3+k*6+t+3]
+                coe2 = model_vec[schema.sin_index[k,t],0]
 
                 # omega
                 omega = 2*np.pi / tide_periods[tide_name]
@@ -2320,8 +2741,8 @@ class fourdvel(basics):
                 else:
                     raise Exception()
 
-                param_vec[3+k*6+t,0] = amp
-                param_vec[3+k*6+t+3,0] = phase
+                param_vec[schema.amp_index[k,t],0] = amp
+                param_vec[schema.phase_index[k,t],0] = phase
 
         return param_vec
 
@@ -2351,6 +2772,8 @@ class fourdvel(basics):
             param_vec = param_vec + np.nan
             return param_vec
 
+        schema = self.get_parameter_schema()
+
         # Tides.
         for k in range(n_modeling_tides):
             
@@ -2369,19 +2792,18 @@ class fourdvel(basics):
                 # sin term = amp/w*sin(phi)
 
                 # amp term.
-                #print(tide_vec.shape, 3+k*6+t)
-                amp = tide_vec[3+k*6+t]
+                amp = tide_vec[schema.amp_index[k,t],0]
 
                 # phase term.
-                phi = tide_vec[3+k*6+t+3]
+                phi = tide_vec[schema.phase_index[k,t],0]
 
                 omega = 2*np.pi / tide_periods[tide_name]
 
                 cos_term = -amp/omega * np.cos(phi)
                 sin_term = amp/omega * np.sin(phi)
 
-                param_vec[3+k*6+t,0] = cos_term
-                param_vec[3+k*6+t+3,0] = sin_term
+                param_vec[schema.cos_index[k,t],0] = cos_term
+                param_vec[schema.sin_index[k,t],0] = sin_term
         
         return param_vec
 
@@ -2406,34 +2828,40 @@ class fourdvel(basics):
         n_modeling_tides = self.n_modeling_tides
 
         num_params = len(tide_vec)
-        num_tide_params = n_modeling_tides*6
+        schema = self.get_parameter_schema()
 
         param_uq = np.zeros(shape=(num_params,1))
         secular_corr = (0, 0, 0)
 
+        # Compact posterior (variance only mode)
+        if isinstance(Cm_p, tuple):
+            variance, secular_cov = Cm_p
+
         # If Cm_p is invalid.
-        if np.isnan(Cm_p[0,0]):
+        elif np.isnan(Cm_p[0,0]):
             # Set param_uq to be np.nan
             param_uq = param_uq + np.nan
             secular_corr = (np.nan, np.nan, np.nan)
             return (param_uq, secular_corr)
 
-        # Now Cm_p is valid, so is tide_vec
+        else:
+            # Get the diagonal component
+            variance = np.diag(Cm_p)
+            secular_cov = (Cm_p[0,1], Cm_p[0,2], Cm_p[1,2])
 
-        # Get the diagonal component
-        variance = np.diag(Cm_p)
+        # Now Cm_p is valid, so is tide_vec
 
         # Get the secular params
-        param_uq[0:3,0] = variance[0:3]
+        param_uq[schema.secular_index,0] = variance[schema.secular_index]
 
         # Get the covariance of secular term
-        en_corr = Cm_p[0,1]/ np.sqrt(Cm_p[0,0] * Cm_p[1,1])
-        eu_corr = Cm_p[0,2]/ np.sqrt(Cm_p[0,0] * Cm_p[2,2])
-        nu_corr = Cm_p[1,2]/ np.sqrt(Cm_p[1,1] * Cm_p[2,2])
+        en_corr = secular_cov[0]/ np.sqrt(variance[0] * variance[1])
+        eu_corr = secular_cov[1]/ np.sqrt(variance[0] * variance[2])
+        nu_corr = secular_cov[2]/ np.sqrt(variance[1] * variance[2])
         secular_corr = (en_corr, eu_corr, nu_corr)
         
         # Set param_uq params 
-        param_uq[3 + num_tide_params:, 0] = variance[3 + num_tide_params:]
+        param_uq[schema.extra_index, 0] = variance[schema.extra_index]
 
         # Tide components. Do the conversion.
         for k in range(n_modeling_tides):
@@ -2441,16 +2869,16 @@ class fourdvel(basics):
             for t in range(3):
         
                 # cos term var.
-                error_c_t = variance[3+k*6+t]
+                error_c_t = variance[schema.cos_index[k,t]]
 
                 # sin term var.
-                error_s_t = variance[3+k*6+t+3]
+                error_s_t = variance[schema.sin_index[k,t]]
 
                 # Amplitude
-                amp = tide_vec[3+k*6+t][0]
+                amp = tide_vec[schema.amp_index[k,t]][0]
 
                 # Phase
-                phase = tide_vec[3+k*6+t+3][0]
+                phase = tide_vec[schema.phase_index[k,t]][0]
 
                 # Amplitude error
                 amp_error = (error_c_t * np.sin(phase)**2 - error_s_t * np.cos(phase)**2) / (np.sin(phase)**4 - np.cos(phase)**4)
@@ -2469,8 +2897,8 @@ class fourdvel(basics):
                 #    print((np.sin(phase)**4 - np.cos(phase)**4))
                 #    print(stop)
 
-                param_uq[3+k*6+t,0] = amp_error
-                param_uq[3+k*6+t+3,0] = phase_error
+                param_uq[schema.amp_index[k,t],0] = amp_error
+                param_uq[schema.phase_index[k,t],0] = phase_error
 
         # From variance to standard deviation (Important!).
         #param_uq = np.sqrt(param_uq)
@@ -2512,49 +2940,55 @@ class fourdvel(basics):
     def real_data_uncertainty(self,data_vec, sigma):
 
         # Range the azimuth are different.
+        # Cd is diagonal, so only keep the diagonal of invCd as a weight vector
         n_data = data_vec.shape[0]
+        n_offsets = n_data//2
 
-        Cd = np.zeros(shape = (n_data,n_data))
-        invCd = np.zeros(shape = (n_data,n_data))
+        invCd = np.zeros(shape = (n_data,))
 
-        for i in range(n_data//2):
+        if n_offsets > 0:
+            sigma = np.asarray(sigma[:n_offsets], dtype=np.float64)
             # Range.
-            Cd[2*i,2*i] = sigma[i][0]**2
+            invCd[0:2*n_offsets:2] = 1/np.square(sigma[:,0])
             # Azimuth.
-            Cd[2*i+1,2*i+1] = sigma[i][1]**2
-
-            invCd[2*i,2*i] = 1/Cd[2*i,2*i]
-            invCd[2*i+1,2*i+1] = 1/Cd[2*i+1,2*i+1]
+            invCd[1:2*n_offsets:2] = 1/np.square(sigma[:,1])
 
         return invCd
 
     def model_prior_set(self, point_set):
 
+        # The prior is the same for all points, they share one matrix
+        invCm = self.model_prior()
+
         invCm_set = {}
         for point in point_set:
-            invCm_set[point] = self.model_prior()
+            invCm_set[point] = invCm
 
         return invCm_set
 
     def model_prior(self):
 
-        n_modeling_tides = self.n_modeling_tides
-        modeling_tides = self.modeling_tides
+        # Dense form of the diagonal prior
+        return np.diag(self.model_prior_precision())
 
-        # Find the number of parameters
-        num_params = 3 + n_modeling_tides*6
+    def model_prior_precision(self):
 
-        # For tides_3, add one param for up_disp scale
-        if self.task_name == "tides_3":
-            num_params +=1
+        # Diagonal of the prior precision (invCm), cached for the run
+        # Depends on the parameter schema and the prior options only
+        schema = self.get_parameter_schema()
 
-        if self.est_secular_variation:
-            num_params +=3
+        horizontal = self.horizontal_prior
+        no_secular_up = getattr(self, 'no_secular_up', False)
+        up_short_period = getattr(self, 'up_short_period', False)
+        horizontal_long_period = getattr(self, 'horizontal_long_period', False)
+
+        if not hasattr(self, 'model_prior_cache'):
+            self.model_prior_cache = {}
+
+        key = (tuple(schema.modeling_tides), schema.up_disp, schema.secular_variation, schema.topo_resid, horizontal, no_secular_up, up_short_period, horizontal_long_period)
+        if key in self.model_prior_cache:
+            return self.model_prior_cache[key]
 
-        # If est topo resid (the last one)
-        if self.est_topo_resid:
-            num_params +=1
-        
         # Set the model priors
         # Sigmas of model parameters.
         inf_permiss = 0
@@ -2562,52 +2996,36 @@ class fourdvel(basics):
         #inf_restrict = 10**8
 
         # Default is the value for permiss 
-        inv_sigma = np.zeros(shape=(num_params, num_params))
-
-        horizontal = self.horizontal_prior
+        inv_sigma = np.zeros(shape=(schema.num_params,))
 
         # Secular velocity.
-        if horizontal == True:
+        if horizontal == True or no_secular_up == True:
             # Remove upper component.
-            inv_sigma[2,2] = inf_restrict
+            inv_sigma[schema.secular_index[2]] = inf_restrict
 
-        if hasattr(self,'no_secular_up'):
-            if self.no_secular_up == True:
-                inv_sigma[2,2] = inf_restrict
+        # Tides.
+        for k, tide_name in enumerate(schema.modeling_tides):
 
-        if hasattr(self,'up_short_period'):
-            up_short_period = self.up_short_period
-        else:
-            up_short_period = False
+            # only horizontal motion 
+            if horizontal == True:
+                inv_sigma[schema.cos_index[k,2]] = inf_restrict
+                inv_sigma[schema.sin_index[k,2]] = inf_restrict
 
-        if hasattr(self,'horizontal_long_period'):
-            horizontal_long_period = self.horizontal_long_period
-        else:
-            horizontal_long_period = False
+            # Control the up on be only short period
+            if not tide_name in self.tide_short_period_members and up_short_period:
+                inv_sigma[schema.cos_index[k,2]] = inf_restrict
+                inv_sigma[schema.sin_index[k,2]] = inf_restrict
 
-        # Tides.
-        for i in range(n_modeling_tides):
-            tide_name = modeling_tides[i]
-            #print(tide_name)
-            for j in range(6):
-                k = 3 + i*6 + j
-               
-                # only horizontal motion 
-                if horizontal==True and (j==2 or j==5):
-                    inv_sigma[k,k] = inf_restrict
-
-                # Control the up on be only short period
-                if not tide_name in self.tide_short_period_members and up_short_period and (j==2 or j==5):
-                    inv_sigma[k,k] = inf_restrict
-                    #print(tide_name, j)
-
-                # Control the horizontal to be only long period
-                if not tide_name in self.tide_long_period_members and horizontal_long_period and (j==0 or j==1 or j==3 or j==4):
-                    inv_sigma[k,k] = inf_restrict
- 
-        invCm = np.square(inv_sigma)
+            # Control the horizontal to be only long period
+            if not tide_name in self.tide_long_period_members and horizontal_long_period:
+                inv_sigma[schema.cos_index[k,0:2]] = inf_restrict
+                inv_sigma[schema.sin_index[k,0:2]] = inf_restrict
+
+        precision = np.square(inv_sigma)
+        precision.flags.writeable = False
+        self.model_prior_cache[key] = precision
 
-        return invCm
+        return precision
 
     #@jit(nopython=True)
     def model_posterior_set(self, point_set, linear_design_mat_set, data_prior_set, model_prior_set, test_point=None):
@@ -2636,17 +3054,11 @@ class fourdvel(basics):
         assert G.shape[0] == invCd.shape[0], print(G.shape, invCd.shape, 'G and invCd shapes do not match')
         assert G.shape[1] == invCm.shape[0], print(G.shape, invCm.shape, 'G and invCm shapes do not match')
 
-        invCm_p = np.matmul(np.matmul(np.transpose(G), invCd),G) + invCm
+        # invCd is the diagonal weight vector
+        invCm_p = np.matmul(np.transpose(G * invCd[:,None]), G) + invCm
 
-        # If G is singular.
-        if np.linalg.cond(invCm_p) < 1/sys.float_info.epsilon:
-            # This step can still have problem in rare case
-            try:
-                Cm_p = np.linalg.pinv(invCm_p)
-            except:
-                Cm_p = np.zeros(shape=invCm_p.shape) + np.nan
-        else:
-            Cm_p = np.zeros(shape=invCm_p.shape) + np.nan
+        # Singular matrix comes back with nan
+        Cm_p = self.invert_normal_matrix_stack(invCm_p[None,:,:])[0]
 
         return Cm_p
 
@@ -2704,10 +3116,36 @@ class fourdvel(basics):
     def extract_up_scale(self, model_vec):
         # up_scale is at the first index after secular and tidal params
         if not np.isnan(model_vec[0,0]):
-            return model_vec[3 + len(self.modeling_tides) * 6, 0]
+            return model_vec[self.get_parameter_schema().up_index, 0]
         else:
             return np.nan
 
+    def export_empty_point_set(self, point_set, tide_vec_set, tide_vec_uq_set, resid_of_secular_set, resid_of_tides_set, residual_analysis_set, others_set):
+
+        # Same results as a point without data going through the linear inversion, in bulk
+        nan_resid = (np.nan,np.nan,np.nan,np.nan)
+
+        for point in point_set:
+            tide_vec_set[point] = np.zeros((1,1)) + np.nan
+            tide_vec_uq_set[point] = np.zeros((1,1)) + np.nan
+            resid_of_secular_set[point] = nan_resid
+            resid_of_tides_set[point] = nan_resid
+
+            if not (self.single_point_mode and point!=self.test_point):
+                residual_analysis_set[point] = None
+
+            others_set[point]['lowest_tide_height'] = None
+            others_set[point]['secular_corr'] = (np.nan, np.nan, np.nan)
+
+            if self.task_name == "tides_3":
+                others_set[point]["true_optimal_grounding_level"] = self.simulation_grounding_level
+                others_set[point]["true_up_scale"] = self.grid_set_velo[point][2]
+                others_set[point]["optimal_grounding_level"] = np.nan
+                others_set[point]["up_scale"] = np.nan
+                others_set[point]["grounding_level_credible_interval"] = (np.nan, np.nan)
+
+        return 0
+
     def export_to_others_set_secular_corr(self, point_set, secular_corr_set, others_set):
         for point in point_set:
             others_set[point]['secular_corr'] = secular_corr_set[point]
@@ -2722,33 +3160,31 @@ class fourdvel(basics):
         else:
             raise ValueError()
 
+        grounding_levels_int_set = {}
+        up_scale_set = {}
         for point in point_set:
             if mode == 'const':
-                grounding_level_point = grounding_level
+                grounding_levels_int_set[point] = [grounding_level]
             elif mode == 'point':
-                grounding_level_point = grounding_level[point]
+                grounding_levels_int_set[point] = [grounding_level[point]]
             else:
                 raise ValueError()
 
-            # up scale
-            if not 'grounding_level_up_scale' in others_set[point].keys():
-                others_set[point]['grounding_level_up_scale'] = {}
+            up_scale_set[point] = [self.extract_up_scale(model_vec_set[point])]
 
-            others_set[point]['grounding_level_up_scale'][grounding_level_point] = self.extract_up_scale(model_vec_set[point])
+        # model likelihood, up scale and residual
+        enum_cube = self.get_enum_result_cube(point_set, others_set)
+        enum_cube.append(point_set, grounding_levels_int_set, {point: [model_likelihood_set[point]] for point in point_set}, up_scale_set, {point: [resid_set[point]] for point in point_set})
 
-            # model likelihood
-            if not 'grounding_level_model_likelihood' in others_set[point].keys():
-                others_set[point]['grounding_level_model_likelihood'] = {}
+        return 0
 
-            others_set[point]['grounding_level_model_likelihood'][grounding_level_point] = model_likelihood_set[point]
+    def get_enum_result_cube(self, point_set, others_set):
 
-            # residual
-            if not 'grounding_level_resids' in others_set[point].keys():
-                others_set[point]['grounding_level_resids'] = {}
+        # The enumeration results of the tile are kept in others_set['grounding_level_enum']
+        if not 'grounding_level_enum' in others_set:
+            others_set['grounding_level_enum'] = enum_result_cube(point_set)
 
-            others_set[point]['grounding_level_resids'][grounding_level_point] = resid_set[point]
-
-        return 0
+        return others_set['grounding_level_enum']
 
     def calc_hpdi(self, x, y, alpha=0.9):
 
@@ -2861,9 +3297,92 @@ class fourdvel(basics):
 
         return (x[left], x[right])
 
+    def grounding_level_credible_interval(self, grounding_levels, likelihoods):
+
+        # grounding_levels are integers (gl * 10**6), sorted
+        # Remove the non-grounding case (-10m) from the valid enumeration
+        grounding_levels_proc = []
+        likelihoods_proc = []
+
+        for i, grounding_level_int in enumerate(grounding_levels):
+            # Remove -10
+            if grounding_level_int != -10 * 10**6:
+                grounding_levels_proc.append(grounding_levels[i])
+                likelihoods_proc.append(likelihoods[i])
+
+        grounding_levels_proc = np.asarray(grounding_levels_proc)
+        likelihoods_proc = np.asarray(likelihoods_proc)
+
+        #print(grounding_levels)
+        #print(likelihoods)
+
+        #print(grounding_levels_proc)
+        #print(likelihoods_proc)
+        #print(stop)
+
+        # calculate credible interval
+        if len(grounding_levels_proc)>=2:
+            # Need to consider the case if the enumeration is not even
+            # Do interpolation on [-4,0] for Rutford, [-3, 0] for Evans
+            # spacing = 0.01
+            interp_fun = interp1d(grounding_levels_proc, likelihoods_proc, kind='linear')
+   
+            # interpolation every 1cm (10**(-2))
+            #gls_interp = np.arange(min(grounding_levels),max(grounding_levels)+1e-6, 10**(-2) * 10**6)
+            # give up the last point, to make sure gls_interp is within grounding_levels
+
+            gls_interp_min = min(grounding_levels_proc)
+            gls_interp_max = max(grounding_levels_proc)
+
+            gls_interp = np.arange(gls_interp_min, gls_interp_max, 10**(-2) * 10**6)
+
+            try:
+                likelihoods_interp = interp_fun(gls_interp)
+            except:
+                print(grounding_levels)
+                print(likelihoods)
+                print(gls_interp)
+                raise Exception("Interpolation error")
+    
+            ## Get the probability ##
+            # normalize the likelihood in log space
+            # Sum up the denominator
+            likelihoods_interp = likelihoods_interp - np.nanmin(likelihoods_interp)
+            prob_sum = np.nansum(np.exp(-likelihoods_interp))
+            gl_probs_interp = np.exp(-likelihoods_interp) / prob_sum
+    
+            # Calculate credible interval
+            #if point == self.test_point:
+            #    start_time = time.time()
+            #    gl_ci = self.calc_hpdi(gls_interp/10**6, gl_probs_interp)
+            #    elapsed_time = time.time() - start_time
+            #    print("Elapased time: ", elapsed_time)
+            #    print(gl_ci)
+            #    print(stop)
+            #    start_time = time.time()
+            #    gl_ci_2 = self.calc_hpdi_v2(gls_interp/10**6, gl_probs_interp)
+            #    elapsed_time = time.time() - start_time
+            #    print("Elapased time: ", elapsed_time)
+            #    print(gl_ci_2)
+
+            #print(gls_interp / 10**6)
+            #print(gl_probs_interp)
+ 
+            gl_ci_2 = self.calc_hpdi_v2(gls_interp/10**6, gl_probs_interp)
+
+        else:
+            gls_interp = grounding_levels
+            likelihoods_interp = likelihoods
+            gl_probs_interp = np.ones(shape=(1,))
+            gl_ci_2 = (np.nan, np.nan)
+        
+        return (gls_interp, likelihoods_interp, gl_probs_interp, gl_ci_2)
+
     def select_optimal_grounding_level(self, point_set, grid_set_velo, others_set, gl_specified_range = None):
 
         select_mode = "likelihood"
+
+        enum_cube = self.get_enum_result_cube(point_set, others_set)
  
         for point in point_set:
 
@@ -2886,7 +3405,8 @@ class fourdvel(basics):
             if select_mode == "resid":
                 min_value = float("inf")
 
-                for grounding_level_int, resids in sorted(others_set[point]['grounding_level_resids'].items()):
+                for grounding_level_int in enum_cube.completed_levels(point):
+                    resids = enum_cube.value(point, grounding_level_int, name='resids')
 
                     # Do selection based on the full root mean squre error
                     # range_rmse can be np.nan (np.nan < number is False)
@@ -2904,103 +3424,25 @@ class fourdvel(basics):
             elif select_mode == "likelihood":
                 min_value = float("inf")
 
-                grounding_levels = []
-                likelihoods = []
+                # Sorted from small to large gl
+                grounding_levels, likelihoods, up_scales = enum_cube.point_levels(point)
 
-                # Go from small to large gl to find grounding_levels and likelihoods
-                for grounding_level_int, likelihood in sorted(others_set[point]['grounding_level_model_likelihood'].items()):
-                    #print(grounding_level_int, likelihood)
+                # Go from small to large gl to find the optimal
+                for i, grounding_level_int in enumerate(grounding_levels.tolist()):
+                    #print(grounding_level_int, likelihoods[i])
 
-                    if likelihood < min_value:
-                        min_value = likelihood
+                    if likelihoods[i] < min_value:
+                        min_value = likelihoods[i]
 
                         # Save the optimal grounding level
                         others_set[point]["optimal_grounding_level"]  = grounding_level_int
 
                         # Save the corresponding up_scale
-                        others_set[point]["up_scale"] = others_set[point]['grounding_level_up_scale'][grounding_level_int]
-
-                    grounding_levels.append(grounding_level_int)
-                    likelihoods.append(likelihood)
-
-                grounding_levels = np.asarray(grounding_levels)
-                likelihoods = np.asarray(likelihoods)
-
-                # Remove the non-grounding case (-10m) from the valid enumeration
-                grounding_levels_proc = []
-                likelihoods_proc = []
-
-                for i, grounding_level_int in enumerate(grounding_levels):
-                    # Remove -10
-                    if grounding_level_int != -10 * 10**6:
-                        grounding_levels_proc.append(grounding_levels[i])
-                        likelihoods_proc.append(likelihoods[i])
-
-                grounding_levels_proc = np.asarray(grounding_levels_proc)
-                likelihoods_proc = np.asarray(likelihoods_proc)
-
-                #print(grounding_levels)
-                #print(likelihoods)
-
-                #print(grounding_levels_proc)
-                #print(likelihoods_proc)
-                #print(stop)
+                        others_set[point]["up_scale"] = up_scales[i]
 
                 # calculate credible interval
-                if len(grounding_levels_proc)>=2:
-                    # Need to consider the case if the enumeration is not even
-                    # Do interpolation on [-4,0] for Rutford, [-3, 0] for Evans
-                    # spacing = 0.01
-                    interp_fun = interp1d(grounding_levels_proc, likelihoods_proc, kind='linear')
-   
-                    # interpolation every 1cm (10**(-2))
-                    #gls_interp = np.arange(min(grounding_levels),max(grounding_levels)+1e-6, 10**(-2) * 10**6)
-                    # give up the last point, to make sure gls_interp is within grounding_levels
-
-                    gls_interp_min = min(grounding_levels_proc)
-                    gls_interp_max = max(grounding_levels_proc)
-
-                    gls_interp = np.arange(gls_interp_min, gls_interp_max, 10**(-2) * 10**6)
-
-                    try:
-                        likelihoods_interp = interp_fun(gls_interp)
-                    except:
-                        print(grounding_levels)
-                        print(likelihoods)
-                        print(gls_interp)
-                        raise Exception("Interpolation error")
-    
-                    ## Get the probability ##
-                    # normalize the likelihood in log space
-                    # Sum up the denominator
-                    likelihoods_interp = likelihoods_interp - np.nanmin(likelihoods_interp)
-                    prob_sum = np.nansum(np.exp(-likelihoods_interp))
-                    gl_probs_interp = np.exp(-likelihoods_interp) / prob_sum
-    
-                    # Calculate credible interval
-                    #if point == self.test_point:
-                    #    start_time = time.time()
-                    #    gl_ci = self.calc_hpdi(gls_interp/10**6, gl_probs_interp)
-                    #    elapsed_time = time.time() - start_time
-                    #    print("Elapased time: ", elapsed_time)
-                    #    print(gl_ci)
-                    #    print(stop)
-                    #    start_time = time.time()
-                    #    gl_ci_2 = self.calc_hpdi_v2(gls_interp/10**6, gl_probs_interp)
-                    #    elapsed_time = time.time() - start_time
-                    #    print("Elapased time: ", elapsed_time)
-                    #    print(gl_ci_2)
-
-                    #print(gls_interp / 10**6)
-                    #print(gl_probs_interp)
- 
-                    gl_ci_2 = self.calc_hpdi_v2(gls_interp/10**6, gl_probs_interp)
+                gls_interp, likelihoods_interp, gl_probs_interp, gl_ci_2 = self.grounding_level_credible_interval(grounding_levels, likelihoods)
 
-                else:
-                    gls_interp = grounding_levels
-                    gl_probs_interp = np.ones(shape=(1,))
-                    gl_ci_2 = (np.nan, np.nan)
-                
                 others_set[point]["grounding_level_credible_interval"] = gl_ci_2
 
                 # For test point, save and show the result
@@ -3035,6 +3477,29 @@ class fourdvel(basics):
 
         return 0
 
+    def select_optimal_grounding_level_vectorized(self, point_set, grid_set_velo, others_set):
+
+        # Same as select_optimal_grounding_level with the likelihood mode, for all points at once
+        # The credible interval is the shortest interval (calc_hpdi), not the expansion from the peak (calc_hpdi_v2)
+        if self.proj in ['Rutford', 'Evans']:
+            alpha = 0.68
+        else:
+            raise ValueError()
+
+        for point in point_set:
+            others_set[point]["true_optimal_grounding_level"] = self.simulation_grounding_level
+            others_set[point]["true_up_scale"] = grid_set_velo[point][2]
+
+        if len(point_set) == 0:
+            return 0
+
+        selection = grounding_level_selection(alpha=alpha)
+        grounding_levels_int, likelihoods, up_scales = self.get_enum_result_cube(point_set, others_set).arrays(point_set)
+        result = selection.select(grounding_levels_int, likelihoods, up_scales)
+        selection.export_to_others_set(point_set, result, others_set, test_point=self.test_point)
+
+        return 0
+
     # Simple version.
     def param_estimation_simple(self, design_mat, data):
 
@@ -3077,7 +3542,7 @@ class fourdvel(basics):
             model_vec = np.zeros(shape=(1,1)) + np.nan
             return model_vec
 
-        dd = np.matmul(np.matmul(np.transpose(G),invCd),d)
+        dd = np.matmul(np.transpose(G * invCd[:,None]), d)
 
         model_p = np.matmul(Cm_p, dd)
 
@@ -3085,8 +3550,966 @@ class fourdvel(basics):
 
         return model_vec
 
+    # Bayesian inversion of a whole tile at once (batched).
+    # Same result as model_posterior_set + param_estimation_set.
+    # model_prior is the diagonal of invCm (from model_prior_precision), shared by all points.
+    def model_posterior_param_estimation_batch_set(self, point_set, linear_design_mat_set, data_vec_set, data_prior_set, model_prior, batch_size=256, variance_only=False):
+
+        Cm_p_set = {}
+        model_vec_set = {}
+
+        # Group the valid points by the number of parameters
+        groups = {}
+        for point in point_set:
+            G = linear_design_mat_set[point]
+
+            if np.isnan(G[0,0]):
+                Cm_p_set[point] = np.zeros(shape=(1,1)) + np.nan
+                model_vec_set[point] = np.zeros(shape=(1,1)) + np.nan
+            else:
+                num_params = G.shape[1]
+                if not num_params in groups:
+                    groups[num_params] = []
+                groups[num_params].append(point)
+
+        for num_params, group_points in groups.items():
+            for i_start in range(0, len(group_points), batch_size):
+                batch_points = group_points[i_start : i_start + batch_size]
+                self.model_posterior_param_estimation_batch(batch_points, linear_design_mat_set, data_vec_set, data_prior_set, model_prior, Cm_p_set, model_vec_set, variance_only)
+
+        return (Cm_p_set, model_vec_set)
+
+    def model_posterior_param_estimation_batch(self, batch_points, linear_design_mat_set, data_vec_set, data_prior_set, model_prior, Cm_p_set, model_vec_set, variance_only=False):
+
+        n_points = len(batch_points)
+        num_params = linear_design_mat_set[batch_points[0]].shape[1]
+        n_data_max = max([linear_design_mat_set[point].shape[0] for point in batch_points])
+
+        assert num_params == len(model_prior), print(num_params, len(model_prior), 'G and invCm shapes do not match')
+
+        # Padded stacks. Padded rows have zero weight, so they do not contribute
+        G_stack = np.zeros(shape=(n_points, n_data_max, num_params))
+        w_stack = np.zeros(shape=(n_points, n_data_max))
+        d_stack = np.zeros(shape=(n_points, n_data_max))
+
+        for i, point in enumerate(batch_points):
+            G = linear_design_mat_set[point]
+            invCd = data_prior_set[point]
+
+            assert G.shape[0] == invCd.shape[0], print(G.shape, invCd.shape, 'G and invCd shapes do not match')
+
+            n_data = G.shape[0]
+            G_stack[i,:n_data,:] = G
+            w_stack[i,:n_data] = invCd
+            d_stack[i,:n_data] = data_vec_set[point][:,0]
+
+        # Normal equations, the prior is added to the diagonal of all points
+        GtW_stack = np.transpose(G_stack * w_stack[:,:,None], axes=(0,2,1))
+        invCm_p_stack = np.matmul(GtW_stack, G_stack)
+        self.add_model_prior_to_stack(invCm_p_stack, model_prior)
+        dd_stack = np.matmul(GtW_stack, d_stack[:,:,None])
+
+        self.solve_normal_eq_stack(batch_points, invCm_p_stack, dd_stack, Cm_p_set, model_vec_set, variance_only)
+
+        return 0
+
+    # Bayesian inversion from normal equations (G^T W G, G^T W d), batched over the tile.
+    # model_prior is the diagonal of invCm, shared by all points.
+    def solve_normal_eq_set(self, point_set, normal_eq_set, model_prior, batch_size=256, variance_only=False):
+
+        Cm_p_set = {}
+        model_vec_set = {}
+
+        # Group the valid points by the number of parameters
+        groups = {}
+        for point in point_set:
+            normal_eq = normal_eq_set[point]
+
+            if normal_eq is None:
+                Cm_p_set[point] = np.zeros(shape=(1,1)) + np.nan
+                model_vec_set[point] = np.zeros(shape=(1,1)) + np.nan
+            else:
+                num_params = normal_eq[0].shape[0]
+                if not num_params in groups:
+                    groups[num_params] = []
+                groups[num_params].append(point)
+
+        for num_params, group_points in groups.items():
+            for i_start in range(0, len(group_points), batch_size):
+                batch_points = group_points[i_start : i_start + batch_size]
+
+                invCm_p_stack = np.asarray([normal_eq_set[point][0] for point in batch_points])
+                self.add_model_prior_to_stack(invCm_p_stack, model_prior)
+                dd_stack = np.asarray([normal_eq_set[point][1] for point in batch_points]).reshape(len(batch_points), num_params, 1)
+
+                self.solve_normal_eq_stack(batch_points, invCm_p_stack, dd_stack, Cm_p_set, model_vec_set, variance_only)
+
+        return (Cm_p_set, model_vec_set)
+
+    def add_model_prior_to_stack(self, invCm_p_stack, model_prior):
+
+        # In place, model_prior is the diagonal of invCm
+        num_params = invCm_p_stack.shape[1]
+        assert num_params == len(model_prior), print(num_params, len(model_prior), 'normal matrix and invCm shapes do not match')
+
+        diag_index = np.arange(num_params)
+        invCm_p_stack[:, diag_index, diag_index] += model_prior
+
+        return 0
+
+    # variance_only: Cm_p_set has the compact posterior (see compact_model_posterior)
+    def solve_normal_eq_stack(self, batch_points, invCm_p_stack, dd_stack, Cm_p_set, model_vec_set, variance_only=False):
+
+        # Keep the posterior in factored form
+        if variance_only and self.linear_solver == 'cholesky':
+            return self.solve_normal_eq_stack_factored(batch_points, invCm_p_stack, dd_stack, Cm_p_set, model_vec_set)
+
+        Cm_p_stack = self.invert_normal_matrix_stack(invCm_p_stack)
+
+        for i, point in enumerate(batch_points):
+            Cm_p = Cm_p_stack[i]
+
+            if np.isnan(Cm_p[0,0]):
+                model_vec_set[point] = np.zeros(shape=(1,1)) + np.nan
+            else:
+                model_vec_set[point] = np.matmul(Cm_p, dd_stack[i])
+
+            Cm_p_set[point] = self.compact_model_posterior(Cm_p) if variance_only else Cm_p
+
+        return 0
+
+    def solve_normal_eq_stack_factored(self, batch_points, invCm_p_stack, dd_stack, Cm_p_set, model_vec_set):
+
+        # Cm_p = inv(L)^T inv(L) is not formed.
+        # Only the variances and the secular covariances are taken from the columns of inv(L)
+        invL_stack, chol_ok = self.factor_normal_matrix_cholesky(invCm_p_stack)
+        self.count_linear_solver_path('cholesky', np.sum(chol_ok))
+
+        # m = inv(L)^T (inv(L) dd)
+        model_vec_stack = np.matmul(np.transpose(invL_stack, axes=(0,2,1)), np.matmul(invL_stack, dd_stack))
+
+        variance_stack = np.sum(np.square(invL_stack), axis=1)
+        secular_cov_stack = np.stack([np.sum(invL_stack[:,:,i] * invL_stack[:,:,j], axis=1) for i, j in [(0,1), (0,2), (1,2)]], axis=1)
+
+        for i, point in enumerate(batch_points):
+            if chol_ok[i]:
+                Cm_p_set[point] = (variance_stack[i], secular_cov_stack[i])
+                model_vec_set[point] = model_vec_stack[i]
+            else:
+                # SVD path
+                Cm_p = self.invert_normal_matrix_svd(invCm_p_stack[i])
+                Cm_p_set[point] = self.compact_model_posterior(Cm_p)
+
+                if np.isnan(Cm_p[0,0]):
+                    model_vec_set[point] = np.zeros(shape=(1,1)) + np.nan
+                else:
+                    model_vec_set[point] = np.matmul(Cm_p, dd_stack[i])
+
+        return 0
+
+    def compact_model_posterior(self, Cm_p):
+
+        # What model_posterior_to_uncertainty needs:
+        # (variance of all params, covariance of secular (E,N), (E,U), (N,U))
+        # Invalid Cm_p is kept as it is
+        if np.isnan(Cm_p[0,0]):
+            return Cm_p
+
+        return (np.diag(Cm_p).copy(), np.asarray([Cm_p[0,1], Cm_p[0,2], Cm_p[1,2]]))
+
+    ## Linear solver backends ##
+    # linear_solver: cholesky (default), qr or svd.
+    # cholesky and qr estimate the condition number from the diagonal of the factor (a lower bound of cond),
+    # points that fail or are close to singular go to the SVD path, which does the exact check.
+    def invert_normal_matrix_stack(self, invCm_p_stack):
+
+        linear_solver = self.linear_solver
+        n_points = invCm_p_stack.shape[0]
+
+        if linear_solver == 'cholesky':
+            Cm_p_stack, solver_ok = self.invert_normal_matrix_cholesky(invCm_p_stack)
+
+        elif linear_solver == 'qr':
+            Cm_p_stack, solver_ok = self.invert_normal_matrix_qr(invCm_p_stack)
+
+        elif linear_solver == 'svd':
+            Cm_p_stack = np.zeros(shape=invCm_p_stack.shape)
+            solver_ok = np.zeros(n_points, dtype=bool)
+
+        else:
+            raise ValueError("Unknown linear_solver: " + str(linear_solver))
+
+        self.count_linear_solver_path(linear_solver, np.sum(solver_ok))
+
+        # SVD path
+        for i in np.nonzero(~solver_ok)[0]:
+            Cm_p_stack[i] = self.invert_normal_matrix_svd(invCm_p_stack[i])
+
+        return Cm_p_stack
+
+    def invert_normal_matrix_cholesky(self, invCm_p_stack):
+
+        invL_stack, chol_ok = self.factor_normal_matrix_cholesky(invCm_p_stack)
+
+        # Cm_p = inv(L)^T inv(L)
+        Cm_p_stack = np.matmul(np.transpose(invL_stack, axes=(0,2,1)), invL_stack)
+
+        return (Cm_p_stack, chol_ok)
+
+    def factor_normal_matrix_cholesky(self, invCm_p_stack):
+
+        # Returns inv(L) of invCm_p = L L^T
+        n_points, num_params = invCm_p_stack.shape[0:2]
+
+        # Stacked Cholesky. If one point fails, find it by doing them one by one
+        chol_ok = np.ones(n_points, dtype=bool)
+        try:
+            L_stack = np.linalg.cholesky(invCm_p_stack)
+        except np.linalg.LinAlgError:
+            L_stack = np.zeros(shape=invCm_p_stack.shape)
+            for i in range(n_points):
+                try:
+                    L_stack[i] = np.linalg.cholesky(invCm_p_stack[i])
+                except np.linalg.LinAlgError:
+                    chol_ok[i] = False
+                    L_stack[i] = np.eye(num_params)
+
+        # cond(A) is about (max/min of diag L)^2
+        L_diag = np.abs(np.diagonal(L_stack, axis1=1, axis2=2))
+        with np.errstate(divide='ignore'):
+            cond_est = np.square(np.max(L_diag, axis=1) / np.min(L_diag, axis=1))
+        chol_ok = chol_ok & (cond_est < np.sqrt(1/sys.float_info.epsilon))
+
+        # Solves against the unit vectors
+        identity_stack = np.broadcast_to(np.eye(num_params), invCm_p_stack.shape)
+        invL_stack = np.linalg.solve(L_stack, identity_stack)
+
+        return (invL_stack, chol_ok)
+
+    def invert_normal_matrix_qr(self, invCm_p_stack):
+
+        n_points, num_params = invCm_p_stack.shape[0:2]
+
+        Q_stack, R_stack = np.linalg.qr(invCm_p_stack)
+
+        # cond(A) is about max/min of diag R
+        R_diag = np.abs(np.diagonal(R_stack, axis1=1, axis2=2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cond_est = np.max(R_diag, axis=1) / np.min(R_diag, axis=1)
+        qr_ok = cond_est < np.sqrt(1/sys.float_info.epsilon)
+
+        # Cm_p = inv(R) Q^T, solved only on the good points
+        Cm_p_stack = np.zeros(shape=invCm_p_stack.shape)
+        if np.any(qr_ok):
+            Cm_p_stack[qr_ok] = np.linalg.solve(R_stack[qr_ok], np.transpose(Q_stack[qr_ok], axes=(0,2,1)))
+
+        return (Cm_p_stack, qr_ok)
+
+    def invert_normal_matrix_svd(self, invCm_p):
+
+        # Same as the original model_posterior
+        if np.linalg.cond(invCm_p) < 1/sys.float_info.epsilon:
+            # This step can still have problem in rare case
+            try:
+                Cm_p = np.linalg.pinv(invCm_p)
+                self.count_linear_solver_path('svd', 1)
+            except np.linalg.LinAlgError as e:
+                print('SVD of the normal matrix failed: ', e)
+                Cm_p = np.zeros(shape=invCm_p.shape) + np.nan
+                self.count_linear_solver_path('failed', 1)
+        else:
+            Cm_p = np.zeros(shape=invCm_p.shape) + np.nan
+            self.count_linear_solver_path('singular', 1)
+
+        return Cm_p
+
+    def reset_linear_solver_counts(self):
+
+        # Number of points (per tile) that took each path
+        self.linear_solver_counts = {'cholesky': 0, 'qr': 0, 'svd': 0, 'singular': 0, 'failed': 0}
+
+    def count_linear_solver_path(self, path, count):
+
+        if not hasattr(self, 'linear_solver_counts'):
+            self.reset_linear_solver_counts()
+
+        self.linear_solver_counts[path] += int(count)
+
+    # Grounding level enumeration (tides_3).
+    # Only the up column of G changes with the grounding level, so the normal equations
+    # of the fixed columns are solved once and each level is a bordered (Schur complement) update.
+    # The fixed part is given either as G (fixed_design_mat_set) or as its normal equations (fixed_normal_eq_set).
+    # design_mat_set is G of the run schema (from build_design_mat_set), the up column is filled in place for each level.
+    # model_prior is the diagonal of invCm (from model_prior_precision).
+    def prepare_enum_normal_eq_set(self, point_set, design_mat_set, data_vec_set, invCd_set, model_prior, fixed_normal_eq_set=None):
+
+        schema = self.get_parameter_schema()
+        up_col_index = schema.up_index
+        fixed_index = schema.fixed_index
+
+        # Prior of the fixed columns
+        fixed_model_prior = model_prior[fixed_index]
+
+        # Posterior and estimation without the up column
+        if fixed_normal_eq_set is not None:
+            fixed_Cm_p_set, fixed_model_vec_set = self.solve_normal_eq_set(point_set, fixed_normal_eq_set, fixed_model_prior)
+        else:
+            fixed_design_mat_set = {}
+            for point in point_set:
+                G = design_mat_set[point]
+                fixed_design_mat_set[point] = G if np.isnan(G[0,0]) else G[:,fixed_index]
+
+            fixed_Cm_p_set, fixed_model_vec_set = self.model_posterior_param_estimation_batch_set(point_set, fixed_design_mat_set, data_vec_set, invCd_set, fixed_model_prior)
+
+        enum_state_set = {}
+        for point in point_set:
+
+            enum_state = {}
+            enum_state['G'] = design_mat_set[point] if design_mat_set is not None else None
+            enum_state['d'] = data_vec_set[point]
+            enum_state['invCd'] = invCd_set[point]
+            enum_state['Cm_p'] = fixed_Cm_p_set[point]
+            enum_state['model_vec'] = fixed_model_vec_set[point]
+            enum_state['up_col_index'] = up_col_index
+            enum_state['fixed_index'] = fixed_index
+
+            # Prior of the up column, no cross terms with the fixed columns (diagonal prior)
+            enum_state['invCm_up_up'] = model_prior[up_col_index]
+
+            enum_state_set[point] = enum_state
+
+        return enum_state_set
+
+    # border_set is from assemble_normal_eq_border_set, if G is not formed.
+    def enum_posterior_param_estimation_set(self, point_set, enum_state_set, up_disp_column_set, border_set=None, variance_only=False):
+
+        Cm_p_set = {}
+        model_vec_set = {}
+        linear_design_mat_set = {}
+
+        for point in point_set:
+            border = border_set[point] if border_set is not None else None
+            Cm_p_set[point], model_vec_set[point], linear_design_mat_set[point] = self.enum_posterior_param_estimation(enum_state_set[point], up_disp_column_set[point], border, variance_only)
+
+        return (Cm_p_set, model_vec_set, linear_design_mat_set)
+
+    def enum_posterior_param_estimation(self, enum_state, up_disp_column, border=None, variance_only=False):
+
+        G = enum_state['G']
+        Cm_p_fixed = enum_state['Cm_p']
+        model_vec_fixed = enum_state['model_vec']
+        idx = enum_state['up_col_index']
+        fixed_index = enum_state['fixed_index']
+
+        # Without G, the output design matrix is None
+        form_G = G is not None
+
+        # Up column of this grounding level, in place
+        if form_G and not np.isnan(G[0,0]):
+            G[:,idx] = up_disp_column
+
+        # Invalid G or the fixed part is already singular
+        if (form_G and np.isnan(G[0,0])) or np.isnan(Cm_p_fixed[0,0]):
+            nan_mat = np.zeros(shape=(1,1)) + np.nan
+            return (nan_mat, nan_mat, G)
+
+        u = up_disp_column
+
+        # Border of the normal matrix
+        if border is not None:
+            FtWu, utWu, r_u = border
+        else:
+            d = enum_state['d'][:,0]
+            Wu = enum_state['invCd'] * u
+            FtWu = np.matmul(np.transpose(G), Wu)[fixed_index]
+            utWu = np.dot(u, Wu)
+            r_u = np.dot(Wu, d)
+
+        b = FtWu
+        c = utWu + enum_state['invCm_up_up']
+
+        # Schur complement of the fixed block
+        z = np.matmul(Cm_p_fixed, b)
+        s = c - np.dot(b, z)
+
+        # The full normal matrix is (numerically) singular
+        if not s > c * sys.float_info.epsilon:
+            nan_mat = np.zeros(shape=(1,1)) + np.nan
+            return (nan_mat, nan_mat, G)
+
+        # Block inverse
+        num_params = Cm_p_fixed.shape[0] + 1
+
+        if variance_only:
+            # Only the diagonal and the secular covariances (the secular columns are before idx)
+            variance = np.zeros(shape=(num_params,))
+            variance[fixed_index] = np.diag(Cm_p_fixed) + np.square(z) / s
+            variance[idx] = 1 / s
+            secular_cov = np.asarray([Cm_p_fixed[i,j] + z[i] * z[j] / s for i, j in [(0,1), (0,2), (1,2)]])
+            Cm_p = (variance, secular_cov)
+        else:
+            Cm_p = np.zeros(shape=(num_params, num_params))
+            Cm_p[np.ix_(fixed_index, fixed_index)] = Cm_p_fixed + np.outer(z, z) / s
+            Cm_p[fixed_index, idx] = -z / s
+            Cm_p[idx, fixed_index] = -z / s
+            Cm_p[idx, idx] = 1 / s
+
+        # Model vector
+        m_up = (r_u - np.dot(b, model_vec_fixed[:,0])) / s
+        model_vec = np.zeros(shape=(num_params,1))
+        model_vec[fixed_index,0] = model_vec_fixed[:,0] - z * m_up
+        model_vec[idx,0] = m_up
+
+        return (Cm_p, model_vec, G)
+
+    ## Adaptive search of the grounding level (tides_3) ##
+
+    # Evaluate many grounding levels of each point at once (grounding_levels_set[point] in meter, can differ by point),
+    # from the fixed part in enum_state_set. All bordered systems of a point are solved together.
+    # Returns the model likelihood, the up scale and the residual stats of each level, per point.
+    def evaluate_grounding_levels_batch_set(self, point_set, enum_state_set, offsetfields_set, up_disp_set, data_vec_set, invCd_set, grounding_levels_set, topo_resid_column_set=None):
+
+        model_likelihood_set = {}
+        up_scale_set = {}
+        resid_of_tides_set = {}
+
+        for point in point_set:
+            topo_resid_column = topo_resid_column_set[point] if topo_resid_column_set is not None else None
+
+            model_likelihood_set[point], up_scale_set[point], resid_of_tides_set[point] = self.evaluate_grounding_levels_batch(enum_state_set[point], offsetfields_set[point], up_disp_set[point], data_vec_set[point], invCd_set[point], grounding_levels_set[point], topo_resid_column)
+
+        return (model_likelihood_set, up_scale_set, resid_of_tides_set)
+
+    def evaluate_grounding_levels_batch(self, enum_state, offsetfields, up_disp, data_vec, invCd, grounding_levels, topo_resid_column=None):
+
+        grounding_levels = np.asarray(grounding_levels, dtype=np.float64).reshape(-1)
+        n_levels = len(grounding_levels)
+
+        G = enum_state['G']
+        Cm_p_fixed = enum_state['Cm_p']
+        model_vec_fixed = enum_state['model_vec']
+        idx = enum_state['up_col_index']
+        fixed_index = enum_state['fixed_index']
+
+        nan_results = (np.full(n_levels, np.nan), np.full(n_levels, np.nan), [(np.nan,np.nan,np.nan,np.nan)] * n_levels)
+
+        # No data or the fixed part is singular
+        if len(offsetfields) == 0 or np.isnan(Cm_p_fixed[0,0]):
+            return nan_results
+
+        tide_height_master, tide_height_slave = up_disp
+        U = self.get_up_disp_columns(offsetfields, tide_height_master, tide_height_slave, grounding_levels)
+
+        d = np.asarray(data_vec)[:,0]
+        W = invCd
+
+        # Border of all levels
+        if G is None:
+            FtWU, UtWU, UtWd = self.assemble_normal_eq_border_batch(offsetfields, data_vec, invCd, U, self.est_secular_variation, topo_resid_column)
+        else:
+            WU = W[None,:] * U
+            FtWU = np.matmul(np.transpose(G), np.transpose(WU))[fixed_index]
+            UtWU = np.sum(WU * U, axis=1)
+            UtWd = np.matmul(WU, d)
+
+        # Schur complement of each level
+        B = FtWU
+        C = UtWU + enum_state['invCm_up_up']
+        Z = np.matmul(Cm_p_fixed, B)
+        S = C - np.sum(B * Z, axis=0)
+
+        # The full normal matrix is (numerically) singular
+        valid = S > C * sys.float_info.epsilon
+        S[~valid] = np.nan
+
+        m_up = (UtWd - np.matmul(model_vec_fixed[:,0], B)) / S
+        M_fixed = model_vec_fixed[:,0][:,None] - Z * m_up[None,:]
+
+        # Models of all levels, (n_levels, num_params)
+        model_vecs = np.zeros(shape=(n_levels, len(fixed_index) + 1))
+        model_vecs[:,fixed_index] = np.nan_to_num(np.transpose(M_fixed))
+        model_vecs[:,idx] = np.nan_to_num(m_up)
+
+        # Residual of all levels, (n_levels, n_offsets*2)
+        if G is None:
+            pred = self.predict_data_vec_batch(offsetfields, model_vecs, U, self.est_secular_variation, topo_resid_column)
+        else:
+            # The up column of G is from another level, it is added with U
+            up_vecs = model_vecs[:,idx].copy()
+            model_vecs[:,idx] = 0
+            pred = np.matmul(model_vecs, np.transpose(G)) + up_vecs[:,None] * U
+
+        resid = d[None,:] - pred
+
+        model_likelihoods = 0.5 * np.sum(W[None,:] * np.square(resid), axis=1)
+        model_likelihoods[~valid] = np.nan
+
+        up_scales = m_up
+
+        resids_of_tides = []
+        for k in range(n_levels):
+            if valid[k]:
+                resids_of_tides.append(self.resid_to_stats(resid[k][:,None]))
+            else:
+                resids_of_tides.append((np.nan,np.nan,np.nan,np.nan))
+
+        return (model_likelihoods, up_scales, resids_of_tides)
+
+    def export_to_others_set_wrt_gl_batch(self, point_set, grounding_levels_int_set, model_likelihood_set, up_scale_set, resid_set, others_set):
+
+        # Same as export_to_others_set_wrt_gl, for many levels of each point
+        enum_cube = self.get_enum_result_cube(point_set, others_set)
+        enum_cube.append(point_set, grounding_levels_int_set, model_likelihood_set, up_scale_set, resid_set)
+
+        return 0
+
+    # Optimal grounding levels and credible intervals (in meter) of the solved tiles around a tile
+    def load_neighbour_grounding_levels(self, tile):
+
+        tile_lon_step_int = self.round_int_5dec(self.tile_lon_step)
+        tile_lat_step_int = self.round_int_5dec(self.tile_lat_step)
+
+        neighbour_gl_set = {}
+        count_tile = 0
+        for neighbour_tile in self.tile_set.keys():
+
+            if neighbour_tile == tuple(tile):
+                continue
+
+            if abs(neighbour_tile[0] - tile[0]) > tile_lon_step_int or abs(neighbour_tile[1] - tile[1]) > tile_lat_step_int:
+                continue
+
+            all_sets = self.load_tile_result(neighbour_tile)
+            if all_sets is None:
+                continue
+
+            others_set = all_sets["others_set"]
+            count_tile += 1
+
+            for point, others in others_set.items():
+                # others_set also has the non-point keys, e.g. grounding_level_enum
+                if not isinstance(point, tuple):
+                    continue
+
+                optimal_gl = others.get("optimal_grounding_level", np.nan)
+                gl_ci = others.get("grounding_level_credible_interval", None)
+                if gl_ci is None or np.isnan(optimal_gl) or np.any(np.isnan(gl_ci)):
+                    continue
+
+                neighbour_gl_set[point] = (optimal_gl / 10**6, gl_ci[0], gl_ci[1])
+
+        print("Number of solved neighbour tiles: ", count_tile)
+        print("Number of solved neighbour points: ", len(neighbour_gl_set))
+
+        return neighbour_gl_set
+
+    def neighbour_seeded_gl_window_set(self, point_set, neighbour_gl_set, gl_low, gl_high):
+
+        # Search window of a point from the solved neighbours within the radius (in grid steps)
+        # No window (full range) if there are too few neighbours or they disagree
+        gl_window_set = {}
+        if len(neighbour_gl_set) == 0:
+            return gl_window_set
+
+        lon_radius = self.gl_search_seed_radius * self.lon_step_int
+        lat_radius = self.gl_search_seed_radius * self.lat_step_int
+        min_width = 2 * self.gl_search_coarse_space
+
+        neighbour_points = np.asarray(list(neighbour_gl_set.keys()))
+        neighbour_gls = np.asarray(list(neighbour_gl_set.values()))
+
+        for point in point_set:
+            near = (np.abs(neighbour_points[:,0] - point[0]) <= lon_radius) & (np.abs(neighbour_points[:,1] - point[1]) <= lat_radius)
+            if np.sum(near) < self.gl_search_seed_min_count:
+                continue
+
+            optimal_gls, ci_lows, ci_highs = neighbour_gls[near].T
+
+            # Neighbour evidence disagrees
+            if np.max(optimal_gls) - np.min(optimal_gls) > self.gl_search_seed_spread:
+                continue
+
+            window_low = np.min(ci_lows) - self.gl_search_seed_margin
+            window_high = np.max(ci_highs) + self.gl_search_seed_margin
+
+            # Not narrower than the bracket of the coarse scan
+            if window_high - window_low < min_width:
+                window_center = (window_low + window_high) / 2
+                window_low = window_center - min_width / 2
+                window_high = window_center + min_width / 2
+
+            window_low = max(window_low, gl_low)
+            window_high = min(window_high, gl_high)
+            if window_high <= window_low:
+                continue
+
+            gl_window_set[point] = (window_low, window_high)
+
+        return gl_window_set
+
+    # Per point search on the model likelihood, all points move in lockstep (one batched evaluation per step):
+    # 1. coarse scan over [gl_low, gl_high] to catch multiple minima
+    # 2. golden-section search in the bracket around the best coarse level
+    # 3. add levels at and inside the credible interval until its width converges
+    # All evaluations are saved in others_set as in the enumeration.
+    def adaptive_grounding_level_search_set(self, point_set, enum_state_set, offsetfields_set, up_disp_set, data_vec_set, invCd_set, gl_low, gl_high, others_set, topo_resid_column_set=None, gl_window_set=None):
+
+        coarse_space = self.gl_search_coarse_space
+        tol = self.gl_search_tol
+        ci_tol = self.gl_search_ci_tol
+
+        n_points = len(point_set)
+        n_eval = [0]
+
+        # Grid of the probes (int, 1e-6 m): 1 cm, or finer if the tolerance is smaller
+        grid_int = int(round(min(tol, 0.01) * 10**6))
+
+        enum_cube = self.get_enum_result_cube(point_set, others_set)
+
+        def evaluate(points, gls):
+            # gls: (n_points, n_levels) in meter, rounded to the grid, so that all points share the levels
+            grounding_levels_int_set = {}
+            grounding_levels_set = {}
+            for i, point in enumerate(points):
+                grounding_levels_int_set[point] = [int(round(gl * 10**6 / grid_int)) * grid_int for gl in np.atleast_1d(gls[i])]
+                grounding_levels_set[point] = np.asarray(grounding_levels_int_set[point]) / 10**6
+
+            model_likelihood_set, up_scale_set, resid_of_tides_set = self.evaluate_grounding_levels_batch_set(points, enum_state_set, offsetfields_set, up_disp_set, data_vec_set, invCd_set, grounding_levels_set, topo_resid_column_set)
+
+            self.export_to_others_set_wrt_gl_batch(points, grounding_levels_int_set, model_likelihood_set, up_scale_set, resid_of_tides_set, others_set)
+            n_eval[0] += 1
+
+            # nan is the worst
+            likelihoods = np.asarray([model_likelihood_set[point] for point in points])
+            likelihoods[np.isnan(likelihoods)] = np.inf
+
+            return likelihoods
+
+        def coarse_scan(points):
+            # Bracket of the minimum on the full range
+            coarse_gls = np.arange(gl_low, gl_high + 1e-6, coarse_space)
+            coarse_likelihoods = evaluate(points, np.tile(coarse_gls, (len(points),1)))
+
+            best_ind = np.argmin(coarse_likelihoods, axis=1)
+            a = coarse_gls[np.maximum(best_ind - 1, 0)]
+            b = coarse_gls[np.minimum(best_ind + 1, len(coarse_gls) - 1)]
+
+            return a, b
+
+        def golden_section_search(points, a, b):
+            # Lockstep over the points, returns the final brackets
+            invphi = (np.sqrt(5) - 1) / 2
+            c = b - (b - a) * invphi
+            d = a + (b - a) * invphi
+            fc, fd = np.transpose(evaluate(points, np.stack((c, d), axis=1)))
+
+            while np.max(b - a) > tol:
+                go_left = fc < fd
+
+                # Minimum in [a, d] or in [c, b]
+                b = np.where(go_left, d, b)
+                a = np.where(go_left, a, c)
+
+                new_c = b - (b - a) * invphi
+                new_d = a + (b - a) * invphi
+
+                f_new = evaluate(points, np.where(go_left, new_c, new_d)[:,None])[:,0]
+
+                fd, fc = np.where(go_left, fc, f_new), np.where(go_left, f_new, fd)
+                d, c = np.where(go_left, c, new_d), np.where(go_left, new_c, d)
+
+            return a, b
+
+        if gl_window_set is None:
+            gl_window_set = {}
+
+        ## 1. coarse scan of the points without a seeded window ##
+        a = np.zeros(n_points)
+        b = np.zeros(n_points)
+        seeded = np.asarray([point in gl_window_set for point in point_set], dtype=bool)
+        for i in np.nonzero(seeded)[0]:
+            a[i], b[i] = gl_window_set[point_set[i]]
+        window_a = a.copy()
+        window_b = b.copy()
+
+        unseeded = np.nonzero(~seeded)[0]
+        if len(unseeded) > 0:
+            a[unseeded], b[unseeded] = coarse_scan([point_set[i] for i in unseeded])
+
+        print("Adaptive gl search: coarse scan Done, number of seeded points: ", np.sum(seeded), "/", n_points)
+
+        ## 2. golden-section search ##
+        a, b = golden_section_search(point_set, a, b)
+
+        # Fall back to the full range if the minimum is at an inner edge of the seeded window
+        # The probes are on the grid, so the edge has a margin of two tol
+        at_edge = seeded & (((a - window_a < 2 * tol) & (window_a > gl_low + 1e-6)) | ((window_b - b < 2 * tol) & (window_b < gl_high - 1e-6)))
+        fallback = np.nonzero(at_edge)[0]
+        if len(fallback) > 0:
+            fallback_points = [point_set[i] for i in fallback]
+            a_fallback, b_fallback = coarse_scan(fallback_points)
+            golden_section_search(fallback_points, a_fallback, b_fallback)
+
+        print("Number of seeded points falling back to the full range: ", len(fallback))
+        print("Adaptive gl search: golden-section search Done, number of evaluations: ", n_eval[0])
+
+        ## 3. credible interval ##
+        ci_width = {}
+        active_points = list(point_set)
+
+        for ci_iter in range(self.gl_search_max_ci_iter):
+
+            new_levels = {}
+            for point in active_points:
+                grounding_levels, likelihoods = enum_cube.point_levels(point)[:2]
+
+                if np.all(np.isnan(likelihoods)):
+                    continue
+
+                gl_optimal = grounding_levels[np.nanargmin(likelihoods)] / 10**6
+                gl_ci = self.grounding_level_credible_interval(grounding_levels, likelihoods)[3]
+                width = gl_ci[1] - gl_ci[0]
+
+                # Converged
+                if np.isnan(width) or (point in ci_width and np.abs(width - ci_width[point]) < ci_tol):
+                    continue
+                ci_width[point] = width
+
+                # The interval ends and the middle to the optimal level (rounded to the grid in evaluate)
+                new_levels[point] = [gl_ci[0], gl_ci[1], (gl_ci[0] + gl_optimal)/2, (gl_ci[1] + gl_optimal)/2]
+
+            active_points = list(new_levels.keys())
+            if len(active_points) == 0:
+                break
+
+            evaluate(active_points, [new_levels[point] for point in active_points])
+
+        print("Adaptive gl search: credible interval Done, number of evaluations: ", n_eval[0])
+        print("Number of points not converged: ", len(active_points), "/", n_points)
+
+        return 0
+
+    # Post-solve stage of the linear inversion.
+    # The prediction is computed once per point (G @ m, or given by predict_data_vec_set) and is used for
+    # the residual stats, the residual per track and the model likelihood.
+    def post_solve_analysis_set(self, point_set, data_info_set, offsetfields_set, data_vec_set, invCd_set, linear_design_mat_set, model_vec_set, data_vec_pred_set=None, data_vec_pred_secular_set=None):
+
+        resid_of_secular_set = {}
+        resid_of_tides_set = {}
+        residual_analysis_set = {}
+        model_likelihood_set = {}
+
+        for point in point_set:
+
+            # check if it is single point mode
+            do_residual_analysis = not (self.single_point_mode and point!=self.test_point)
+
+            data_vec = data_vec_set[point]
+            model_vec = model_vec_set[point]
+
+            # Check singularity.
+            if np.isnan(model_vec[0,0]):
+                resid_of_secular_set[point] = (np.nan,np.nan,np.nan,np.nan)
+                resid_of_tides_set[point] = (np.nan,np.nan,np.nan,np.nan)
+                model_likelihood_set[point] = np.nan
+                if do_residual_analysis:
+                    residual_analysis_set[point] = None
+                continue
+
+            # prediction
+            if data_vec_pred_set is not None:
+                data_vec_pred = data_vec_pred_set[point]
+                data_vec_pred_secular = data_vec_pred_secular_set[point]
+            else:
+                G = linear_design_mat_set[point]
+                data_vec_pred = np.matmul(G, model_vec)
+
+                # Only keep secular velocity.
+                data_vec_pred_secular = np.matmul(G[:,0:2], model_vec[0:2])
+
+            # residual
+            data_vec_residual = data_vec - data_vec_pred
+
+            resid_of_secular_set[point] = self.resid_to_stats(data_vec - data_vec_pred_secular)
+            resid_of_tides_set[point] = self.resid_to_stats(data_vec_residual)
+
+            # calculate model likelihood which is "posterior prob = *  exp(-model_likelihood)"
+            model_likelihood_set[point] = 0.5 * np.sum(invCd_set[point] * np.square(data_vec_residual[:,0]))
+
+            # residual per track
+            if do_residual_analysis:
+                residual_analysis_set[point] = self.point_residual_analysis(point, data_info_set[point], offsetfields_set[point], data_vec, data_vec_pred, data_vec_residual)
+
+        return (resid_of_secular_set, resid_of_tides_set, residual_analysis_set, model_likelihood_set)
+
+    ## Tile results ##
+    # point_result/<lon>_<lat>.pkl, or a chunk of the result store (use_result_store)
+    def get_result_store(self, result_folder=None):
+
+        if result_folder is None:
+            result_folder = self.estimation_dir
+
+        if not hasattr(self, 'result_store_cache'):
+            self.result_store_cache = {}
+
+        if result_folder not in self.result_store_cache:
+            # The global point index is created from the grid at the first write
+            points = self.grid_set.keys() if hasattr(self, 'grid_set') else None
+            self.result_store_cache[result_folder] = result_store(result_folder + '/result_store', points=points)
+
+        return self.result_store_cache[result_folder]
+
+    def tile_result_exists(self, tile_name):
+
+        if self.use_result_store:
+            return self.get_result_store().has_tile(tile_name)
+
+        return os.path.exists(self.estimation_dir + '/point_result/' + tile_name + '.pkl')
+
+    def save_tile_result(self, tile_name, all_sets):
+
+        if self.use_result_store:
+            self.get_result_store().write_tile(tile_name, all_sets)
+        else:
+            with open(self.estimation_dir + '/point_result/' + tile_name + '.pkl', "wb") as f:
+                pickle.dump(all_sets, f)
+
+        return 0
+
+    def load_tile_result(self, tile):
+
+        # None if the tile is not calculated
+        tile_name = str(tile[0]) + '_' + str(tile[1])
+
+        if self.use_result_store:
+            return self.get_result_store().read_tile(tile_name)
+
+        tile_result_pkl_file = self.estimation_dir + '/point_result/' + tile_name + '.pkl'
+        if not os.path.exists(tile_result_pkl_file):
+            return None
+
+        with open(tile_result_pkl_file, "rb") as f:
+            all_sets = pickle.load(f)
+
+        return all_sets
+
+    def load_grid_set(self, result_folder, test_id, name):
+
+        # grid_set_<name>, from the result store if it is used and exists, otherwise from the pickle
+        pkl_file = result_folder + '/' + str(test_id) + '_grid_set_' + name + '.pkl'
+        has_store = os.path.exists(result_folder + '/result_store/points.npy')
+
+        if has_store and (self.use_result_store or not os.path.exists(pkl_file)):
+            print("Loading from the result store: ", name)
+            return self.get_result_store(result_folder).read_grid_set(name + '_set')
+
+        with open(pkl_file, 'rb') as f:
+            grid_set = pickle.load(f)
+
+        return grid_set
+
+    ## Incremental update (tides_1) ##
+    # The normal equations of each point are kept in the tile result (normal_eq_state).
+    # A new run only folds in the offset pairs that are not in the state.
+    def load_normal_eq_state(self, tile):
+
+        layout = (tuple(self.modeling_tides), self.est_secular_variation, self.est_topo_resid, self.t_origin)
+
+        state = None
+        all_sets_former = self.load_tile_result(tile)
+        if all_sets_former is not None:
+            state = all_sets_former.get('normal_eq_state', None)
+
+        if state is None or state.layout != layout or getattr(state, 'version', None) != normal_eq_state.version:
+            print("No normal equations of the same layout in the tile result, start from scratch")
+            state = normal_eq_state(layout)
+
+        return state
+
+    def update_normal_eq_state_set(self, state, point_set, offsetfields_set, data_vec_set, invCd_set, data_info_set, demfactor_set):
+
+        # Fold in the new offset pairs of each point, returns the number of the new pairs of each point
+        schema = self.get_parameter_schema()
+
+        self.temporal_basis_cache = {}
+
+        num_new_pairs_set = {}
+        for point in point_set:
+            offsetfields = self.as_offsetfield_table(offsetfields_set[point])
+            pair_keys = state.pair_keys(offsetfields)
+
+            new_rows = state.new_rows(point, pair_keys)
+
+            # Some pairs in the state are not in the data any more
+            if new_rows is None:
+                print("The data of this point has changed, rebuild its normal equations: ", point)
+                state.reset(point, schema.num_params)
+                new_rows = np.ones(len(pair_keys), dtype=bool)
+
+            num_new_pairs_set[point] = int(np.sum(new_rows))
+            if num_new_pairs_set[point] == 0:
+                continue
+
+            new_offsetfields = offsetfields[new_rows]
+            new_data_rows = np.repeat(new_rows, 2)
+
+            new_data_info = [data_info_set[point][i] for i in np.nonzero(new_rows)[0]]
+
+            topo_resid_column = None
+            if schema.topo_resid:
+                demfactor_list, B_perp_list = self.get_topo_resid_factors(new_offsetfields, new_data_info, demfactor_set[point])
+                topo_resid_column = self.get_topo_resid_column(new_offsetfields, demfactor_list, B_perp_list)
+
+            G = self.build_design_mat(new_offsetfields, schema, topo_resid_column)
+            state.add(point, G, data_vec_set[point][new_data_rows], invCd_set[point][new_data_rows], pair_keys[new_rows], new_data_info)
+
+        return num_new_pairs_set
+
+    def post_solve_analysis_from_state_set(self, point_set, state, data_info_set, model_vec_set):
+
+        # Same outputs as post_solve_analysis_set, from the sufficient statistics in the state
+        # The residual analysis (std per track) comes from the sums of each track
+        schema = self.get_parameter_schema()
+
+        resid_of_secular_set = {}
+        resid_of_tides_set = {}
+        residual_analysis_set = {}
+        model_likelihood_set = {}
+
+        for point in point_set:
+
+            # check if it is single point mode
+            do_residual_analysis = not (self.single_point_mode and point!=self.test_point)
+
+            model_vec = model_vec_set[point]
+
+            # Check singularity.
+            if np.isnan(model_vec[0,0]):
+                resid_of_secular_set[point] = (np.nan,np.nan,np.nan,np.nan)
+                resid_of_tides_set[point] = (np.nan,np.nan,np.nan,np.nan)
+                model_likelihood_set[point] = np.nan
+                if do_residual_analysis:
+                    residual_analysis_set[point] = None
+                continue
+
+            # Only keep secular velocity (E,N).
+            model_vec_secular = np.zeros(shape=model_vec.shape)
+            model_vec_secular[schema.secular_index[0:2]] = model_vec[schema.secular_index[0:2]]
+
+            resid_of_secular_set[point] = state.resid_stats(point, model_vec_secular)
+            resid_of_tides_set[point] = state.resid_stats(point, model_vec)
+            model_likelihood_set[point] = state.model_likelihood(point, model_vec)
+
+            # residual per track
+            if do_residual_analysis:
+                tracks = [track_name for track_name, data_num in self.summarize_data_info(data_info_set[point])]
+                residual_analysis_set[point] = state.track_resid_std(point, model_vec, tracks)
+
+        return (resid_of_secular_set, resid_of_tides_set, residual_analysis_set, model_likelihood_set)
+
     # Calculate residual sets.
-    def get_resid_set(self, point_set, linear_design_mat_set, data_vec_set, model_vec_set):
+    # The prediction can be given (from predict_data_vec_set), otherwise it is G @ m.
+    def get_resid_set(self, point_set, linear_design_mat_set, data_vec_set, model_vec_set, data_vec_pred_set=None, data_vec_pred_secular_set=None):
 
         resid_of_secular_set = {}
         resid_of_tides_set = {}
@@ -3097,37 +4520,36 @@ class fourdvel(basics):
 
         for point in point_set:
             # secular.
-            resid_of_secular = self.resid_of_secular(linear_design_mat_set[point],
+            if data_vec_pred_secular_set is not None:
+                resid_of_secular = data_vec_set[point] - data_vec_pred_secular_set[point]
+            else:
+                resid_of_secular = self.resid_of_secular(linear_design_mat_set[point],
                                                 data_vec_set[point], model_vec_set[point])
 
-            if not np.isnan(resid_of_secular[0,0]):
-                resid_of_secular_set[point] = ( np.mean(resid_of_secular[0::2]),
-                                                np.sqrt(np.mean(resid_of_secular[0::2]**2)),
-                                                np.mean(resid_of_secular[1::2]),
-                                                np.sqrt(np.mean(resid_of_secular[1::2]**2)))
-
-                #print(resid_of_secular_set[point])
-
-            else:
-                resid_of_secular_set[point] = (np.nan,np.nan,np.nan,np.nan)
+            resid_of_secular_set[point] = self.resid_to_stats(resid_of_secular)
 
             # tides.
-            resid_of_tides = self.resid_of_tides(linear_design_mat_set[point],
+            if data_vec_pred_set is not None:
+                resid_of_tides = data_vec_set[point] - data_vec_pred_set[point]
+            else:
+                resid_of_tides = self.resid_of_tides(linear_design_mat_set[point],
                                                 data_vec_set[point], model_vec_set[point])
 
-            if not np.isnan(resid_of_tides[0,0]):
-                # range and azimuth
-                resid_of_tides_set[point] = (   np.mean(resid_of_tides[0::2]),
-                                                np.sqrt(np.mean(resid_of_tides[0::2]**2)),
-                                                np.mean(resid_of_tides[1::2]),
-                                                np.sqrt(np.mean(resid_of_tides[1::2]**2)))
+            resid_of_tides_set[point] = self.resid_to_stats(resid_of_tides)
 
-                #print(resid_of_tides_set[point])
+        return (resid_of_secular_set, resid_of_tides_set)
 
-            else:
-                resid_of_tides_set[point] = (np.nan,np.nan,np.nan,np.nan)
+    def resid_to_stats(self, resid):
 
-        return (resid_of_secular_set, resid_of_tides_set)
+        if not np.isnan(resid[0,0]):
+            # range and azimuth
+            return (    np.mean(resid[0::2]),
+                        np.sqrt(np.mean(resid[0::2]**2)),
+                        np.mean(resid[1::2]),
+                        np.sqrt(np.mean(resid[1::2]**2)))
+
+        else:
+            return (np.nan,np.nan,np.nan,np.nan)
 
     # Residual of secular velocity.
     def resid_of_secular(self, design_mat, data, model):
@@ -3170,7 +4592,7 @@ class fourdvel(basics):
 
         return resid_of_tides
 
-    def point_set_residual_analysis(self, point_set, data_info_set, offsetfields_set, data_vec_set, linear_design_mat_set, model_vec_set):
+    def point_set_residual_analysis(self, point_set, data_info_set, offsetfields_set, data_vec_set, linear_design_mat_set, model_vec_set, data_vec_pred_set=None):
 
         test_point = self.test_point
         grid_set = self.grid_set
@@ -3188,7 +4610,6 @@ class fourdvel(basics):
             data_info = data_info_set[point]
             data_vec = data_vec_set[point]
             offsetfields = offsetfields_set[point]
-            design_mat = linear_design_mat_set[point]
 
             # Find the estimation
             model_vec = model_vec_set[point]
@@ -3197,7 +4618,10 @@ class fourdvel(basics):
             if not np.isnan(model_vec[0,0]):
 
                 # prediction 
-                data_vec_pred = np.matmul(design_mat, model_vec)
+                if data_vec_pred_set is not None:
+                    data_vec_pred = data_vec_pred_set[point]
+                else:
+                    data_vec_pred = np.matmul(linear_design_mat_set[point], model_vec)
 
                 # residual
                 data_vec_residual = data_vec - data_vec_pred
@@ -3221,6 +4645,14 @@ class fourdvel(basics):
 
     def point_residual_analysis(self, point, data_info, offsetfields, data_vec, data_vec_pred, data_vec_residual):
 
+        offsetfields = self.as_offsetfield_table(offsetfields)
+
+        # Plot and make analysis
+        plot_analysis = False
+
+        if plot_analysis == True and self.single_point_mode == False:
+            raise Exception("Cannot plot analysis when single point mode is turned on")
+
         #print("Work on point: ", point)
 
         # Partition the residual according to track, center date and time interval
@@ -3246,10 +4678,6 @@ class fourdvel(basics):
         # Loop through by track
         data_info_summary = self.summarize_data_info(data_info)
 
-        # Save the residual from all tracks
-        range_residual_all_tracks = []
-        azimuth_residual_all_tracks = []
-
         for i, track in enumerate(data_info_summary):
 
             # check if it is single point mode
@@ -3280,7 +4708,7 @@ class fourdvel(basics):
             data_vec_pred_track_range = data_vec_pred_track[0::2, 0]
             data_vec_pred_track_azimuth = data_vec_pred_track[1::2, 0]
 
-            # Obtain the offsetfields of this track            
+            # Obtain the offsetfields of this track (view)
             offsetfields_track = offsetfields[ data_num_total: data_num_total + data_num ]
 
             # Obtain the residual of this track
@@ -3294,21 +4722,27 @@ class fourdvel(basics):
             track_residual[((sate_name, track_num), 'range')] = np.nanstd(range_residual_track)
             track_residual[((sate_name, track_num), 'azimuth')] = np.nanstd(azimuth_residual_track)
 
-            # Save the residual to all track list
-            range_residual_all_tracks = range_residual_all_tracks + list(range_residual_track)
-            azimuth_residual_all_tracks = azimuth_residual_all_tracks + list(azimuth_residual_track)
-
             # Move to next track
             data_num_total += data_num
 
             ############ Analyze the each residual point #########
+            # Only needed for plotting
+            if not plot_analysis:
+                continue
+
             # Find the index of the track
             _, track_ind = self.track_num_to_track_ind[(sate_name, track_num)]
 
             # Record the relevant information of each offset field
-            for j, offsetfield in enumerate(offsetfields_track):
-                t1_day = self.count_days(offsetfield[0])
-                t2_day = self.count_days(offsetfield[1])
+            dates_a = offsetfields_track.dates_a
+            dates_b = offsetfields_track.dates_b
+            t_frac_track = offsetfields_track.t_frac.tolist()
+            day_a_track = offsetfields_track.day_a.tolist()
+            day_b_track = offsetfields_track.day_b.tolist()
+
+            for j in range(len(offsetfields_track)):
+                t1_day = day_a_track[j]
+                t2_day = day_b_track[j]
                 t_center = (t1_day + t2_day)/2
                 t_center_date = self.t_origin + datetime.timedelta(days=t_center)
                 t_center_datestr = t_center_date.strftime('%Y%m%d')
@@ -3318,37 +4752,32 @@ class fourdvel(basics):
 
                 # Record tide
                 # Fractional time
-                t1 = t1_day + offsetfield[4]
-                t2 = t2_day + offsetfield[4]
+                t1 = t1_day + t_frac_track[j]
+                t2 = t2_day + t_frac_track[j]
 
                 # The tidal height
                 z1 = tide_data[int(np.round((t1 - tide_taxis[0])/tide_taxis_delta))]
                 z2 = tide_data[int(np.round((t2 - tide_taxis[0])/tide_taxis_delta))]
 
                 # Record the sampled tide by master and slave
-                tide_proxy_list.append((z1, z2, track_num, offsetfield[0], offsetfield[1]))
+                tide_proxy_list.append((z1, z2, track_num, dates_a[j], dates_b[j]))
 
         # Calcuate the residual, the std per looking angle
         #print('data info summary: ', data_info_summary)
 
-        track_residual[(('all-sate','all-track'),'range')] = np.std(range_residual_all_tracks)
-        track_residual[(('all-sate','all-track'),'azimuth')] = np.std(azimuth_residual_all_tracks)
+        # The tracks cover all the residual
+        track_residual[(('all-sate','all-track'),'range')] = np.std(data_vec_residual[::2,0])
+        track_residual[(('all-sate','all-track'),'azimuth')] = np.std(data_vec_residual[1::2,0])
 
         #print(track_residual[(('all-sate','all-track'),'range')])
         #print(track_residual[(('all-sate','all-track'),'azimuth')])
         #print(stop)
 
-        # Check if the coords are correct: 2 x length of coords == length of residual
-        assert(len(coords_list)*2 == len(data_vec_residual)), \
-        print("coords_list length {} and data_vec_residual length {} don't match".format(len(coords_list), len(data_vec_residual)))
-
-        # Plot and make analysis
-        plot_analysis = False
-
-        if plot_analysis == True and self.single_point_mode == False:
-            raise Exception("Cannot plot analysis when single point mode is turned on")
-
         if plot_analysis:
+            # Check if the coords are correct: 2 x length of coords == length of residual
+            assert(len(coords_list)*2 == len(data_vec_residual)), \
+            print("coords_list length {} and data_vec_residual length {} don't match".format(len(coords_list), len(data_vec_residual)))
+
             if self.proj == 'Rutford':
                 analysis_start_day = datetime.datetime(2013,6,1)
                 analysis_stop_day = datetime.datetime(2014,10,1)
@@ -3427,11 +4856,136 @@ class fourdvel(basics):
 
         return residual_analysis_point_result
 
-    def get_model_likelihood_set(self, point_set, linear_design_mat_set, data_vec_set, model_vec_set, invCd_set):
+    ## Cross validation ##
+    # Leave-one-track-out and leave-one-pair-out from the factored normal equations, no refit.
+    # Leaving out the rows S: (I - P_S W_S) e_S = r_S, with P_S = G_S Cm_p G_S^T and r = d - G m the full residual,
+    # e_S = d_S - G_S m_-S is the predicted residual and m_-S = m - Cm_p G_S^T W_S e_S.
+    def cross_validation_set(self, point_set, design_mat_set, data_vec_set, invCd_set, offsetfields_set, model_prior, batch_size=256):
+
+        cross_validation_set = {}
+
+        valid_points = []
+        for point in point_set:
+            if np.isnan(design_mat_set[point][0,0]):
+                cross_validation_set[point] = {}
+            else:
+                valid_points.append(point)
+
+        for i_start in range(0, len(valid_points), batch_size):
+            batch_points = valid_points[i_start : i_start + batch_size]
+
+            # Normal matrix with the prior, factored once per point
+            invCm_p_stack = np.asarray([np.matmul(np.transpose(design_mat_set[point] * invCd_set[point][:,None]), design_mat_set[point]) for point in batch_points])
+            self.add_model_prior_to_stack(invCm_p_stack, model_prior)
+
+            invL_stack, chol_ok = self.factor_normal_matrix_cholesky(invCm_p_stack)
+
+            for i, point in enumerate(batch_points):
+
+                if not chol_ok[i]:
+                    print("Normal matrix is close to singular, skip cross validation: ", point)
+                    cross_validation_set[point] = {}
+                    continue
+
+                cross_validation_set[point] = self.point_cross_validation(point, design_mat_set[point], data_vec_set[point], invCd_set[point], offsetfields_set[point], invL_stack[i])
+
+        return cross_validation_set
+
+    def point_cross_validation(self, point, G, data_vec, invCd, offsetfields, invL):
+
+        offsetfields = self.as_offsetfield_table(offsetfields)
+
+        d = np.asarray(data_vec).reshape(-1)
+        w = invCd
+        sqrt_w = np.sqrt(w)
+
+        # Cm_p = inv(L)^T inv(L), G Cm_p G^T = B^T B
+        B = np.matmul(invL, np.transpose(G))
+
+        # Full data solution and residual
+        model_vec = np.matmul(np.transpose(invL), np.matmul(B, w * d))
+        resid = d - np.matmul(G, model_vec)
+
+        # Whitened columns, C^T C = W^1/2 G Cm_p G^T W^1/2
+        C = B * sqrt_w[None,:]
+
+        cross_validation = {}
+
+        ## Leave one pair out, 2x2 blocks of all pairs at once
+        n_offsets = len(offsetfields)
+        C_pair = np.transpose(C.reshape(C.shape[0], n_offsets, 2), axes=(1,0,2))
+        B_pair = np.transpose(B.reshape(B.shape[0], n_offsets, 2), axes=(1,0,2))
+
+        M_pair = np.eye(2)[None,:,:] - np.matmul(np.transpose(C_pair, axes=(0,2,1)), C_pair)
+        rhs_pair = (sqrt_w * resid).reshape(n_offsets, 2, 1)
+
+        # A pair that is the only constraint of a parameter cannot be predicted
+        pair_ok = np.linalg.det(M_pair) > np.sqrt(sys.float_info.epsilon)
+        M_pair[~pair_ok] = np.eye(2)
+
+        # u = W^1/2 e, e = r + P W e = r + B^T C u
+        u_pair = np.linalg.solve(M_pair, rhs_pair)
+        e_pair = resid.reshape(n_offsets, 2) + np.matmul(np.transpose(B_pair, axes=(0,2,1)), np.matmul(C_pair, u_pair))[:,:,0]
+        e_pair[~pair_ok] = np.nan
+
+        misfit_pair = np.sum(w.reshape(n_offsets, 2) * np.square(e_pair), axis=1)
+
+        ## Leave one track out
+        for track_name, track_slice in offsetfields.track_slices():
+
+            rows = slice(track_slice.start*2, track_slice.stop*2)
+            n_rows = rows.stop - rows.start
+
+            C_S = C[:, rows]
+            M_S = np.eye(n_rows) - np.matmul(np.transpose(C_S), C_S)
+
+            # The rest of the data (and the prior) must constrain all the parameters
+            try:
+                L_S = np.linalg.cholesky(M_S)
+                track_ok = np.min(np.abs(np.diagonal(L_S))) > sys.float_info.epsilon**0.25
+            except np.linalg.LinAlgError:
+                track_ok = False
+
+            if track_ok:
+                u_S = np.linalg.solve(M_S, sqrt_w[rows] * resid[rows])
+                e_S = resid[rows] + np.matmul(np.transpose(B[:, rows]), np.matmul(C_S, u_S))
+
+                # Change of the model without this track
+                model_vec_S = model_vec - np.matmul(np.transpose(invL), np.matmul(C_S, u_S))
+                model_change = model_vec_S - model_vec
+            else:
+                e_S = np.zeros(n_rows) + np.nan
+                model_change = np.zeros(len(model_vec)) + np.nan
+
+            # Predicted residual (leave one track out)
+            cross_validation[(track_name, 'loto_range')] = np.sqrt(np.mean(np.square(e_S[0::2])))
+            cross_validation[(track_name, 'loto_azimuth')] = np.sqrt(np.mean(np.square(e_S[1::2])))
+            cross_validation[(track_name, 'loto_misfit')] = np.mean(w[rows] * np.square(e_S))
+            cross_validation[(track_name, 'loto_secular_change')] = np.linalg.norm(model_change[0:3])
+
+            # Predicted residual (leave one pair out)
+            e_pair_S = e_pair[track_slice]
+            cross_validation[(track_name, 'lopo_range')] = np.sqrt(np.nanmean(np.square(e_pair_S[:,0])))
+            cross_validation[(track_name, 'lopo_azimuth')] = np.sqrt(np.nanmean(np.square(e_pair_S[:,1])))
+            cross_validation[(track_name, 'lopo_misfit')] = np.nanmean(misfit_pair[track_slice]) / 2
+
+            # In-sample residual
+            cross_validation[(track_name, 'fit_range')] = np.sqrt(np.mean(np.square(resid[rows][0::2])))
+            cross_validation[(track_name, 'fit_azimuth')] = np.sqrt(np.mean(np.square(resid[rows][1::2])))
+
+            cross_validation[(track_name, 'data_num')] = track_slice.stop - track_slice.start
+
+        # All the pairs
+        cross_validation[(('all-sate','all-track'), 'lopo_range')] = np.sqrt(np.nanmean(np.square(e_pair[:,0])))
+        cross_validation[(('all-sate','all-track'), 'lopo_azimuth')] = np.sqrt(np.nanmean(np.square(e_pair[:,1])))
+        cross_validation[(('all-sate','all-track'), 'lopo_misfit')] = np.nanmean(misfit_pair) / 2
+
+        return cross_validation
+
+    def get_model_likelihood_set(self, point_set, linear_design_mat_set, data_vec_set, model_vec_set, invCd_set, data_vec_pred_set=None):
 
         model_likelihood_set = {}
         for point in point_set:
-            G = linear_design_mat_set[point]
             d = data_vec_set[point]
             m = model_vec_set[point]
             invCd = invCd_set[point]
@@ -3440,8 +4994,13 @@ class fourdvel(basics):
                 model_likelihood_set[point] = np.nan
             else:
                 # calculate model likelihood which is "posterior prob = *  exp(-model_likelihood)"
-                model_likelihood = 0.5 * (d - G @ m).T @ invCd @ (d - G @ m)
-                model_likelihood_set[point] = model_likelihood[0,0]
+                if data_vec_pred_set is not None:
+                    data_vec_pred = data_vec_pred_set[point]
+                else:
+                    data_vec_pred = linear_design_mat_set[point] @ m
+                resid = (d - data_vec_pred)[:,0]
+                model_likelihood = 0.5 * np.sum(invCd * np.square(resid))
+                model_likelihood_set[point] = model_likelihood
        
         return model_likelihood_set
 
@@ -3463,6 +5022,9 @@ class fourdvel(basics):
         tide_periods = self.tide_periods
         tide_omegas = self.tide_omegas
 
+        # Indices of the parameters
+        schema = self.get_parameter_schema()
+
         # for uq, both est and uq are passed in a tuple
         # The main vec is data_vec
         if state == 'uq':
@@ -3547,8 +5109,8 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Msf':
-                    ampE = data_vec[3+k*6]
-                    ampN = data_vec[3+k*6+1]
+                    ampE = data_vec[schema.amp_index[k,0]]
+                    ampN = data_vec[schema.amp_index[k,1]]
                     quant = np.sqrt(ampE**2 + ampN**2)
                 else:
                     k=k+1
@@ -3561,8 +5123,8 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Msf':
-                    ampE = self.velo_amp_to_dis_amp(data_vec[3+k*6],tide_name)
-                    ampN = self.velo_amp_to_dis_amp(data_vec[3+k*6+1],tide_name)
+                    ampE = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,0]],tide_name)
+                    ampN = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,1]],tide_name)
                     quant = np.sqrt(ampE**2 + ampN**2)
                 else:
                     k=k+1
@@ -3575,7 +5137,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Msf':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     quant = ampU
                 else:
                     k=k+1
@@ -3590,7 +5152,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Msf':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     thres = 0.1
 
                     model_up = self.get_model_up(point)
@@ -3599,7 +5161,7 @@ class fourdvel(basics):
                     # clip values outside ice-shelf for Rutford and Evans
                     if (state == 'uq') or ( (ampU >=thres) and ((self.proj == 'Rutford' and model_up > 0) or (self.proj == 'Evans' and model_up > 0)) ):
 
-                        value = data_vec[3+k*6+5]
+                        value = data_vec[schema.phase_index[k,2]]
 
                         if state in [ 'true','est']:
                             phaseU = self.velo_phase_to_dis_phase(value)
@@ -3626,7 +5188,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'M2':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     quant = np.sqrt(ampU**2)
                 else:
                     k=k+1
@@ -3647,11 +5209,11 @@ class fourdvel(basics):
                     else:
                         raise ValueError()
  
-                    ampE = self.velo_amp_to_dis_amp(est_vec[3+k*6], tide_name)
-                    phaseE = self.velo_phase_to_dis_phase(est_vec[3+k*6+3])
+                    ampE = self.velo_amp_to_dis_amp(est_vec[schema.amp_index[k,0]], tide_name)
+                    phaseE = self.velo_phase_to_dis_phase(est_vec[schema.phase_index[k,0]])
 
-                    ampN = self.velo_amp_to_dis_amp(est_vec[3+k*6+1], tide_name)
-                    phaseN = self.velo_phase_to_dis_phase(est_vec[3+k*6+4])
+                    ampN = self.velo_amp_to_dis_amp(est_vec[schema.amp_index[k,1]], tide_name)
+                    phaseN = self.velo_phase_to_dis_phase(est_vec[schema.phase_index[k,1]])
 
                     ################## Notes ####################
                     # Calculate along flow and cross flow
@@ -3937,10 +5499,10 @@ class fourdvel(basics):
 
                         # Find the sigma of E&N amplitude and phase
                         ## The uq is sigma with sqrt taken
-                        #sigma_ampE = data_vec[3+k*6]
-                        #sigma_phaseE = data_vec[3+k*6+3]
-                        #sigma_ampN = data_vec[3+k*6+1]
-                        #sigma_phaseN = data_vec[3+k*6+4]
+                        #sigma_ampE = data_vec[schema.amp_index[k,0]]
+                        #sigma_phaseE = data_vec[schema.phase_index[k,0]]
+                        #sigma_ampN = data_vec[schema.amp_index[k,1]]
+                        #sigma_phaseN = data_vec[schema.phase_index[k,1]]
 
                         #sigma_ampE_2 = sigma_ampE**2
                         #sigma_phaseE_2 = sigma_phase_E**2
@@ -3949,10 +5511,10 @@ class fourdvel(basics):
 
 
                         # The uq is sigma_2
-                        sigma_ampE_2 = data_vec[3+k*6]
-                        sigma_phaseE_2 = data_vec[3+k*6+3]
-                        sigma_ampN_2 = data_vec[3+k*6+1]
-                        sigma_phaseN_2 = data_vec[3+k*6+4]
+                        sigma_ampE_2 = data_vec[schema.amp_index[k,0]]
+                        sigma_phaseE_2 = data_vec[schema.phase_index[k,0]]
+                        sigma_ampN_2 = data_vec[schema.amp_index[k,1]]
+                        sigma_phaseN_2 = data_vec[schema.phase_index[k,1]]
 
                         #a = ampE * np.sin(phaseE) # amp of cos term
                         #b = ampE * np.cos(phaseE) # amp of sin term
@@ -4055,7 +5617,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Msf':
-                    ampE = self.velo_amp_to_dis_amp(data_vec[3+k*6],tide_name)
+                    ampE = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,0]],tide_name)
                     quant = ampE
                 else:
                     k=k+1
@@ -4070,7 +5632,7 @@ class fourdvel(basics):
             for tide_name in modeling_tides:
                 if tide_name == 'Msf':
 
-                    value = data_vec[3+k*6+3]
+                    value = data_vec[schema.phase_index[k,0]]
                     if state in [ 'true','est']:
                         phaseE = self.velo_phase_to_dis_phase(value)
                         quant = self.rad2deg(phaseE)
@@ -4094,7 +5656,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Msf':
-                    ampN = self.velo_amp_to_dis_amp(data_vec[3+k*6+1],tide_name)
+                    ampN = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,1]],tide_name)
                     quant = ampN
                 else:
                     k=k+1
@@ -4109,7 +5671,7 @@ class fourdvel(basics):
             for tide_name in modeling_tides:
                 if tide_name == 'Msf':
 
-                    value = data_vec[3+k*6+4]
+                    value = data_vec[schema.phase_index[k,1]]
 
                     if state in [ 'true','est']:
                         phaseE=self.velo_phase_to_dis_phase(value)
@@ -4135,8 +5697,8 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Mf':
-                    ampE = self.velo_amp_to_dis_amp(data_vec[3+k*6],tide_name)
-                    ampN = self.velo_amp_to_dis_amp(data_vec[3+k*6+1],tide_name)
+                    ampE = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,0]],tide_name)
+                    ampN = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,1]],tide_name)
                     quant = np.sqrt(ampE**2 + ampN**2)
                 else:
                     k=k+1
@@ -4150,7 +5712,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Mf':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     quant = ampU
                 else:
                     k=k+1
@@ -4165,10 +5727,10 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Mf':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     thres = 0.1
 
-                    value = data_vec[3+k*6+5]
+                    value = data_vec[schema.phase_index[k,2]]
 
                     if (self.grid_set_velo[point][2]>0 and ampU > thres) or (state=='uq'):
                         if state in [ 'true','est']:
@@ -4201,8 +5763,8 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'M2':
-                    ampE = self.velo_amp_to_dis_amp(data_vec[3+k*6],tide_name)
-                    ampN = self.velo_amp_to_dis_amp(data_vec[3+k*6+1],tide_name)
+                    ampE = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,0]],tide_name)
+                    ampN = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,1]],tide_name)
                     quant = np.sqrt(ampE**2 + ampN**2)
                 else:
                     k=k+1
@@ -4216,8 +5778,8 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'O1':
-                    ampE = self.velo_amp_to_dis_amp(data_vec[3+k*6],tide_name)
-                    ampN = self.velo_amp_to_dis_amp(data_vec[3+k*6+1],tide_name)
+                    ampE = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,0]],tide_name)
+                    ampN = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,1]],tide_name)
                     quant = np.sqrt(ampE**2 + ampN**2)
                 else:
                     k=k+1
@@ -4235,7 +5797,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'M2':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     quant = np.sqrt(ampU**2)
                 else:
                     k=k+1
@@ -4251,7 +5813,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'M2':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
 
                     # old way
                     #thres = 0.3
@@ -4281,7 +5843,7 @@ class fourdvel(basics):
                     # clip values outside ice-shelf for Rutford and Evans
                     if (state=='uq') or ( (ampU >=thres) and ((self.proj == 'Rutford' and model_up > 0) or (self.proj == 'Evans' and model_up > 0)) ):
 
-                        value = data_vec[3+k*6+5]
+                        value = data_vec[schema.phase_index[k,2]]
                         if state in [ 'true','est']:
                             # Find the phase
                             phaseU=self.velo_phase_to_dis_phase(value)
@@ -4317,7 +5879,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'N2':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     quant = np.sqrt(ampU**2)
                 else:
                     k=k+1
@@ -4334,7 +5896,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'N2':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
 
 
                     if self.proj == 'Evans':
@@ -4357,7 +5919,7 @@ class fourdvel(basics):
                     # clip values outside ice-shelf for Rutford and Evans
                     if (state == 'uq') or ( (ampU >=thres) and ((self.proj == 'Rutford' and model_up > 0) or (self.proj == 'Evans' and model_up > 0)) ):
 
-                        value = data_vec[3+k*6+5]
+                        value = data_vec[schema.phase_index[k,2]]
                         if state in [ 'true','est']:
                             # Find the phase
 
@@ -4395,7 +5957,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'O1':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     quant = np.sqrt(ampU**2)
                 else:
                     k=k+1
@@ -4409,7 +5971,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'O1':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     thres = 0.1
 
                     if self.proj == 'Evans':
@@ -4430,7 +5992,7 @@ class fourdvel(basics):
                     # clip values outside ice-shelf for Rutford and Evans
                     if (state == 'uq') or ( (ampU >=thres) and ((self.proj == 'Rutford' and model_up > 0) or (self.proj == 'Evans' and model_up > 0)) ):
 
-                        value = data_vec[3+k*6+5]
+                        value = data_vec[schema.phase_index[k,2]]
                         if state in [ 'true','est']:
                             phaseU=self.velo_phase_to_dis_phase(value)
                             quant = self.rad2deg(phaseU)
@@ -4464,7 +6026,7 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Q1':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     quant = np.sqrt(ampU**2)
                 else:
                     k=k+1
@@ -4480,13 +6042,13 @@ class fourdvel(basics):
             k = 0
             for tide_name in modeling_tides:
                 if tide_name == 'Q1':
-                    ampU = self.velo_amp_to_dis_amp(data_vec[3+k*6+2],tide_name)
+                    ampU = self.velo_amp_to_dis_amp(data_vec[schema.amp_index[k,2]],tide_name)
                     thres = 0.03
 
                     #if (self.grid_set_velo[point][2]>0 and ampU > thres) or (state=='uq'):
                     if (ampU > thres) or (state=='uq'):
 
-                        value = data_vec[3+k*6+5]
+                        value = data_vec[schema.phase_index[k,2]]
                         if state in [ 'true','est']:
                             # Find the phase
                             phaseU=self.velo_phase_to_dis_phase(value)
@@ -4522,10 +6084,10 @@ class fourdvel(basics):
         elif quant_name == "up_amplitude_scaling":
 
             if state in ['est','uq']:
-                assert len(data_vec)>= 3 + self.n_modeling_tides*6 + 1, print("length of param_uq_vec has problem for up_amplitude scaling ", len(data_vec), data_vec)
+                assert len(data_vec) == schema.num_params and schema.up_disp, print("length of param_uq_vec has problem for up_amplitude scaling ", len(data_vec), data_vec)
 
             # the first index after tidal params
-            ind = 3 + self.n_modeling_tides * 6
+            ind = schema.up_index
 
             # TODO, Need to import true up amp scaling here
             if state in ['true']:
@@ -4547,10 +6109,10 @@ class fourdvel(basics):
         elif quant_name == "topo_resid":
             
             if state in ['est', 'uq']:
-                assert len(data_vec)>= 3 + self.n_modeling_tides*6 + 1, print("length of param_uq_vec has problem for topo resid ", len(data_vec))
+                assert len(data_vec) == schema.num_params and schema.topo_resid, print("length of param_uq_vec has problem for topo resid ", len(data_vec))
 
-            # I use the last index as topo resid
-            ind = -1
+            # topo resid is the last index
+            ind = schema.topo_resid_index
 
             # TODO, Need to import true topo resid
             if state in ['true']:
@@ -4568,17 +6130,13 @@ class fourdvel(basics):
         elif quant_name in ["secular_east_velocity_variation", "secular_north_velocity_variation", "secular_up_velocity_variation"]:
             
             if state in ['est', 'uq']:
-                assert len(data_vec)>= 3 + self.n_modeling_tides*6 + 3, print("length of param_uq_vec has problem for secular variation ", len(data_vec))
+                assert len(data_vec) == schema.num_params and schema.secular_variation, print("length of param_uq_vec has problem for secular variation ", len(data_vec))
 
-            # I use the last index as topo resid, find the index of secular variation accordingly
-            if self.est_topo_resid:
-                ind_east = -4
-                ind_north = -3
-                ind_up = -2
+            # Index of secular variation
+            if schema.secular_variation:
+                ind_east, ind_north, ind_up = schema.secular_variation_index
             else:
-                ind_east = -3
-                ind_north = -2
-                ind_up = -1
+                ind_east, ind_north, ind_up = None, None, None
 
             if quant_name == 'secular_east_velocity_variation':
                 ind = ind_east
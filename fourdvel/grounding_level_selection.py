@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# Selection of the optimal grounding level and its credible interval for all points at once
+# Same steps as fourdvel.select_optimal_grounding_level, on (n_points, n_levels) arrays:
+# (1) optimal level = the first minimum of the likelihood
+# (2) linear interpolation of the likelihood onto a 1 cm grid starting at the lowest level of each point
+# (3) normalized probability exp(-likelihood)
+# (4) highest posterior density interval = the shortest window of the grid with mass >= alpha
+
+import time
+import argparse
+
+import numpy as np
+
+# The non-grounding case, excluded from the credible interval
+no_grounding_level_int = -10 * 10**6
+
+def createParser():
+
+    parser = argparse.ArgumentParser( description='micro-benchmark of the grounding level selection')
+
+    parser.add_argument('-n','--n_points', dest='n_points',type=int,help='number of points',default=200)
+
+    parser.add_argument('-s','--space', dest='space',type=float,help='spacing of the enumerated levels (m)',default=0.1)
+
+    parser.add_argument('-a','--alpha', dest='alpha',type=float,help='mass of the credible interval',default=0.68)
+
+    return parser
+
+def cmdLineParse(iargs = None):
+    parser = createParser()
+    return parser.parse_args(args=iargs)
+
+class grounding_level_selection():
+
+    def __init__(self, alpha=0.68, grid_space_int=10**4):
+
+        # Mass of the credible interval
+        self.alpha = alpha
+
+        # Interpolation grid, 1 cm
+        self.grid_space_int = grid_space_int
+
+    def select(self, grounding_levels_int, likelihoods, up_scales=None):
+
+        # grounding_levels_int: (n_levels,) sorted
+        # likelihoods, up_scales: (n_points, n_levels), nan is missing
+        optimal_grounding_level, up_scale = self.select_optimal(grounding_levels_int, likelihoods, up_scales)
+
+        gls_interp, gl_probs_interp, grid_mask = self.interp_probs(grounding_levels_int, likelihoods)
+
+        gl_ci = self.hpdi(gls_interp, gl_probs_interp, grid_mask)
+
+        return {'optimal_grounding_level': optimal_grounding_level,
+                'up_scale': up_scale,
+                'grounding_level_grid': gls_interp,
+                'grounding_level_prob': gl_probs_interp,
+                'grid_mask': grid_mask,
+                'grounding_level_credible_interval': gl_ci}
+
+    def select_optimal(self, grounding_levels_int, likelihoods, up_scales=None):
+
+        n_points = likelihoods.shape[0]
+
+        valid = ~np.all(np.isnan(likelihoods), axis=1)
+        best_ind = np.argmin(np.where(np.isnan(likelihoods), np.inf, likelihoods), axis=1)
+
+        optimal_grounding_level = np.where(valid, grounding_levels_int[best_ind], np.nan)
+
+        up_scale = np.full(n_points, np.nan)
+        if up_scales is not None:
+            up_scale[valid] = up_scales[np.arange(n_points)[valid], best_ind[valid]]
+
+        return (optimal_grounding_level, up_scale)
+
+    def interp_probs(self, grounding_levels_int, likelihoods):
+
+        # Per point grid: gl_min + k * 1 cm, gl_min <= grid < gl_max, over the valid levels except no grounding
+        n_points, n_levels = likelihoods.shape
+        step = self.grid_space_int
+
+        valid = ~np.isnan(likelihoods) & (grounding_levels_int != no_grounding_level_int)[None,:]
+        levels = np.broadcast_to(grounding_levels_int.astype(np.float64), (n_points, n_levels))
+
+        n_valid = np.sum(valid, axis=1)
+        gl_min = np.min(np.where(valid, levels, np.inf), axis=1)
+        gl_max = np.max(np.where(valid, levels, -np.inf), axis=1)
+
+        n_grid = np.zeros(n_points, dtype=np.int64)
+        has_grid = n_valid >= 2
+        n_grid[has_grid] = np.ceil((gl_max[has_grid] - gl_min[has_grid]) / step).astype(np.int64)
+
+        max_grid = max(int(np.max(n_grid)) if n_points > 0 else 0, 1)
+        grid_mask = np.arange(max_grid)[None,:] < n_grid[:,None]
+        gls_interp = np.where(grid_mask, np.where(has_grid, gl_min, 0)[:,None] + np.arange(max_grid)[None,:] * step, np.nan)
+
+        # Linear interpolation of all points at once, on keys offset by the row
+        # The valid levels of a row are sorted, so are the keys
+        row_offset = (np.arange(n_points) * 4 * (np.max(np.abs(grounding_levels_int)) + max_grid * step + 1)).astype(np.float64)
+
+        level_rows, level_cols = np.nonzero(valid)
+        level_keys = row_offset[level_rows] + levels[level_rows, level_cols]
+        level_values = likelihoods[level_rows, level_cols]
+
+        grid_rows, grid_cols = np.nonzero(grid_mask)
+        grid_keys = row_offset[grid_rows] + gls_interp[grid_rows, grid_cols]
+
+        right = np.searchsorted(level_keys, grid_keys, side='right')
+        left = right - 1
+        # grid < gl_max, so the right neighbour is in the same row
+        weight = (grid_keys - level_keys[left]) / (level_keys[right] - level_keys[left])
+
+        likelihoods_interp = np.full((n_points, max_grid), np.nan)
+        likelihoods_interp[grid_rows, grid_cols] = level_values[left] * (1 - weight) + level_values[right] * weight
+
+        # Normalize in log space
+        min_likelihood = np.min(np.where(grid_mask, likelihoods_interp, np.inf), axis=1)
+        likelihoods_interp = likelihoods_interp - np.where(np.isfinite(min_likelihood), min_likelihood, 0)[:,None]
+        gl_probs_interp = np.where(grid_mask, np.exp(-likelihoods_interp), 0)
+        prob_sum = np.sum(gl_probs_interp, axis=1)
+        gl_probs_interp = gl_probs_interp / np.where(prob_sum > 0, prob_sum, 1)[:,None]
+
+        return (gls_interp, gl_probs_interp, grid_mask)
+
+    def hpdi(self, gls_interp, gl_probs_interp, grid_mask):
+
+        # Shortest window [i, j] with mass >= alpha, the larger mass for windows of the same length
+        # Cumulative mass C, window mass C[j+1] - C[i], j+1 = first index with C >= C[i] + alpha
+        n_points, max_grid = gl_probs_interp.shape
+
+        cum_mass = np.zeros((n_points, max_grid + 1))
+        cum_mass[:,1:] = np.cumsum(gl_probs_interp, axis=1)
+        total_mass = cum_mass[:,-1]
+
+        # Keys offset by the row, the mass of a row is in [0, 1]
+        row_offset = (np.arange(n_points) * 4).astype(np.float64)[:,None]
+        cum_keys = (row_offset + cum_mass).reshape(-1)
+        target_keys = row_offset + cum_mass[:,:-1] + self.alpha * total_mass[:,None] * (1 - 1e-12)
+
+        stop = np.searchsorted(cum_keys, target_keys.reshape(-1), side='left').reshape(n_points, max_grid) - (np.arange(n_points) * (max_grid + 1))[:,None]
+
+        start = np.arange(max_grid)[None,:]
+        reachable = grid_mask & (stop <= max_grid) & (stop > start)
+        stop = np.minimum(stop, max_grid)
+
+        width = stop - start
+        window_mass = np.take_along_axis(cum_mass, stop, axis=1) - cum_mass[:,:-1]
+
+        # width is an integer and window_mass is in [0, 1]
+        score = np.where(reachable, 2 * width - window_mass, np.inf)
+        best_start = np.argmin(score, axis=1)
+        best_stop = stop[np.arange(n_points), best_start] - 1
+
+        valid = np.isfinite(score[np.arange(n_points), best_start]) & (total_mass > 0)
+
+        gl_ci = np.full((n_points, 2), np.nan)
+        gl_ci[valid,0] = gls_interp[valid, best_start[valid]] / 10**6
+        gl_ci[valid,1] = gls_interp[valid, best_stop[valid]] / 10**6
+
+        return gl_ci
+
+    def export_to_others_set(self, point_set, result, others_set, test_point=None):
+
+        # Same entries as fourdvel.select_optimal_grounding_level
+        for ip, point in enumerate(point_set):
+            optimal_grounding_level = result['optimal_grounding_level'][ip]
+            if not np.isnan(optimal_grounding_level):
+                optimal_grounding_level = int(optimal_grounding_level)
+
+            others_set[point]["optimal_grounding_level"] = optimal_grounding_level
+            others_set[point]["up_scale"] = result['up_scale'][ip]
+            others_set[point]["grounding_level_credible_interval"] = tuple(result['grounding_level_credible_interval'][ip])
+
+            if point == test_point:
+                grid_mask = result['grid_mask'][ip]
+                gls_interp = result['grounding_level_grid'][ip][grid_mask]
+                gl_probs_interp = result['grounding_level_prob'][ip][grid_mask]
+
+                others_set[point]["grounding_level_prob"] = {}
+                for i in range(len(gl_probs_interp)):
+                    others_set[point]["grounding_level_prob"][gls_interp[i]] = gl_probs_interp[i]
+
+        return 0
+
+def benchmark(n_points, space, alpha):
+
+    from fourdvel import fourdvel
+    from enum_result_cube import enum_result_cube
+
+    # Synthetic likelihood curves, quadratic around a random optimal level with noise
+    rng = np.random.default_rng(0)
+    grounding_levels_int = np.round(np.arange(-4.0, 4.0 + 1e-6, space) * 10**6).astype(np.int64)
+    grounding_levels_int = np.concatenate(([no_grounding_level_int], grounding_levels_int))
+
+    optimal = rng.uniform(-3, 3, size=(n_points,1))
+    width = rng.uniform(0.1, 1.0, size=(n_points,1))
+    likelihoods = 0.5 * ((grounding_levels_int[None,:] / 10**6 - optimal) / width)**2 + rng.normal(scale=0.05, size=(n_points, len(grounding_levels_int)))
+    likelihoods[:,0] = 1e3
+    up_scales = rng.uniform(0.8, 1.2, size=likelihoods.shape)
+
+    point_set = [(i, 0) for i in range(n_points)]
+    others_set = {point: {} for point in point_set}
+    enum_cube = enum_result_cube(point_set)
+    enum_cube.append(point_set, {point: grounding_levels_int for point in point_set},
+                    {point: likelihoods[ip] for ip, point in enumerate(point_set)},
+                    {point: up_scales[ip] for ip, point in enumerate(point_set)},
+                    {point: np.zeros((len(grounding_levels_int), 4)) for point in point_set})
+    others_set['grounding_level_enum'] = enum_cube
+
+    fourD = fourdvel.__new__(fourdvel)
+    fourD.proj = 'Rutford'
+    fourD.simulation_grounding_level = np.nan
+    fourD.test_point = None
+    grid_set_velo = {point: [0, 0, 1] for point in point_set}
+
+    # Current: loop over points, calc_hpdi_v2
+    start_time = time.time()
+    fourD.select_optimal_grounding_level(point_set, grid_set_velo, others_set)
+    time_loop = time.time() - start_time
+
+    # Vectorized
+    selection = grounding_level_selection(alpha=alpha)
+    start_time = time.time()
+    arrays = enum_cube.arrays(point_set)
+    time_arrays = time.time() - start_time
+    start_time = time.time()
+    result = selection.select(*arrays)
+    time_select = time.time() - start_time
+
+    diff_optimal = np.nanmax(np.abs(result['optimal_grounding_level'] - np.asarray([others_set[point]['optimal_grounding_level'] for point in point_set])))
+    diff_ci = np.nanmax(np.abs(result['grounding_level_credible_interval'] - np.asarray([others_set[point]['grounding_level_credible_interval'] for point in point_set])))
+
+    print("Number of points, levels: ", n_points, len(grounding_levels_int))
+    print("select_optimal_grounding_level (calc_hpdi_v2): ", round(time_loop, 4), "s")
+    print("vectorized (arrays from the enumeration cube, select): ", round(time_arrays, 4), round(time_select, 4), "s")
+    print("max difference of optimal level (m): ", diff_optimal / 10**6)
+    print("max difference of credible interval to calc_hpdi_v2 (m): ", diff_ci)
+
+    # HPDI of one point, calc_hpdi is O(n^3)
+    gls_interp, gl_probs_interp, grid_mask = selection.interp_probs(*arrays[:2])
+    x = gls_interp[0][grid_mask[0]] / 10**6
+    y = gl_probs_interp[0][grid_mask[0]]
+
+    start_time = time.time()
+    gl_ci_1 = fourD.calc_hpdi(x, y.copy(), alpha=alpha)
+    time_hpdi = time.time() - start_time
+    start_time = time.time()
+    gl_ci_2 = fourD.calc_hpdi_v2(x, y.copy(), alpha=alpha)
+    time_hpdi_v2 = time.time() - start_time
+    start_time = time.time()
+    gl_ci_3 = selection.hpdi(gls_interp[:1], gl_probs_interp[:1], grid_mask[:1])[0]
+    time_hpdi_vec = time.time() - start_time
+
+    print("One point, grid size: ", len(x))
+    print("calc_hpdi: ", gl_ci_1, round(time_hpdi, 4), "s")
+    print("calc_hpdi_v2: ", gl_ci_2, round(time_hpdi_v2, 4), "s")
+    print("vectorized: ", tuple(gl_ci_3), round(time_hpdi_vec, 4), "s")
+
+    return 0
+
+def main(iargs=None):
+
+    inps = cmdLineParse(iargs)
+
+    benchmark(inps.n_points, inps.space, inps.alpha)
+
+if __name__=="__main__":
+
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# Normal equations of the points of a tile (tides_1), kept in the tile result for incremental update
+# New offset pairs are folded in, the old ones are never read again
+# Per point: G^T W G, G^T W d, d^T W d and the sufficient statistics of the residual (range and azimuth),
+# for all the data and per track
+
+import numpy as np
+
+class normal_eq_state():
+
+    # Saved states of another version are rebuilt
+    version = 2
+
+    def __init__(self, layout=None):
+
+        # The state is only valid for the same layout (modeling tides, optional columns, t_origin)
+        self.layout = layout
+
+        # point -> dict of arrays
+        self.point_states = {}
+
+    @staticmethod
+    def pair_keys(offsetfields):
+
+        # One int64 per offsetfield: satellite, track, first day and second day
+        sate_track = (offsetfields.sate_code.astype(np.int64) + 1) * 10**4 + offsetfields.track_num.astype(np.int64)
+        days = (offsetfields.day_a.astype(np.int64) + 5*10**5) * 10**6 + (offsetfields.day_b.astype(np.int64) + 5*10**5)
+
+        return sate_track * 10**12 + days
+
+    def new_rows(self, point, pair_keys):
+
+        # Mask of the offsetfields that are not folded in yet
+        # None if some folded offsetfields are gone (excluded tracks etc.), then the point has to be rebuilt
+        if point not in self.point_states:
+            return np.ones(len(pair_keys), dtype=bool)
+
+        folded_keys = self.point_states[point]['pair_keys']
+        if not np.all(np.isin(folded_keys, pair_keys)):
+            return None
+
+        return ~np.isin(pair_keys, folded_keys)
+
+    def reset(self, point, num_params):
+
+        self.point_states[point] = {
+            'pair_keys': np.zeros(shape=(0,), dtype=np.int64),
+            'GtWG': np.zeros(shape=(num_params, num_params)),
+            'GtWd': np.zeros(shape=(num_params,)),
+            'dtWd': 0.0,
+            'resid': self.new_resid_sums(num_params),
+            # (sate, track_num) -> residual sums of the track
+            'tracks': {},
+        }
+
+        return 0
+
+    def new_resid_sums(self, num_params):
+
+        # range and azimuth, unweighted
+        return {
+            'n': np.zeros(shape=(2,), dtype=np.int64),
+            'sum_d': np.zeros(shape=(2,)),
+            'sum_d2': np.zeros(shape=(2,)),
+            'sum_G': np.zeros(shape=(2, num_params)),
+            'GtG': np.zeros(shape=(2, num_params, num_params)),
+            'Gtd': np.zeros(shape=(2, num_params)),
+        }
+
+    def add_resid_sums(self, sums, G, d):
+
+        for c in range(2):
+            Gc = G[c::2]
+            dc = d[c::2]
+            sums['n'][c] += len(dc)
+            sums['sum_d'][c] += np.sum(dc)
+            sums['sum_d2'][c] += np.sum(np.square(dc))
+            sums['sum_G'][c] += np.sum(Gc, axis=0)
+            sums['GtG'][c] += np.matmul(np.transpose(Gc), Gc)
+            sums['Gtd'][c] += np.matmul(np.transpose(Gc), dc)
+
+        return 0
+
+    def add(self, point, G, data_vec, invCd, pair_keys, data_info):
+
+        # Fold in the rows of new offsetfields (two rows each: range, azimuth)
+        # data_info: (sate, track_num) of each offsetfield
+        num_params = G.shape[1]
+        if point not in self.point_states:
+            self.reset(point, num_params)
+
+        state = self.point_states[point]
+        d = np.asarray(data_vec).reshape(-1)
+
+        GtW = np.transpose(G * invCd[:,None])
+        state['GtWG'] += np.matmul(GtW, G)
+        state['GtWd'] += np.matmul(GtW, d)
+        state['dtWd'] += np.sum(invCd * np.square(d))
+
+        self.add_resid_sums(state['resid'], G, d)
+
+        data_info = [tuple(info) for info in data_info]
+        for track in set(data_info):
+            rows = np.repeat(np.asarray([info == track for info in data_info]), 2)
+            if track not in state['tracks']:
+                state['tracks'][track] = self.new_resid_sums(num_params)
+            self.add_resid_sums(state['tracks'][track], G[rows], d[rows])
+
+        state['pair_keys'] = np.concatenate((state['pair_keys'], np.asarray(pair_keys, dtype=np.int64)))
+
+        return 0
+
+    def num_pairs(self, point):
+
+        if point not in self.point_states:
+            return 0
+
+        return len(self.point_states[point]['pair_keys'])
+
+    def normal_eq_set(self, point_set):
+
+        # Same as assemble_normal_eq_set, None if there is no data
+        normal_eq_set = {}
+        for point in point_set:
+            if self.num_pairs(point) == 0:
+                normal_eq_set[point] = None
+            else:
+                state = self.point_states[point]
+                normal_eq_set[point] = (state['GtWG'], state['GtWd'], state['dtWd'])
+
+        return normal_eq_set
+
+    def model_likelihood(self, point, model_vec):
+
+        # 0.5 * (d - Gm)^T W (d - Gm)
+        state = self.point_states[point]
+        m = np.asarray(model_vec).reshape(-1)
+
+        return 0.5 * (state['dtWd'] - 2 * np.dot(m, state['GtWd']) + np.dot(m, np.matmul(state['GtWG'], m)))
+
+    def resid_moments(self, sums, m):
+
+        # Mean and mean square of d - Gm, for range and azimuth
+        moments = []
+        for c in range(2):
+            n = sums['n'][c]
+            if n == 0:
+                moments.append((np.nan, np.nan))
+                continue
+
+            mean = (sums['sum_d'][c] - np.dot(sums['sum_G'][c], m)) / n
+            mean_square = (sums['sum_d2'][c] - 2 * np.dot(m, sums['Gtd'][c]) + np.dot(m, np.matmul(sums['GtG'][c], m))) / n
+
+            moments.append((mean, max(mean_square, 0)))
+
+        return moments
+
+    def resid_stats(self, point, model_vec):
+
+        # Same as resid_to_stats of d - Gm: range mean, range rms, azimuth mean, azimuth rms
+        m = np.asarray(model_vec).reshape(-1)
+
+        stats = []
+        for mean, mean_square in self.resid_moments(self.point_states[point]['resid'], m):
+            stats += [mean, np.sqrt(mean_square)]
+
+        return tuple(stats)
+
+    def track_resid_std(self, point, model_vec, tracks):
+
+        # Same as the std of d - Gm per track in point_residual_analysis, and of all the data
+        m = np.asarray(model_vec).reshape(-1)
+        state = self.point_states[point]
+
+        track_residual = {}
+        for track in tracks:
+            track = tuple(track)
+            if track in state['tracks']:
+                moments = self.resid_moments(state['tracks'][track], m)
+            else:
+                moments = [(np.nan, np.nan)] * 2
+
+            for comp, (mean, mean_square) in zip(['range', 'azimuth'], moments):
+                track_residual[(track, comp)] = np.sqrt(max(mean_square - mean**2, 0))
+
+        for comp, (mean, mean_square) in zip(['range', 'azimuth'], self.resid_moments(state['resid'], m)):
+            track_residual[(('all-sate','all-track'), comp)] = np.sqrt(max(mean_square - mean**2, 0))
+
+        return track_residual
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# Lazy access to the offset field stacks, keyed by track (sate, track_num)
+# A track is loaded at the first use, and kept in a LRU cache with a byte budget
+# Memory-mapped stacks (offset_stack_store) only count the arrays that are in memory
+
+import collections
+
+import numpy as np
+
+class offset_stack_cache():
+
+    def __init__(self, load_func, max_bytes=None):
+
+        # load_func(source) returns the stack of a track
+        self.load_func = load_func
+        self.max_bytes = max_bytes
+
+        # (sate, track_num) -> source (the stack pkl)
+        self.sources = {}
+
+        # (sate, track_num) -> (stack, nbytes), the last used at the end
+        self.stacks = collections.OrderedDict()
+        self.total_bytes = 0
+
+    def register(self, track, source):
+
+        self.sources[track] = source
+
+        return 0
+
+    def __contains__(self, track):
+
+        return track in self.sources
+
+    def keys(self):
+
+        return self.sources.keys()
+
+    def __len__(self):
+
+        return len(self.sources)
+
+    def __getitem__(self, track):
+
+        if track in self.stacks:
+            self.stacks.move_to_end(track)
+            return self.stacks[track][0]
+
+        if track not in self.sources:
+            raise KeyError(track)
+
+        stack = self.load_func(self.sources[track])
+        nbytes = self.stack_nbytes(stack)
+
+        self.stacks[track] = (stack, nbytes)
+        self.total_bytes += nbytes
+
+        # Evict the least recently used tracks, always keep the one just loaded
+        while self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self.stacks) > 1:
+            evicted_track, (_, evicted_bytes) = self.stacks.popitem(last=False)
+            self.total_bytes -= evicted_bytes
+            print("Evict offset field stack: ", evicted_track)
+
+        return stack
+
+    def load_all(self):
+
+        # Eager loading (as before)
+        for track in self.sources:
+            self[track]
+
+        return 0
+
+    def stack_nbytes(self, stack):
+
+        # In-memory bytes of the arrays in the stack
+        if isinstance(stack, np.memmap):
+            return 0
+
+        if isinstance(stack, np.ndarray):
+            return stack.nbytes
+
+        if isinstance(stack, dict):
+            return sum(self.stack_nbytes(key) + self.stack_nbytes(value) for key, value in stack.items())
+
+        if isinstance(stack, (list, tuple)):
+            return sum(self.stack_nbytes(value) for value in stack)
+
+        return 0
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# On-disk store of an offset field stack (offsetFieldStack_*.pkl)
+# The arrays go to raw .npy blocks (arrays of the same shape and dtype stacked in one block),
+# everything else (pairs, geometry, dates, ...) goes to a JSON index
+# The loader opens the blocks with np.memmap (read-only), so all the worker processes
+# share the OS page cache and only the pixels that are used are read from disk
+
+import os
+import json
+import shutil
+import pickle
+import datetime
+import argparse
+
+import numpy as np
+
+class offset_stack_store():
+
+    index_name = 'index.json'
+
+    def __init__(self, store_dir):
+
+        self.store_dir = store_dir
+
+    @staticmethod
+    def store_dir_of_pkl(stack_pkl):
+
+        # offsetFieldStack_xx.pkl -> offsetFieldStack_xx_store
+        return os.path.splitext(stack_pkl)[0] + '_store'
+
+    def exists(self):
+
+        return os.path.exists(os.path.join(self.store_dir, self.index_name))
+
+    def write(self, stack):
+
+        # Collect the arrays, grouped by shape and dtype
+        self.block_keys = []
+        self.block_arrays = []
+
+        tree = self.encode(stack)
+
+        # Write to a temporary folder, then rename (other runs may convert the same stack)
+        tmp_dir = self.store_dir + '.tmp' + str(os.getpid())
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        blocks = []
+        for i, arrays in enumerate(self.block_arrays):
+            block_name = 'block_' + str(i).zfill(3) + '.npy'
+            np.save(os.path.join(tmp_dir, block_name), np.stack(arrays))
+            blocks.append(block_name)
+
+        index = {'blocks': blocks, 'tree': tree}
+        with open(os.path.join(tmp_dir, self.index_name), 'w') as f:
+            json.dump(index, f)
+
+        try:
+            os.rename(tmp_dir, self.store_dir)
+        except OSError:
+            # Already converted by another run
+            shutil.rmtree(tmp_dir)
+
+        del self.block_keys, self.block_arrays
+
+        return 0
+
+    def load(self):
+
+        with open(os.path.join(self.store_dir, self.index_name)) as f:
+            index = json.load(f)
+
+        # Read-only memory maps, nothing is read until the pixels are used
+        self.blocks = [np.load(os.path.join(self.store_dir, block_name), mmap_mode='r') for block_name in index['blocks']]
+
+        stack = self.decode(index['tree'])
+
+        del self.blocks
+
+        return stack
+
+    ## JSON encoding of the stack, the arrays are replaced by (block, slot)
+    def encode(self, obj):
+
+        if isinstance(obj, np.ndarray):
+            if obj.dtype.hasobject:
+                raise ValueError("Cannot store object arrays")
+            key = (obj.dtype.str, obj.shape)
+            if key not in self.block_keys:
+                self.block_keys.append(key)
+                self.block_arrays.append([])
+            i_block = self.block_keys.index(key)
+            self.block_arrays[i_block].append(obj)
+            return {'t': 'array', 'block': i_block, 'slot': len(self.block_arrays[i_block])-1}
+
+        if isinstance(obj, dict):
+            return {'t': 'dict', 'items': [[self.encode(key), self.encode(value)] for key, value in obj.items()]}
+
+        if isinstance(obj, tuple):
+            return {'t': 'tuple', 'v': [self.encode(value) for value in obj]}
+
+        if isinstance(obj, list):
+            return {'t': 'list', 'v': [self.encode(value) for value in obj]}
+
+        if isinstance(obj, np.generic):
+            return {'t': 'scalar', 'dtype': obj.dtype.str, 'v': obj.item()}
+
+        # datetime is a subclass of date
+        if isinstance(obj, datetime.datetime):
+            return {'t': 'datetime', 'v': obj.isoformat()}
+
+        if isinstance(obj, datetime.date):
+            return {'t': 'date', 'v': obj.isoformat()}
+
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return obj
+
+        raise ValueError("Cannot store type: " + str(type(obj)))
+
+    def decode(self, obj):
+
+        if not isinstance(obj, dict):
+            return obj
+
+        t = obj['t']
+
+        if t == 'array':
+            return self.blocks[obj['block']][obj['slot']]
+
+        if t == 'dict':
+            return {self.decode(key): self.decode(value) for key, value in obj['items']}
+
+        if t == 'tuple':
+            return tuple(self.decode(value) for value in obj['v'])
+
+        if t == 'list':
+            return [self.decode(value) for value in obj['v']]
+
+        if t == 'scalar':
+            return np.dtype(obj['dtype']).type(obj['v'])
+
+        if t == 'datetime':
+            return datetime.datetime.fromisoformat(obj['v'])
+
+        if t == 'date':
+            return datetime.date.fromisoformat(obj['v'])
+
+        raise ValueError("Unknown type in store: " + str(t))
+
+def convert_stack_pkl(stack_pkl, store_dir=None):
+
+    # One-time conversion of offsetFieldStack_*.pkl
+    if store_dir is None:
+        store_dir = offset_stack_store.store_dir_of_pkl(stack_pkl)
+
+    store = offset_stack_store(store_dir)
+    if store.exists():
+        print("Store exists: ", store_dir)
+        return store
+
+    print("Converting: ", stack_pkl)
+    with open(stack_pkl, 'rb') as f:
+        stack = pickle.load(f)
+
+    store.write(stack)
+    print("Done: ", store_dir)
+
+    return store
+
+def cmdLineParse(iargs = None):
+
+    parser = argparse.ArgumentParser(description='Convert offset field stacks (pkl) to memory-mapped stores')
+    parser.add_argument('stack_pkls', type=str, nargs='+', help='offsetFieldStack pkl files')
+
+    return parser.parse_args(args=iargs)
+
+def main(iargs=None):
+
+    inps = cmdLineParse(iargs)
+
+    for stack_pkl in inps.stack_pkls:
+        convert_stack_pkl(stack_pkl)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# Columnar table of offsetfields
+# Replaces the list of [date1, date2, vec1, vec2, t_frac] for each point
+
+import datetime
+
+import numpy as np
+
+class offsetfield_table():
+
+    # satellite name <-> integer code
+    sate_names = ['csk', 's1']
+    sate_codes = {'csk': 0, 's1': 1}
+
+    def __init__(self, t_origin, day_a=None, day_b=None, t_frac=None, vecs=None, sate_code=None, track_num=None):
+
+        # t_origin is a datetime.date, day numbers are counted from it
+        if isinstance(t_origin, datetime.datetime):
+            t_origin = t_origin.date()
+        self.t_origin = t_origin
+
+        if day_a is None:
+            day_a = np.zeros(shape=(0,), dtype=np.int32)
+            day_b = np.zeros(shape=(0,), dtype=np.int32)
+            t_frac = np.zeros(shape=(0,), dtype=np.float64)
+            vecs = np.zeros(shape=(0,2,3), dtype=np.float64)
+            sate_code = np.zeros(shape=(0,), dtype=np.int8)
+            track_num = np.zeros(shape=(0,), dtype=np.int32)
+
+        # Columns
+        self.day_a = day_a
+        self.day_b = day_b
+        self.t_frac = t_frac
+        # (n, 2, 3): (los, azi) x (E, N, U)
+        self.vecs = vecs
+        self.sate_code = sate_code
+        self.track_num = track_num
+
+    @classmethod
+    def from_track(cls, t_origin, pairs, vec1, vec2, t_frac, sate, track_num):
+
+        # All offsetfields of one track at one point share vecs, t_frac and track info
+        table = cls(t_origin)
+        n = len(pairs)
+        if n == 0:
+            return table
+
+        t_origin = table.t_origin
+        table.day_a = np.asarray([(pair[0] - t_origin).days for pair in pairs], dtype=np.int32)
+        table.day_b = np.asarray([(pair[1] - t_origin).days for pair in pairs], dtype=np.int32)
+        table.t_frac = np.full(n, t_frac, dtype=np.float64)
+        table.vecs = np.empty(shape=(n,2,3), dtype=np.float64)
+        table.vecs[:,0,:] = vec1
+        table.vecs[:,1,:] = vec2
+        table.sate_code = np.full(n, cls.sate_codes[sate], dtype=np.int8)
+        table.track_num = np.full(n, track_num, dtype=np.int32)
+
+        return table
+
+    @classmethod
+    def from_offsetfields(cls, t_origin, offsetfields, data_info=None):
+
+        # From the old list of [date1, date2, vec1, vec2, t_frac]
+        # data_info is a list of (sate, track_num) of each offsetfield
+        if isinstance(offsetfields, cls):
+            return offsetfields
+
+        table = cls(t_origin)
+        n = len(offsetfields)
+        if n == 0:
+            return table
+
+        t_origin = table.t_origin
+        table.day_a = np.asarray([(offsetfield[0] - t_origin).days for offsetfield in offsetfields], dtype=np.int32)
+        table.day_b = np.asarray([(offsetfield[1] - t_origin).days for offsetfield in offsetfields], dtype=np.int32)
+        table.t_frac = np.asarray([offsetfield[4] for offsetfield in offsetfields], dtype=np.float64)
+        table.vecs = np.asarray([[offsetfield[2], offsetfield[3]] for offsetfield in offsetfields], dtype=np.float64).reshape(n,2,3)
+
+        if data_info is not None:
+            table.sate_code = np.asarray([cls.sate_codes[info[0]] for info in data_info], dtype=np.int8)
+            table.track_num = np.asarray([info[1] for info in data_info], dtype=np.int32)
+        else:
+            table.sate_code = np.full(n, -1, dtype=np.int8)
+            table.track_num = np.full(n, -1, dtype=np.int32)
+
+        return table
+
+    @classmethod
+    def concatenate(cls, tables, t_origin=None):
+
+        tables = [table for table in tables if len(table)>0]
+
+        if len(tables) == 0:
+            return cls(t_origin)
+
+        if len(tables) == 1:
+            return tables[0]
+
+        table = cls(tables[0].t_origin)
+        for name in ['day_a', 'day_b', 't_frac', 'vecs', 'sate_code', 'track_num']:
+            setattr(table, name, np.concatenate([getattr(this_table, name) for this_table in tables], axis=0))
+
+        return table
+
+    def __len__(self):
+        return len(self.day_a)
+
+    def __add__(self, other):
+        # Concatenation (same as list addition before)
+        if isinstance(other, list):
+            if len(other) > 0:
+                raise TypeError("Cannot concatenate offsetfield_table with a non-empty list")
+            return self
+        return offsetfield_table.concatenate([self, other])
+
+    def __radd__(self, other):
+        # [] + table, the initial value of defaultdict(list)
+        if isinstance(other, list):
+            if len(other) > 0:
+                raise TypeError("Cannot concatenate a non-empty list with offsetfield_table")
+            return self
+        return offsetfield_table.concatenate([other, self])
+
+    def __getitem__(self, key):
+
+        # One row, in the old format [date1, date2, vec1, vec2, t_frac]
+        if isinstance(key, (int, np.integer)):
+            return self.row(key)
+
+        # Slice gives views of the columns (zero copy). Index arrays or masks give copies.
+        table = offsetfield_table(self.t_origin)
+        for name in ['day_a', 'day_b', 't_frac', 'vecs', 'sate_code', 'track_num']:
+            setattr(table, name, getattr(self, name)[key])
+
+        return table
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def row(self, i):
+        return [self.day_to_date(self.day_a[i]), self.day_to_date(self.day_b[i]), self.vecs[i,0,:], self.vecs[i,1,:], float(self.t_frac[i])]
+
+    def day_to_date(self, day):
+        return self.t_origin + datetime.timedelta(days=int(day))
+
+    ## Derived columns ##
+    @property
+    def t_a(self):
+        return self.day_a + self.t_frac
+
+    @property
+    def t_b(self):
+        return self.day_b + self.t_frac
+
+    @property
+    def delta_td(self):
+        return (self.day_b - self.day_a).astype(np.float64)
+
+    @property
+    def dates_a(self):
+        return self.days_to_dates(self.day_a)
+
+    @property
+    def dates_b(self):
+        return self.days_to_dates(self.day_b)
+
+    def days_to_dates(self, days):
+        # Only a few hundred unique days, convert them once
+        unique_days, inverse = np.unique(days, return_inverse=True)
+        unique_dates = [self.day_to_date(day) for day in unique_days]
+        return [unique_dates[ind] for ind in inverse.reshape(-1)]
+
+    def timings_a(self):
+        # Keys of timings_tide_heights and design_mat_set: (date, round(t_frac,4))
+        return list(zip(self.dates_a, self.rounded_t_frac()))
+
+    def timings_b(self):
+        return list(zip(self.dates_b, self.rounded_t_frac()))
+
+    def rounded_t_frac(self):
+        # Python round, same as the keys were made
+        unique_t_frac, inverse = np.unique(self.t_frac, return_inverse=True)
+        unique_rounded = [round(t_frac, 4) for t_frac in unique_t_frac.tolist()]
+        return [unique_rounded[ind] for ind in inverse.reshape(-1)]
+
+    def pairnames(self):
+        dates_a = self.dates_a
+        dates_b = self.dates_b
+        return [dates_a[i].strftime('%Y%m%d') + '_' + dates_b[i].strftime('%Y%m%d') for i in range(len(self))]
+
+    def data_info(self):
+        # list of (sate, track_num) of each offsetfield
+        return [(self.sate_code_to_name(sate_code), int(track_num)) for sate_code, track_num in zip(self.sate_code.tolist(), self.track_num.tolist())]
+
+    def sate_code_to_name(self, sate_code):
+        # -1: unknown satellite
+        if sate_code < 0:
+            return None
+        return self.sate_names[sate_code]
+
+    def track_slices(self):
+
+        # The offsetfields of one track are contiguous
+        # Return a list of ((sate, track_num), slice)
+        n = len(self)
+        if n == 0:
+            return []
+
+        change = np.nonzero((np.diff(self.sate_code) != 0) | (np.diff(self.track_num) != 0))[0] + 1
+        starts = np.concatenate(([0], change))
+        stops = np.concatenate((change, [n]))
+
+        slices = []
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            track_name = (self.sate_code_to_name(self.sate_code[start]), int(self.track_num[start]))
+            slices.append((track_name, slice(start, stop)))
+
+        return slices
@@ -73,16 +73,12 @@ class output(fourdvel):
         #            + str(test_id) + '_' + 'grid_set_resid_of_secular.pkl','rb') as f:
         #    self.grid_set_resid_of_secular = pickle.load(f)
 
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_resid_of_tides.pkl','rb') as f:
-            self.grid_set_resid_of_tides = pickle.load(f)
+        self.grid_set_resid_of_tides = self.load_grid_set(this_result_folder, test_id, 'resid_of_tides')
 
         # compare id
         compare_id = 202010565141
 
-        with open(self.estimations_dir + '/' + str(compare_id) + '/' +
-                    str(compare_id) + '_' + 'grid_set_resid_of_tides.pkl','rb') as f:
-            self.grid_set_resid_of_tides_compare = pickle.load(f)
+        self.grid_set_resid_of_tides_compare = self.load_grid_set(self.estimations_dir + '/' + str(compare_id), compare_id, 'resid_of_tides')
 
         # Set the compare set
 
@@ -143,29 +139,24 @@ class output(fourdvel):
 
     def load_master_model(self,num,prefix='est'):
 
-        this_result_folder = self.estimation_dir
         # Load all the results.
         if prefix == 'true':
-            filename = self.estimations_dir +'/'+str(num)+'/'+str(num)+'_grid_set_true_tide_vec.pkl'
+            name = 'true_tide_vec'
         else:
-            filename = self.estimations_dir +'/'+str(num)+'/'+str(num)+'_grid_set_tide_vec.pkl'
-           
-        with open(filename,'rb') as f:
-            self.grid_set_master_model_tide_vec = pickle.load(f)
+            name = 'tide_vec'
+
+        self.grid_set_master_model_tide_vec = self.load_grid_set(self.estimations_dir + '/' + str(num), num, name)
         return 0
 
     def load_slave_model(self,num,prefix='est'):
 
-        this_result_folder = self.estimation_dir
         # Load all the results.
-
         if prefix == 'true':
-            filename = self.estimations_dir + '/' + str(num)+'/'+str(num)+'_grid_set_true_tide_vec.pkl'
+            name = 'true_tide_vec'
         else:
-            filename = self.estimations_dir + '/' + str(num)+'/'+str(num)+'_grid_set_tide_vec.pkl'
- 
-        with open(filename,'rb') as f:
-            self.grid_set_slave_model_tide_vec = pickle.load(f)
+            name = 'tide_vec'
+
+        self.grid_set_slave_model_tide_vec = self.load_grid_set(self.estimations_dir + '/' + str(num), num, name)
         return 0
 
     def load_everything(self):
@@ -174,18 +165,12 @@ class output(fourdvel):
         test_id = self.test_id
 
         # Load all the results.
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_true_tide_vec.pkl','rb') as f:
-            self.grid_set_true_tide_vec = pickle.load(f)
+        self.grid_set_true_tide_vec = self.load_grid_set(this_result_folder, test_id, 'true_tide_vec')
 
 
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_tide_vec.pkl','rb') as f:
-            self.grid_set_tide_vec = pickle.load(f)
+        self.grid_set_tide_vec = self.load_grid_set(this_result_folder, test_id, 'tide_vec')
 
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_tide_vec_uq.pkl','rb') as f:
-            self.grid_set_tide_vec_uq = pickle.load(f)
+        self.grid_set_tide_vec_uq = self.load_grid_set(this_result_folder, test_id, 'tide_vec_uq')
 
         return 0
 
@@ -236,9 +221,7 @@ class output(fourdvel):
         test_id = self.test_id
 
         # load others results
-        with open(this_result_folder + '/' 
-                    + str(test_id) + '_' + 'grid_set_others.pkl','rb') as f:
-            this_grid_set = pickle.load(f)
+        this_grid_set = self.load_grid_set(this_result_folder, test_id, 'others')
 
         # load up amplitude scaling output at estimation stage
         if self.task_name == 'tides_3':
@@ -424,7 +407,7 @@ class output(fourdvel):
 
                             # scaled
                             else:
-                                if "grounding_level_up_scale" in this_grid_set[point]: 
+                                if "up_scale" in this_grid_set[point]: 
                                     grid_set_quant[point] = optimal_grounding_level * crsp_up_scale
                                 else:
                                     raise ValueError()
@@ -577,8 +560,10 @@ class output(fourdvel):
                 # Write to xyz file.
                 xyz_name = os.path.join(this_result_folder, str(test_id) + '_' + state + '_' + 'others' + '_' + quant_name + '.xyz')
                 print("Saving: ", xyz_name)
-                
-                self.display.write_dict_to_xyz(grid_set_quant, xyz_name = xyz_name)
+
+                # The optimal grounding levels are read back as text (estimate, ephemeral grounding points)
+                binary = False if quant_name.startswith("optimal_grounding_level") else None
+                self.display.write_dict_to_xyz(grid_set_quant, xyz_name = xyz_name, binary = binary)
 
                 # Save the results
                 saved_grid_set_quant_results[(state, quant_name)] = grid_set_quant
@@ -671,7 +656,7 @@ class output(fourdvel):
                     self.display.write_dict_to_xyz(grid_set_quant, xyz_name = xyz_name)
 
         # residual analysis 
-        elif self.task_name == 'residual_analysis':
+        elif self.task_name in ['residual_analysis', 'cross_validation']:
             pkl_name = '_'.join((str(test_id), 'grid_set_analysis', self.task_name))  + '.pkl'
 
             with open(this_result_folder + '/' + pkl_name,'rb') as f:
@@ -692,7 +677,10 @@ class output(fourdvel):
             for obs in residual_set_by_obs.keys():
 
                 (obs_sate, obs_track_num), obs_vec = obs
-                xyz_name = os.path.join(this_result_folder, '_'.join(['residual',obs_sate, str(obs_track_num), obs_vec]) + '.xyz')
+                if self.task_name == 'residual_analysis':
+                    xyz_name = os.path.join(this_result_folder, '_'.join(['residual',obs_sate, str(obs_track_num), obs_vec]) + '.xyz')
+                else:
+                    xyz_name = os.path.join(this_result_folder, '_'.join(['cross_validation',obs_sate, str(obs_track_num), obs_vec]) + '.xyz')
 
                 grid_set_quant = residual_set_by_obs[obs]
 
@@ -1135,8 +1123,10 @@ class output(fourdvel):
 
                     processed_grid_set_quant = self.process_grid_set_quant(state, sub_quant_name, grid_set_quant[sub_quant_name])
 
-                    # Write the processed grid_set_quant to xyz 
-                    self.display.write_dict_to_xyz(processed_grid_set_quant, xyz_name = xyz_name)
+                    # Write the processed grid_set_quant to xyz
+                    # The up amplitude scaling is read back as text in run_output_others
+                    binary = False if sub_quant_name == "up_amplitude_scaling" else None
+                    self.display.write_dict_to_xyz(processed_grid_set_quant, xyz_name = xyz_name, binary = binary)
 
                     # Save the results
                     # If this is phase, then phase correction may be done.
@@ -1290,7 +1280,7 @@ def main(iargs=None):
 
     out = output(inps)
 
-    if out.task_name in ['residual_analysis']:
+    if out.task_name in ['residual_analysis', 'cross_validation']:
         out.output_mode = 'analysis'
 
     print('output_mode: ', out.output_mode)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# Column layout of the model vector (and of G) of the linear inversion
+# Fixed once per run from the modeling tides and the optional parameters:
+# 1. secular velocity (E,N,U) 2. tides 3. tides_3 up scale 4. secular variation (E,N,U) 5. topo resid
+
+import numpy as np
+
+class parameter_schema():
+
+    def __init__(self, modeling_tides, up_disp=False, secular_variation=False, topo_resid=False):
+
+        self.modeling_tides = list(modeling_tides)
+        self.n_modeling_tides = len(self.modeling_tides)
+
+        self.up_disp = up_disp
+        self.secular_variation = secular_variation
+        self.topo_resid = topo_resid
+
+        # Secular velocity
+        self.secular_index = np.arange(3)
+
+        # Tides: cosE, cosN, cosU, sinE, sinN, sinU of each tide, (n_modeling_tides, 3)
+        # In tide_vec, the amplitudes and phases take the places of the cos and sin terms
+        self.cos_index = 3 + np.arange(self.n_modeling_tides)[:,None]*6 + np.arange(3)[None,:]
+        self.sin_index = self.cos_index + 3
+        self.amp_index = self.cos_index
+        self.phase_index = self.sin_index
+
+        self.n_tide_params = 3 + self.n_modeling_tides*6
+        num_params = self.n_tide_params
+
+        self.up_index = None
+        if up_disp:
+            self.up_index = num_params
+            num_params += 1
+
+        self.secular_variation_index = None
+        if secular_variation:
+            self.secular_variation_index = np.arange(num_params, num_params+3)
+            num_params += 3
+
+        self.topo_resid_index = None
+        if topo_resid:
+            self.topo_resid_index = num_params
+            num_params += 1
+
+        self.num_params = num_params
+
+        # Parameters after the secular and tidal ones
+        self.extra_index = np.arange(self.n_tide_params, num_params)
+
+        # Columns of G that are an observation vector times a temporal coefficient (Kronecker blocks),
+        # and the columns given per row (up, topo resid)
+        kron_index = list(range(self.n_tide_params))
+        scalar_index = []
+        if up_disp:
+            scalar_index.append(self.up_index)
+        if secular_variation:
+            kron_index += self.secular_variation_index.tolist()
+        if topo_resid:
+            scalar_index.append(self.topo_resid_index)
+
+        self.kron_index = np.asarray(kron_index, dtype=int)
+        self.scalar_index = np.asarray(scalar_index, dtype=int)
+
+        # Columns that do not depend on the grounding level (all but the up column)
+        self.fixed_index = np.delete(np.arange(num_params), [] if self.up_index is None else [self.up_index])
+
+    def tide_index(self, k):
+
+        # The six columns of the k-th tide
+        return np.concatenate((self.cos_index[k], self.sin_index[k]))
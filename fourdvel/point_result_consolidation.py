@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# Consolidation of the tile results (point_result/*.pkl) into the grid sets in load mode
+# Each tile is converted once to a compact shard (a few column arrays, one row per point), named by the mtime of the tile
+# A re-run only converts the tiles that are new or updated, the shards of removed tiles are deleted
+# The grid sets are rebuilt from the columns, without unpickling the values of each point
+# With nthreads > 1, the conversion of the tiles is done by a process pool (the workers only write shards)
+
+import os
+import gc
+import pickle
+import operator
+import itertools
+import multiprocessing
+
+import numpy as np
+
+set_names = ['true_tide_vec_set', 'tide_vec_set', 'tide_vec_uq_set', 'resid_of_secular_set', 'resid_of_tides_set', 'others_set', 'residual_analysis_set']
+
+# Scalar types kept as columns, and the dtype of the column
+column_dtypes = {float: np.float64, int: np.int64, bool: np.bool_, np.float64: np.float64, np.int64: np.int64}
+
+## Encoding of a tile
+def encode_values(values, arrays):
+
+    # Values of the same kind to columns: arrays of the same shape (stacked), scalars,
+    # tuples (a column per position) and dicts with the same keys (a column per key)
+    # Returns the description of the columns, None if the values do not fit
+    value_types = set(map(type, values))
+    if len(value_types) != 1:
+        return None
+    value_type = value_types.pop()
+
+    if value_type is np.ndarray:
+        dtypes = set(map(operator.attrgetter('dtype'), values))
+        shapes = set(map(operator.attrgetter('shape'), values))
+        if len(dtypes) != 1 or len(shapes) != 1:
+            return None
+        if dtypes.pop().hasobject or shapes.pop() == ():
+            return None
+        arrays.append(np.stack(values))
+        return ('array', len(arrays)-1)
+
+    if value_type in column_dtypes:
+        arrays.append(np.asarray(values, dtype=column_dtypes[value_type]))
+        return ('scalar', value_type, len(arrays)-1)
+
+    if value_type is tuple:
+        lengths = set(map(len, values))
+        if lengths == {0} or len(lengths) != 1:
+            return None
+        columns = [encode_values(list(column), arrays) for column in zip(*values)]
+        if None in columns:
+            return None
+        return ('tuple', columns)
+
+    if value_type is dict:
+        fields = set(map(tuple, values))
+        if len(fields) != 1:
+            return None
+        fields = fields.pop()
+        if len(fields) == 0:
+            return None
+        if len(fields) == 1:
+            columns = [encode_values([value[fields[0]] for value in values], arrays)]
+        else:
+            columns = [encode_values(list(column), arrays) for column in zip(*map(operator.itemgetter(*fields), values))]
+        if None in columns:
+            return None
+        return ('dict', list(fields), columns)
+
+    return None
+
+def value_signature(value):
+
+    # For the sets that mix kinds of values, the values of the same signature are encoded together
+    if isinstance(value, np.ndarray):
+        return ('array', value.dtype.str, value.shape)
+
+    if type(value) is tuple:
+        return ('tuple', tuple(map(type, value)))
+
+    if type(value) is dict:
+        return ('dict', tuple(value.keys()), tuple(map(type, value.values())))
+
+    return ('scalar', type(value))
+
+def encode_group(values, arrays):
+
+    try:
+        return encode_values(values, arrays)
+    except OverflowError:
+        # int out of the int64 range
+        return None
+
+def split_point_keys(the_set):
+
+    # The point keys (lon, lat as int) and their values, the other keys go to extras
+    keys = list(the_set.keys())
+    values = list(the_set.values())
+
+    is_tuple = [type(key) is tuple for key in keys]
+    if all(is_tuple):
+        points, extras = keys, {}
+    else:
+        points = [key for key, key_is_tuple in zip(keys, is_tuple) if key_is_tuple]
+        extras = {key: value for key, value, key_is_tuple in zip(keys, values, is_tuple) if not key_is_tuple}
+        values = [value for value, key_is_tuple in zip(values, is_tuple) if key_is_tuple]
+
+    # Fast check of all the points at once
+    try:
+        point_array = np.asarray(points, dtype=np.int64).reshape(-1,2)
+        is_int = set(map(type, itertools.chain.from_iterable(points))) <= {int}
+        ok = len(point_array) == len(points) and is_int
+    except (ValueError, TypeError, OverflowError):
+        ok = False
+
+    if not ok:
+        # Key by key
+        is_point = [len(key) == 2 and type(key[0]) is int and type(key[1]) is int for key in points]
+        extras.update((key, value) for key, value, key_is_point in zip(points, values, is_point) if not key_is_point)
+        points, values = [key for key, key_is_point in zip(points, is_point) if key_is_point], [value for value, key_is_point in zip(values, is_point) if key_is_point]
+        point_array = np.asarray(points, dtype=np.int64).reshape(-1,2)
+
+    return (point_array, points, values, extras)
+
+def encode_point_result(all_sets):
+
+    # Columns of each set, the keys that are not points and the values that do not fit are pickled
+    arrays = []
+    meta = {}
+
+    for set_name in set_names:
+        the_set = all_sets.get(set_name, None)
+        if the_set is None:
+            continue
+
+        point_array, points, values, extras = split_point_keys(the_set)
+
+        # All the values at once, otherwise by signature
+        set_meta = []
+        groups = [(points, values)] if len(values) > 0 else []
+        while groups:
+            group_points, group_values = groups.pop(0)
+
+            n_arrays = len(arrays)
+            group = encode_group(group_values, arrays)
+
+            if group is not None:
+                arrays.append(np.asarray(group_points, dtype=np.int64).reshape(-1,2) if group_points is not points else point_array)
+                set_meta.append((len(arrays)-1, group))
+                continue
+
+            del arrays[n_arrays:]
+
+            # Split the mixed values once, the rest goes to extras
+            if group_values is values:
+                signature_groups = {}
+                for point, value in zip(group_points, group_values):
+                    group_points_values = signature_groups.setdefault(value_signature(value), ([], []))
+                    group_points_values[0].append(point)
+                    group_points_values[1].append(value)
+                if len(signature_groups) > 1:
+                    groups = list(signature_groups.values())
+                    continue
+
+            extras.update(zip(group_points, group_values))
+
+        meta[set_name] = (set_meta, extras)
+
+    return (meta, arrays)
+
+def load_point_result(pklfile):
+
+    with open(pklfile, "rb") as f:
+        all_sets = pickle.load(f)
+
+    return all_sets
+
+def write_point_result_shard(all_sets, shard_file):
+
+    shard = encode_point_result(all_sets)
+
+    # Atomic write
+    tmp_file = shard_file + '.tmp' + str(os.getpid())
+    with open(tmp_file, "wb") as f:
+        pickle.dump(shard, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, shard_file)
+
+    return 0
+
+def write_point_result_shards(jobs):
+
+    # Worker: convert a list of (pklfile, shard_file)
+    for pklfile, shard_file in jobs:
+        write_point_result_shard(load_point_result(pklfile), shard_file)
+
+    return len(jobs)
+
+## Decoding of a shard
+def decode_values(group, arrays):
+
+    kind = group[0]
+
+    if kind == 'array':
+        # Rows of the stack (views)
+        return list(arrays[group[1]])
+
+    if kind == 'scalar':
+        value_type, i_array = group[1:]
+        # Python scalars from tolist, numpy scalars from iteration
+        if value_type in (float, int, bool):
+            return arrays[i_array].tolist()
+        return list(arrays[i_array])
+
+    if kind == 'tuple':
+        return list(zip(*[decode_values(column, arrays) for column in group[1]]))
+
+    fields = group[1]
+    return [dict(zip(fields, row)) for row in zip(*[decode_values(column, arrays) for column in group[2]])]
+
+def read_point_result_shard(shard_file, grid_sets):
+
+    with open(shard_file, "rb") as f:
+        meta, arrays = pickle.load(f)
+
+    for set_name, (set_meta, extras) in meta.items():
+        grid_set = grid_sets[set_name]
+
+        for i_points, group in set_meta:
+            points = map(tuple, arrays[i_points].tolist())
+            grid_set.update(zip(points, decode_values(group, arrays)))
+
+        grid_set.update(extras)
+
+    return 0
+
+class point_result_consolidation():
+
+    def __init__(self, point_result_dir, shard_dir):
+
+        self.point_result_dir = point_result_dir
+        self.shard_dir = shard_dir
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+    def shard_name(self, point_pkl, mtime_ns):
+
+        # point_result_xx.pkl -> point_result_xx.<mtime>.pkl
+        return point_pkl[:-4] + '.' + str(mtime_ns) + '.pkl'
+
+    def consolidate(self, nthreads=1):
+
+        # Tiles on disk and their shards
+        shard_names = {}
+        for point_pkl in os.listdir(self.point_result_dir):
+            if point_pkl.endswith('.pkl'):
+                mtime_ns = os.stat(os.path.join(self.point_result_dir, point_pkl)).st_mtime_ns
+                shard_names[point_pkl] = self.shard_name(point_pkl, mtime_ns)
+
+        # Remove the shards of the tiles that are gone or updated
+        current_shards = set(shard_names.values())
+        for shard in os.listdir(self.shard_dir):
+            if not shard in current_shards:
+                os.remove(os.path.join(self.shard_dir, shard))
+
+        existing_shards = set(os.listdir(self.shard_dir))
+        new_tiles = sorted(point_pkl for point_pkl in shard_names if not shard_names[point_pkl] in existing_shards)
+        print("Number of tiles: ", len(shard_names), ", to convert: ", len(new_tiles))
+
+        jobs = [(os.path.join(self.point_result_dir, point_pkl), os.path.join(self.shard_dir, shard_names[point_pkl])) for point_pkl in new_tiles]
+
+        # Millions of small objects are created and none is garbage, the cyclic gc is paused
+        gc_enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            # Conversion by the pool (contiguous chunks), then all the tiles are read from the shards
+            nthreads = max(1, min(nthreads, len(jobs)))
+            if nthreads > 1:
+                chunks = [jobs[i * len(jobs) // nthreads : (i+1) * len(jobs) // nthreads] for i in range(nthreads)]
+                with multiprocessing.Pool(nthreads) as pool:
+                    pool.map(write_point_result_shards, chunks)
+                new_tiles = []
+
+            # Merge in the order of the tiles
+            # Serial: a new tile is merged as it is read, and converted for the next run
+            grid_sets = {set_name: {} for set_name in set_names}
+            new_tiles = set(new_tiles)
+            for point_pkl in sorted(shard_names.keys()):
+                shard_file = os.path.join(self.shard_dir, shard_names[point_pkl])
+
+                if point_pkl in new_tiles:
+                    all_sets = load_point_result(os.path.join(self.point_result_dir, point_pkl))
+                    write_point_result_shard(all_sets, shard_file)
+
+                    for set_name in set_names:
+                        if all_sets.get(set_name, None) is not None:
+                            grid_sets[set_name].update(all_sets[set_name])
+                else:
+                    read_point_result_shard(shard_file, grid_sets)
+
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        return grid_sets
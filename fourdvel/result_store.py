@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+# Author: Minyan Zhong
+# Development starts in Oct, 2026
+
+# Columnar store of the tile results (replaces point_result/*.pkl and the grid_set pickles)
+# Points are keyed by a global point index (the row in points.npy)
+# Each tile is one chunk (npz, written to a temporary file and renamed, so writers do not block each other)
+# In a chunk, every numeric field of a set is a fixed-width float array, one row per point:
+#   tide_vec_set -> tide_vec_set, others_set[point]['up_scale'] -> others_set/up_scale
+# What does not fit (None, dicts, non-point keys, the normal equations, ...) is pickled per set as extras
+# A field can be read for the whole region without unpickling the sets
+
+import os
+import json
+import pickle
+
+import numpy as np
+
+class result_store():
+
+    set_names = ['true_tide_vec_set', 'tide_vec_set', 'tide_vec_uq_set', 'resid_of_secular_set', 'resid_of_tides_set', 'others_set', 'residual_analysis_set']
+
+    def __init__(self, store_dir, points=None):
+
+        self.store_dir = store_dir
+        self.chunk_dir = os.path.join(store_dir, 'chunks')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+
+        points_file = os.path.join(store_dir, 'points.npy')
+        if not os.path.exists(points_file):
+            if points is None:
+                raise ValueError("Points are needed to create the result store: " + store_dir)
+
+            tmp_file = points_file + '.tmp' + str(os.getpid()) + '.npy'
+            np.save(tmp_file, np.asarray(sorted(points), dtype=np.int64).reshape(-1,2))
+            os.replace(tmp_file, points_file)
+
+        # Global point index
+        self.points = np.load(points_file)
+        self.point_index = {tuple(point): i for i, point in enumerate(self.points.tolist())}
+
+    def chunk_file(self, tile_name):
+
+        return os.path.join(self.chunk_dir, tile_name + '.npz')
+
+    def has_tile(self, tile_name):
+
+        return os.path.exists(self.chunk_file(tile_name))
+
+    def tile_names(self):
+
+        return sorted(chunk[:-4] for chunk in os.listdir(self.chunk_dir) if chunk.endswith('.npz'))
+
+    ## Write
+    def write_tile(self, tile_name, all_sets):
+
+        # Points of this tile, ordered by the global index
+        tile_points = set()
+        for set_name in self.set_names:
+            the_set = all_sets.get(set_name, None)
+            if the_set is not None:
+                tile_points.update(key for key in the_set.keys() if key in self.point_index)
+
+        tile_points = sorted(tile_points, key=lambda point: self.point_index[point])
+        n_points = len(tile_points)
+        row_of_point = {point: row for row, point in enumerate(tile_points)}
+
+        members = {}
+        members['point_index'] = np.asarray([self.point_index[point] for point in tile_points], dtype=np.int64)
+
+        meta = {}
+        for set_name in self.set_names:
+            the_set = all_sets.get(set_name, None)
+
+            # The whole set is missing (e.g. no true tide_vec)
+            if the_set is None:
+                members['extras__' + set_name] = self.pickle_member({'set_is_none': True})
+                continue
+
+            # field name -> list of (row, value)
+            field_values = {}
+            extras = {'whole': {}, 'sub': {}, 'dict_points': []}
+
+            for key, value in the_set.items():
+                if not key in self.point_index:
+                    extras['whole'][key] = value
+                    continue
+
+                row = row_of_point[key]
+
+                if isinstance(value, dict):
+                    # Sub-fields with string keys, others go to extras
+                    if not all(isinstance(sub_key, str) for sub_key in value.keys()):
+                        extras['whole'][key] = value
+                        continue
+
+                    extras['dict_points'].append(key)
+                    for sub_key, sub_value in value.items():
+                        field_values.setdefault(set_name + '/' + sub_key, []).append((row, sub_value))
+                else:
+                    field_values.setdefault(set_name, []).append((row, value))
+
+            for field, values in field_values.items():
+                if len(values) == 0:
+                    continue
+
+                encoded = self.encode_field(values, n_points)
+                if encoded is None:
+                    for row, value in values:
+                        self.add_extra(extras, set_name, field, tile_points[row], value)
+                    continue
+
+                kind, shape, is_int, array, mask, rejected = encoded
+                for row, value in rejected:
+                    self.add_extra(extras, set_name, field, tile_points[row], value)
+
+                i_field = len(meta)
+                meta[field] = {'member': 'f' + str(i_field), 'kind': kind, 'shape': list(shape), 'int': is_int}
+                members['f' + str(i_field)] = array
+                members['m' + str(i_field)] = mask
+
+            members['extras__' + set_name] = self.pickle_member(extras)
+
+        # Everything else in the tile result (normal equations etc.)
+        other_sets = {name: value for name, value in all_sets.items() if not name in self.set_names}
+        members['extras__all_sets'] = self.pickle_member(other_sets)
+
+        members['meta'] = np.asarray(json.dumps(meta))
+
+        # Atomic write
+        chunk_file = self.chunk_file(tile_name)
+        tmp_file = chunk_file + '.tmp' + str(os.getpid()) + '.npz'
+        np.savez(tmp_file, **members)
+        os.replace(tmp_file, chunk_file)
+
+        return 0
+
+    def add_extra(self, extras, set_name, field, point, value):
+
+        if field == set_name:
+            extras['whole'][point] = value
+        else:
+            sub_key = field.split('/', 1)[1]
+            extras['sub'].setdefault(point, {})[sub_key] = value
+
+        return 0
+
+    def encode_field(self, values, n_points):
+
+        # Find the kind of the field from the values: array (fixed shape), tuple (fixed length) or scalar
+        # A scalar field is int if all the values that are not nan are int
+        # The values that do not fit are rejected (go to extras)
+        shapes = {}
+        n_tuple = {}
+        n_scalar = 0
+        all_int = True
+
+        for row, value in values:
+            if isinstance(value, np.ndarray) and value.dtype.kind in 'biuf':
+                shapes[value.shape] = shapes.get(value.shape, 0) + 1
+            elif isinstance(value, (tuple, list)) and self.is_number_list(value):
+                n_tuple[len(value)] = n_tuple.get(len(value), 0) + 1
+            elif self.is_number(value):
+                n_scalar += 1
+                if not np.isnan(value):
+                    all_int = all_int and isinstance(value, (int, np.integer))
+
+        if shapes:
+            # The largest shape, the invalid marker (1,1) of nan is kept as a nan row
+            kind = 'array'
+            shape = max(shapes.keys(), key=lambda shape: (int(np.prod(shape)), shapes[shape]))
+        elif n_tuple:
+            kind = 'tuple'
+            shape = (max(n_tuple.keys(), key=lambda n: n_tuple[n]),)
+        elif n_scalar > 0:
+            kind = 'scalar'
+            shape = ()
+        else:
+            return None
+
+        is_int = kind == 'scalar' and all_int
+
+        width = int(np.prod(shape))
+        array = np.zeros(shape=(n_points, width)) + np.nan
+        mask = np.zeros(shape=(n_points,), dtype=bool)
+        rejected = []
+
+        for row, value in values:
+            if kind == 'array' and isinstance(value, np.ndarray) and value.dtype.kind in 'biuf':
+                if value.shape == tuple(shape):
+                    array[row] = value.reshape(-1)
+                    mask[row] = True
+                    continue
+                if value.size == 1 and np.isnan(value.reshape(-1)[0]):
+                    mask[row] = True
+                    continue
+
+            elif kind == 'tuple' and isinstance(value, (tuple, list)) and len(value) == width and self.is_number_list(value):
+                array[row] = value
+                mask[row] = True
+                continue
+
+            elif kind == 'scalar' and self.is_number(value):
+                array[row,0] = value
+                mask[row] = True
+                continue
+
+            rejected.append((row, value))
+
+        return (kind, shape, is_int, array, mask, rejected)
+
+    def is_number(self, value):
+
+        return isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool)
+
+    def is_number_list(self, value):
+
+        return len(value) > 0 and all(self.is_number(v) for v in value)
+
+    def pickle_member(self, obj):
+
+        return np.frombuffer(pickle.dumps(obj), dtype=np.uint8)
+
+    def unpickle_member(self, chunk, name):
+
+        return pickle.loads(chunk[name].tobytes())
+
+    ## Read
+    def decode_row(self, info, row):
+
+        kind = info['kind']
+
+        if kind == 'array':
+            if np.all(np.isnan(row)):
+                return np.zeros(shape=(1,1)) + np.nan
+            return row.reshape(info['shape']).copy()
+
+        if kind == 'tuple':
+            return tuple(row.tolist())
+
+        # int field, nan stays float (as in the former pickles)
+        if (kind == 'int' or info.get('int', False)) and not np.isnan(row[0]):
+            return int(row[0])
+
+        return float(row[0])
+
+    def read_field(self, field, points=None):
+
+        # One field for the whole region (or the given points), no unpickling
+        # Returns the global index and the (n, width) array, rows without the value are nan
+        if points is not None:
+            wanted = np.asarray(sorted(self.point_index[point] for point in points if point in self.point_index), dtype=np.int64)
+
+        index_list = []
+        value_list = []
+        for tile_name in self.tile_names():
+            with np.load(self.chunk_file(tile_name)) as chunk:
+                meta = json.loads(str(chunk['meta']))
+                if not field in meta:
+                    continue
+
+                point_index = chunk['point_index']
+                if points is not None:
+                    keep = np.isin(point_index, wanted)
+                    if not np.any(keep):
+                        continue
+                else:
+                    keep = slice(None)
+
+                values = chunk[meta[field]['member']][keep]
+                values[~chunk[meta[field]['member'].replace('f', 'm', 1)][keep]] = np.nan
+
+                index_list.append(point_index[keep])
+                value_list.append(values)
+
+        if len(index_list) == 0:
+            return (np.zeros(shape=(0,), dtype=np.int64), np.zeros(shape=(0,1)))
+
+        return (np.concatenate(index_list), np.vstack(value_list))
+
+    def read_grid_set(self, set_name, points=None):
+
+        # Same as the grid_set_* dictionary merged from the tile results
+        grid_set = {}
+        for tile_name in self.tile_names():
+            with np.load(self.chunk_file(tile_name)) as chunk:
+                self.read_chunk_set(chunk, set_name, grid_set, points)
+
+        return grid_set
+
+    def read_tile(self, tile_name):
+
+        # The tile result, same as the former point_result pickle
+        if not self.has_tile(tile_name):
+            return None
+
+        with np.load(self.chunk_file(tile_name)) as chunk:
+            all_sets = self.unpickle_member(chunk, 'extras__all_sets')
+
+            for set_name in self.set_names:
+                the_set = {}
+                is_set = self.read_chunk_set(chunk, set_name, the_set)
+                all_sets[set_name] = the_set if is_set else None
+
+        return all_sets
+
+    def read_chunk_set(self, chunk, set_name, the_set, points=None):
+
+        extras = self.unpickle_member(chunk, 'extras__' + set_name)
+        if extras.get('set_is_none', False):
+            return False
+
+        meta = json.loads(str(chunk['meta']))
+        tile_points = [tuple(point) for point in self.points[chunk['point_index']].tolist()]
+
+        if points is not None:
+            points = set(points)
+
+        # Whole values
+        if set_name in meta:
+            info = meta[set_name]
+            array = chunk[info['member']]
+            mask = chunk[info['member'].replace('f', 'm', 1)]
+            for row in np.nonzero(mask)[0]:
+                point = tile_points[row]
+                if points is None or point in points:
+                    the_set[point] = self.decode_row(info, array[row])
+
+        # Dict values
+        for point in extras['dict_points']:
+            if points is None or point in points:
+                the_set[point] = {}
+
+        prefix = set_name + '/'
+        for field, info in meta.items():
+            if not field.startswith(prefix):
+                continue
+            sub_key = field[len(prefix):]
+            array = chunk[info['member']]
+            mask = chunk[info['member'].replace('f', 'm', 1)]
+            for row in np.nonzero(mask)[0]:
+                point = tile_points[row]
+                if points is None or point in points:
+                    the_set[point][sub_key] = self.decode_row(info, array[row])
+
+        for point, sub_extras in extras['sub'].items():
+            if points is None or point in points:
+                for sub_key, value in sub_extras.items():
+                    the_set[point][sub_key] = value
+
+        # Non-point keys always, the other points if wanted
+        for key, value in extras['whole'].items():
+            if points is None or not key in self.point_index or key in points:
+                the_set[key] = value
+
+        return True
@@ -23,6 +23,7 @@ import time
 from scipy import linalg
 
 from fourdvel import fourdvel
+from parameter_schema import parameter_schema
 from display import display
 
 from basics import basics
@@ -569,10 +570,11 @@ class simulation(fourdvel):
         tidesRut_params = self.tidesRut_params
 
 
-        num_params = 3 + n_modeling_tides*6
-        param_vec = np.zeros(shape=(num_params,1))
+        # Secular and tidal parameters of the modeling tides
+        schema = parameter_schema(modeling_tides)
+        param_vec = np.zeros(shape=(schema.n_tide_params,1))
 
-        param_vec[0:3,0] = secular_v
+        param_vec[schema.secular_index,0] = secular_v
 
         #print(tide_amp)
         #print(stop)
@@ -603,7 +605,8 @@ class simulation(fourdvel):
             phi_U = self.wrapped(phi_U)
 
             # Put them into the vector.
-            param_vec[3 + k*6 : 3 + (k+1)*6] = np.expand_dims(np.asarray([amp_E, amp_N, amp_U, phi_E, phi_N, phi_U]), axis=1)
+            param_vec[schema.amp_index[k],0] = [amp_E, amp_N, amp_U]
+            param_vec[schema.phase_index[k],0] = [phi_E, phi_N, phi_U]
 
         return param_vec
 
@@ -1021,21 +1024,16 @@ class simulation(fourdvel):
                 offset_ENU = np.vstack((np.transpose(offset_EN.reshape(n_offsets,2)), np.transpose(offset_U)))
     
                 # Add the secular components
-                for i in range(n_offsets):
-                    t_a = (offsetfields[i][0] - t_origin).days + round(offsetfields[i][4],4)
-                    t_b = (offsetfields[i][1] - t_origin).days + round(offsetfields[i][4],4)
-                    
-                    tmp = np.asarray(secular_v)
-                    
-                    offset_ENU[:,i] = offset_ENU[:,i] +  tmp * (t_b - t_a) 
+                offsetfields = self.as_offsetfield_table(offsetfields)
+                
+                tmp = np.asarray(secular_v)
+                
+                offset_ENU = offset_ENU + tmp[:,None] * offsetfields.delta_td[None,:]
     
                 #print('offset_ENU: ', offset_ENU.shape)
     
                 # Find observed offset
-                data_vector1 = np.zeros(shape=(n_offsets*2,1))
-                for i in range(n_offsets):
-                    data_vector1[2*i,0] = np.dot(offsetfields[i][2],offset_ENU[:,i])
-                    data_vector1[2*i+1,0] = np.dot(offsetfields[i][3],offset_ENU[:,i])
+                data_vector1 = np.einsum('ikc,ci->ik', offsetfields.vecs, offset_ENU).reshape(n_offsets*2,1)
     
                 data_vector = data_vector1
 
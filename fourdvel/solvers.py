@@ -654,16 +654,9 @@ class solvers(fourdvel):
 
             # Form the necessary vectors
             # vecs & delta_t
-            vecs = np.zeros(shape=(N_data, 3))
-            delta_t = np.zeros(shape=(N_offsets,1))
-            t_origin = self.t_origin.date()
-            
-            for i in range(N_offsets):
-                vecs[2*i,:] = np.asarray(offsetfields[i][2])
-                vecs[2*i+1,:] = np.asarray(offsetfields[i][3])
-                t_a = (offsetfields[i][0] - t_origin).days + round(offsetfields[i][4],4)
-                t_b = (offsetfields[i][1] - t_origin).days + round(offsetfields[i][4],4)
-                delta_t[i,0] = t_b - t_a
+            offsetfields = self.as_offsetfield_table(offsetfields)
+            vecs = offsetfields.vecs.reshape(N_data, 3)
+            delta_t = offsetfields.delta_td.reshape(N_offsets, 1)
 
             delta_t = np.repeat(delta_t, 3, axis=1)
 
@@ -674,11 +667,8 @@ class solvers(fourdvel):
             # vec_mat
             # shape: N_data x (N_offsets*3)
             vec_mat = np.zeros(shape=(N_data, N_offsets*3))
-            for i in range(N_offsets):
-                vec1 = np.asarray(offsetfields[i][2])
-                vec2 = np.asarray(offsetfields[i][3])
-                vec_mat[2*i,    3*i:3*(i+1)] = vec1
-                vec_mat[2*i+1,  3*i:3*(i+1)] = vec2
+            offset_inds = np.arange(N_offsets)
+            vec_mat.reshape(N_offsets, 2, N_offsets, 3)[offset_inds, :, offset_inds, :] = offsetfields.vecs
 
             # Scale observation vector matrix according to sampling sigma
             if reweight:
@@ -1037,26 +1027,16 @@ class solvers(fourdvel):
 
             # Form the necessary vectors
             # vecs & delta_t 
-            vecs = np.zeros(shape=(N_data, 3))
-            delta_t = np.zeros(shape=(N_offsets,1))
-            t_origin = self.t_origin.date()
-
-            for i in range(N_offsets):
-                vecs[2*i,:] = np.asarray(offsetfields[i][2])
-                vecs[2*i+1,:] = np.asarray(offsetfields[i][3])
-                t_a = (offsetfields[i][0] - t_origin).days + round(offsetfields[i][4],4)
-                t_b = (offsetfields[i][1] - t_origin).days + round(offsetfields[i][4],4)
-                delta_t[i,0] = t_b - t_a
+            offsetfields = self.as_offsetfield_table(offsetfields)
+            vecs = offsetfields.vecs.reshape(N_data, 3)
+            delta_t = offsetfields.delta_td.reshape(N_offsets, 1)
 
             delta_t = np.repeat(delta_t, 3, axis=1)
 
             # Form the observation vector matrix
             vec_mat = np.zeros(shape=(N_data, N_offsets*3))
-            for i in range(N_offsets):
-                vec1 = np.asarray(offsetfields[i][2])
-                vec2 = np.asarray(offsetfields[i][3])
-                vec_mat[2*i,    3*i:3*(i+1)] = vec1
-                vec_mat[2*i+1,  3*i:3*(i+1)] = vec2
+            offset_inds = np.arange(N_offsets)
+            vec_mat.reshape(N_offsets, 2, N_offsets, 3)[offset_inds, :, offset_inds, :] = offsetfields.vecs
 
             # Prepare up displacement
             if self.task_name == "tides_2":